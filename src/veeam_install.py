@@ -17,11 +17,30 @@
 
 import sys
 import os
+import io
+import codecs
 import argparse
 import time
 import logging
+import logging.handlers
+import queue
 import re
 import ntpath
+import json
+import functools
+import contextlib
+import contextvars
+import itertools
+import socket
+import uuid
+import hashlib
+import base64
+import math
+import sqlite3
+import threading
+import shutil
+import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from fabric import Connection, task
 
 import vm_operation
@@ -30,460 +49,3518 @@ veeam_serv_hostname = "veeam-serv1"
 veeam_serv_user = "administrator"
 veeam_serv_pw = "Osmium76!"
 veeam_serv_sqlinst = "veeamsql2016"    # Veeam server's SQL instance name
+default_install_workers = 4            # number of Veeam servers installed concurrently
+ssh_connect_timeout = 600
+cmd_line_limit = 8000                  # longest command passed to the cmd.exe shell of the Veeam servers (8191 characters at most)
+ssh_keepalive = 30                     # seconds between ssh keepalive packets on pooled connections
+wait_initial_interval = 2              # first polling interval of the readiness checks, doubled after every miss
+wait_max_interval = 30
+log_wait_timeout = 120                 # seconds to wait for the installer log after the installer returned
+installer_idle_timeout = 600           # seconds to wait for Windows Installer to be free before a re-run
+reboot_down_timeout = 120              # seconds to wait for the ssh port to close after "shutdown -r"
+reboot_up_timeout = 1200               # seconds to wait for the Veeam server to come back after a reboot
+services_ready_timeout = 600           # seconds to wait for the Veeam services after a reboot
+log_tail_lines = 10                    # number of non-blank lines at the end of an installer log that are verified
+log_block_size = 64 * 1024             # installer logs are read backwards in blocks of this size
+default_log_verify = "remote"          # "remote": verify installer logs on the Veeam server, "local": download and verify them
+default_log_monitor = True             # tail the installer logs while the installers run and abort failing or stalled ones
+default_stall_window = 900             # seconds without installer log growth after which a running installer is aborted
+log_monitor_interval = 10              # seconds between two reads of the logs of a running installer
+log_progress_interval = 60             # seconds between two progress messages of a running installer
+log_read_limit = 4 * 1024 * 1024       # most bytes of an installer log read in one poll
+remote_base_dir = "c:\\temp\\veeam_install"    # scripts and installer logs of a run go to its own subdirectory on the Veeam servers
+local_base_dir = "/tmp/veeam_install"             # downloaded installer logs go to <local_base_dir>/<run id>/<server>
+default_keep_runs = 10                 # run directories kept on the controller and on every Veeam server; older ones are removed
+run_dir_pattern = r'^\d{8}_\d{6}_[0-9a-f]{8}$'    # names of the run directories, the only ones that are removed
+verify_remote_dir = ntpath.join(remote_base_dir, "verify")    # scratch directory of the verify mode health probe, never pruned
+run_finished_file = "run_finished"     # written with the run's rc into a run directory the run is done with
+run_keep_age = 7 * 86400               # seconds the run directory of a failed or unfinished run is kept as evidence
+installer_kill_grace = 120             # seconds to wait for the installer run to return after the installer was killed
+log_format_text = '%(asctime)s.%(msecs)03d %(levelname)s {%(module)s} [%(threadName)s] [%(log_context)s] [%(funcName)s] %(message)s'
+log_date_format = '%Y-%m-%d %H:%M:%S'
+log_formats = ["text", "json"]         # format of the log files. The console is always text
+msi_success_str = "MainEngineThread is returning 0"
+veeam_maxsnapshots_reg = {"path": "HKLM:\\SOFTWARE\\Veeam\\Veeam Backup and Replication", "name": "MaxSnapshotsPerDatastore"}
+veeam_maxsnapshots_value = 100
+veeam_service_exe = "c:\\Program Files\\Veeam\\Backup and Replication\\Backup\\Veeam.Backup.Service.exe"    # its version is the installed patch level
+veeam_sql_service = f"MSSQL${veeam_serv_sqlinst.upper()}"    # Windows service of the Veeam server's SQL instance
+health_checks = ["probe", "services", "sql", "registry", "version", "components"]    # columns of the verify mode matrix
+default_golden_image = False          # install one golden VM and clone every Veeam server from it instead of installing each
+golden_poweroff_timeout = 300         # seconds to wait for the golden VM to power off after "shutdown -s"
+default_golden_extra_vm = True         # keep the golden VM as an extra powered off image and clone all vm_count VMs
+default_queue_dir = "veeam_install_queue"    # shared work queue directory of the enqueue and worker modes
+queue_subdirs = ["tasks", "leases", "state", "done"]    # queued tasks, their leases, per-task checkpoints and results
+default_lease_ttl = 300                # seconds a task lease lives without a heartbeat before another worker takes the task over
+queue_poll_interval = 30               # seconds between the looks of a worker for tasks it can lease
+default_verify_workers = 32            # Veeam servers probed at the same time in verify mode
+veeam_service_pkgs = [ {"service": "Veeam Mount Service", "msi": "c:\\veeam_soft\\packages\\VeeamMountService.msi",
+                        "log": "c:\\temp\\veeam_mountserv_install.log", "ps_file": "veeam_mountserv_install.ps1",
+                        "timeout": 1800, "success": msi_success_str},
+                       {"service": "Veeam Distribution Service", "msi": "c:\\veeam_soft\\packages\\VeeamDistributionSvc.msi",
+                        "log": "c:\\temp\\veeam_distribserv_install.log", "ps_file": "veeam_distribserv_install.ps1",
+                        "timeout": 1800, "success": msi_success_str},
+                       {"service": "Veeam Backup Transport", "msi": "c:\\veeam_soft\\packages\\VeeamTransport.msi",
+                        "log": "c:\\temp\\veeam_transport_install.log", "ps_file": "veeam_transport_install.ps1",
+                        "timeout": 1800, "success": msi_success_str},
+                       {"service": "Veeam Agent for Linux Redistributable", "msi": "c:\\veeam_soft\\packages\\VALRedist.msi",
+                        "log": "c:\\temp\\veeam_agtlnxredist_install.log", "ps_file": "veeam_agtlnxredist_install.ps1",
+                        "timeout": 1800, "success": msi_success_str},
+                       {"service": "Veeam Agent for Unix Redistributable", "msi": "c:\\veeam_soft\\packages\\VAURedist.msi",
+                        "log": "c:\\temp\\veeam_agtunxredist_install.log", "ps_file": "veeam_agtunxredist_install.ps1",
+                        "timeout": 1800, "success": msi_success_str},
+                       {"service": "Veeam Agent for Windows Redistributable", "msi": "c:\\veeam_soft\\packages\\VAWRedist.msi",
+                        "log": "c:\\temp\\veeam_agtwinredist_install.log", "ps_file": "veeam_agtwinredist_install.ps1",
+                        "timeout": 1800, "success": msi_success_str, "detect": {"product": "Veeam Agent for Microsoft Windows Redistributable"}} ]
+
+reboot_exit_codes = {1641, 3010}       # installer exit codes of a successful install that needs a reboot
+# 3010 and 1641 are a success that needs a reboot, not a failure
+log_failure_markers = [ r'MainEngineThread is returning (?!(?:3010|1641)\b)[1-9]\d*',
+                        r'success or error status: (?!(?:3010|1641)\b)[1-9]\d*',
+                        r'Installation (?:operation )?failed',
+                        r'Return value 3\b' ]
+
+
+# Veeam installation plan. Every step names its installer, arguments, log, success string,
+# timeout, retries and the steps it depends on. Steps holding the same lock never run at the
+# same time on a server; Windows Installer only runs one msi transaction at a time.
+# The plan can be replaced by an "install_plan" section in the YAML configuration file.
+# Arguments may use the placeholders {vbr_service_user}, {veeam_serv_pw}, {vbr_sqlserv},
+# {veeam_licensefile} and {log}.
+# "detect" tells how a resumed run recognizes an already installed step: "product" (installed
+# program name prefix), "file" and "version" (file version prefix), "registry" ({path, name})
+# and/or "log" (the step's log shows success). msi steps and packages default to their
+# description as product name.
+# "weight" is the admission cost of a heavy step: the shared ESX host and datastore I/O it
+# takes (see "admission" in install_options). Steps of weight 0 always run at once.
+#
+install_step_kinds = ["msi", "exe", "msi_batch", "update_components", "stage_media"]
+install_step_defaults = {"args": [], "timeout": 1800, "success": msi_success_str, "retries": 0, "depends": [], "lock": "msiexec", "weight": 0}
+default_install_plan = [
+    {"name": "catalog", "description": "Veeam Backup Catalog", "kind": "msi",
+     "installer": "c:\\veeam_soft\\catalog\\VeeamBackupCatalog64.msi",
+     "args": ['ACCEPTEULA="1"', 'ACCEPT_THIRDPARTY_LICENSES="1"', 'VBRC_SERVICE_USER="{vbr_service_user}"', 'VBRC_SERVICE_PASSWORD="{veeam_serv_pw}"'],
+     "log": "c:\\temp\\veeam_bkupcatalog_install.log", "ps_file": "veeam_bkupcatalog_install.ps1", "timeout": 900},
+    {"name": "server", "description": "Veeam Backup & Replication Server", "kind": "msi",
+     "installer": "c:\\veeam_soft\\backup\\Server.x64.msi",
+     "args": ['ACCEPTEULA="1"', 'ACCEPT_THIRDPARTY_LICENSES="1"', 'VBR_LICENSE_FILE="{veeam_licensefile}"', 'VBR_SERVICE_USER="{vbr_service_user}"',
+              'VBR_SERVICE_PASSWORD="{veeam_serv_pw}"', 'VBR_SQLSERVER_SERVER="{vbr_sqlserv}"'],
+     "log": "c:\\temp\\veeam_br_install.log", "ps_file": "veeam_br_install.ps1", "retries": 1, "depends": ["catalog"], "weight": 1},
+    {"name": "console", "description": "Veeam Backup & Replication Console", "kind": "msi",
+     "installer": "c:\\veeam_soft\\backup\\Shell.x64.msi",
+     "args": ['ACCEPTEULA="1"', 'ACCEPT_THIRDPARTY_LICENSES="1"'],
+     "log": "c:\\temp\\veeam_brconsole_install.log", "ps_file": "veeam_brconsole_install.ps1", "depends": ["server"]},
+    {"name": "service_pkgs", "description": "Veeam service packages", "kind": "msi_batch",
+     "packages": veeam_service_pkgs, "depends": ["console"]},
+    {"name": "patch", "description": "Veeam Patch \"veeam_backup_11.0.1.1261_CumulativePatch20220302\"", "kind": "exe",
+     "installer": "c:\\veeam_soft\\updates\\veeam_backup_11.0.1.1261_CumulativePatch20220302.exe",
+     "args": ['/silent', '/noreboot', 'VBR_AUTO_UPGRADE="0"', '/log', '{log}'],
+     "log": "c:\\temp\\veeam_patch_install.log", "ps_file": "veeam_patch_install.ps1", "success": "Return value 0", "depends": ["service_pkgs"],
+     "weight": 1, "detect": {"file": veeam_service_exe, "version": "11.0.1.1261"}},
+    {"name": "update_components", "description": "Veeam Backup & Replication server components", "kind": "update_components",
+     "ps_file": "veeam_update_servcomponent.ps1", "depends": ["patch"], "weight": 1, "detect": {"registry": veeam_maxsnapshots_reg}} ]
+media_stage_step = {"name": "media", "description": "Veeam installer media", "kind": "stage_media", "timeout": 3600, "retries": 1, "lock": None}
+default_plan_workers = 4               # steps of one server's plan that may run at the same time
+default_state_file = "veeam_install_state.json"    # per-server checkpoints of the completed install plan steps
+default_pipeline = True                # install every deployed VM as soon as it is ready instead of after all deployments
+default_provision_workers = 1          # "veeam_install" entries deployed at the same time in pipeline mode
+media_remote_dir = "c:\\veeam_soft"  # installer media directory on the Veeam servers, staged from install_options media_dir
+media_manifest_file = "veeam_media_manifest.json"    # SHA-256 manifest of media_dir, also the cache of the file hashes
+media_chunk_size = 8 * 1024 * 1024     # media files are uploaded in chunks of this size
+default_media_streams = 4              # parallel sftp streams per media upload
+media_journal_dir = "/tmp/veeam_install/media_journal"    # uploaded chunks per server and file, to resume interrupted uploads
+default_history_db = "veeam_install_history.db"    # SQLite history of the step durations the timeouts are learned from
+history_min_samples = 5                # earlier successful runs of a step needed before its timeout is learned
+history_window = 50                    # most recent successful runs of a step the percentiles are taken over
+history_timeout_factor = 3.0           # learned timeout: this many times the 95th percentile of the step duration
+history_min_timeout = 300              # learned timeouts are never shorter than this
+history_stall_factor = 3.0             # learned stall window: this many times the 95th percentile of the longest log gap
+history_min_stall = 120                # learned stall windows are never shorter than this
+history_learned_kinds = ["msi", "exe", "msi_batch", "update_components"]    # the media step depends on what is already staged
+slow_step_factor = 1.5                 # a step is reported slow above this many times its 95th percentile
+default_admission_limits = {"global": 0, "esx": 0, "datastore": 2}    # weight of the heavy steps running at once in total, per ESX host and per datastore. 0 is no limit
+vm_ready_timeout = 900                 # seconds to wait for a deployed VM to report its ip address and open its ssh port
+# Failure classes of install plan steps, checked in this order: installer exit codes (also the
+# MSI return value in the log) and patterns of the log failure lines and abort reasons.
+# Stalled installers, command timeouts, transport errors and other failures are told apart after these.
+failure_classes = [ ("fatal", {1601, 1602, 1619, 1620, 1625, 1633, 1638, 1639},
+                     r'Error 13(?:09|11)\b|license (?:file )?is (?:invalid|expired)|not supported on this operating system'),
+                    ("reboot_pending", {1641, 3010}, r'pending (?:reboot|restart)|(?:reboot|restart) is required'),
+                    ("msi_busy", {1618}, r'another (?:installation is already in progress|program is being installed)') ]
+transient_exceptions = ["ConnectionError", "EOFError", "TimeoutError", "gaierror", "NoValidConnectionsError", "SSHException"]    # exception classes of transport failures
+# other OSErrors are local failures (a missing media file, a full disk) that a re-run does not fix: fatal
+timeout_exceptions = ["CommandTimedOut"]    # an installer command that ran into its timeout; the installer may still run
+# Retry budget per failure class and step, and the first backoff in seconds, doubled on every
+# retry of the class. A budget of None is the step's "retries". install_options
+# "retry_policy" overrides them per class. Every re-run also waits for the server to be ready
+# (see prepare_retry); a backoff only adds time for failures that readiness does not show.
+default_retry_policy = {"transient": {"budget": 3, "backoff": 30},
+                        "msi_busy": {"budget": 3, "backoff": 120},
+                        "reboot_pending": {"budget": 1, "backoff": 0},
+                        "stalled": {"budget": 1, "backoff": 0},
+                        "timed_out": {"budget": 0, "backoff": 0},
+                        "install_failed": {"budget": None, "backoff": 0},
+                        "unknown": {"budget": None, "backoff": 0},
+                        "fatal": {"budget": 0, "backoff": 0}}
+retry_backoff_max = 600                # longest backoff in seconds
+failure_context = contextvars.ContextVar("veeam_failure_context", default=None)    # evidence of the failure of the running step attempt
+trace_phases = ["admit", "retry", "connect", "put", "exec", "wait", "get", "verify", "reboot", "probe"]    # spans reported per install step
+trace_context = contextvars.ContextVar("veeam_trace_context", default=None)    # innermost open span of the current thread
+
+
+# create the metrics store. Every finished span is written as one JSON line to metrics_file.
+#
+def init_metrics(vcdata, metrics_file, prom_file=None):
+    metrics = {"path": metrics_file, "prom_file": prom_file, "lock": threading.Lock(), "spans": [], "ids": itertools.count(1), "fh": None}
+    try:
+        metrics["fh"] = open(metrics_file, 'w', buffering=1)
+    except (IOError, OSError) as exp:
+        vcdata["mylogger"].warning(f"Unable to open metrics file {metrics_file}. Exception details: {exp}")
+    vcdata["metrics"] = metrics
+
+
+# time a block of work as a span. Spans nest: a span opened inside another one records it as
+# parent and inherits its server, VM name and step. vcdata may be None inside an open span. Callers
+# can store the return code of the work in span["rc"].
+#
+@contextlib.contextmanager
+def trace_span(vcdata, name, **fields):
+    parent = trace_context.get()
+    metrics = vcdata.get("metrics") if vcdata else None
+    if(metrics is None and parent is not None):
+        metrics = parent["metrics"]
+    if metrics is None:
+        yield {}
+        return
+
+    span = {"metrics": metrics, "id": next(metrics["ids"]), "parent": parent["id"] if parent else None, "span": name,
+            "server": parent["server"] if parent else None, "vm_name": parent.get("vm_name") if parent else None,
+            "step": parent["step"] if parent else None, "rc": None}
+    span.update(fields)
+    span["start"] = time.time()
+    token = trace_context.set(span)
+    try:
+        yield span
+    except BaseException:
+        span["rc"] = "exception"
+        raise
+    finally:
+        trace_context.reset(token)
+        span["end"] = time.time()
+        span["duration"] = round(span["end"] - span["start"], 3)
+        record_span(span)
+
+
+def record_span(span):
+    metrics = span["metrics"]
+    record = { key: value for (key, value) in span.items() if key != "metrics" }
+    with metrics["lock"]:
+        metrics["spans"].append(record)
+        if metrics["fh"] is not None:
+            metrics["fh"].write(json.dumps(record) + '\n')
+
+
+# total duration of the direct children of a span per phase
+#
+def get_phase_durations(children, span_id):
+    durations = dict.fromkeys(trace_phases, 0.0)
+    for child in children.get(span_id, []):
+        if child["span"] in durations:
+            durations[child["span"]] += child["duration"]
+    return durations
+
+
+# log the end-of-run timing summary. The slowest server is the critical path of the run; its
+# steps are listed from the longest down with the time spent in each phase.
+#
+def log_metrics_summary(vcdata):
+    mylogger = vcdata["mylogger"]
+    metrics = vcdata.get("metrics")
+    if metrics is None:
+        return
+
+    spans = list(metrics["spans"])
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent"], []).append(span)
+
+    servers = [ span for span in spans if span["span"] == "server" ]
+    if not servers:
+        return
+
+    critical = max(servers, key=lambda span: span["duration"])
+    mylogger.info('-'*15 + f"Critical path: server {critical['server']} ({critical.get('vm_name')}), "
+                  f"{time.strftime('%H:%M:%S', time.gmtime(critical['duration']))}" + '-'*15)
+    mylogger.info(f"{'step':<20}{'total':>10}" + ''.join(f"{phase:>9}" for phase in trace_phases) + f"{'other':>9}")
+
+    steps = sorted(children.get(critical["id"], []), key=lambda span: span["duration"], reverse=True)
+    for step in steps:
+        durations = get_phase_durations(children, step["id"])
+        other = max(0.0, step["duration"] - sum(durations.values()))
+        mylogger.info(f"{str(step['step'] or step['span']):<20}{step['duration']:>10.1f}"
+                      + ''.join(f"{durations[phase]:>9.1f}" for phase in trace_phases) + f"{other:>9.1f}")
+
+    fleet = dict.fromkeys(trace_phases, 0.0)
+    for span in spans:
+        if(span["span"] in ("server", "step")):
+            for (phase, duration) in get_phase_durations(children, span["id"]).items():
+                fleet[phase] += duration
+    mylogger.info("Time by phase over all servers (seconds): " + ', '.join(f"{phase} {fleet[phase]:.1f}" for phase in trace_phases))
+
+
+def prom_labels(**labels):
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for (key, value) in labels.items()) + '}'
+
+
+# export the server and step durations in the Prometheus text format, e.g. for the
+# node_exporter textfile collector. The file is replaced atomically.
+#
+def write_prometheus_textfile(vcdata):
+    metrics = vcdata.get("metrics")
+    if(metrics is None or not metrics["prom_file"]):
+        return
+
+    spans = list(metrics["spans"])
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent"], []).append(span)
+
+    lines = ["# HELP veeam_install_server_duration_seconds Duration of the Veeam installation of a server",
+             "# TYPE veeam_install_server_duration_seconds gauge"]
+    lines += [ f"veeam_install_server_duration_seconds{prom_labels(server=span['server'], rc=span['rc'])} {span['duration']}"
+               for span in spans if span["span"] == "server" ]
+    lines += ["# HELP veeam_install_step_duration_seconds Duration of an install plan step",
+              "# TYPE veeam_install_step_duration_seconds gauge"]
+    lines += [ f"veeam_install_step_duration_seconds{prom_labels(server=span['server'], step=span['step'], rc=span['rc'])} {span['duration']}"
+               for span in spans if span["span"] == "step" ]
+    lines += ["# HELP veeam_install_step_phase_seconds Time an install plan step spent in a phase",
+              "# TYPE veeam_install_step_phase_seconds gauge"]
+    for span in spans:
+        if(span["span"] == "step"):
+            for (phase, duration) in get_phase_durations(children, span["id"]).items():
+                lines.append(f"veeam_install_step_phase_seconds{prom_labels(server=span['server'], step=span['step'], phase=phase)} {round(duration, 3)}")
+
+    lines += ["# HELP veeam_install_queue_wait_seconds Time an item waited for a worker of a pipeline stage",
+              "# TYPE veeam_install_queue_wait_seconds gauge"]
+    lines += [ f"veeam_install_queue_wait_seconds{prom_labels(stage=span['stage'], item=span['item'])} {span['duration']}"
+               for span in spans if span["span"] == "queue" ]
+    lines += ["# HELP veeam_install_provision_duration_seconds Duration of the deployment of a veeam_install entry",
+              "# TYPE veeam_install_provision_duration_seconds gauge"]
+    lines += [ f"veeam_install_provision_duration_seconds{prom_labels(unit=span['unit'], rc=span['rc'])} {span['duration']}"
+               for span in spans if span["span"] == "provision" ]
+
+    lines += ["# HELP veeam_install_admission_wait_seconds Time a server's heavy steps waited for admission",
+              "# TYPE veeam_install_admission_wait_seconds gauge"]
+    waits = {}
+    for span in spans:
+        if(span["span"] == "admit"):
+            waits[span["server"]] = waits.get(span["server"], 0.0) + span["duration"]
+    lines += [ f"veeam_install_admission_wait_seconds{prom_labels(server=server)} {round(wait, 3)}" for (server, wait) in waits.items() ]
+
+    tmp_file = f"{metrics['prom_file']}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, metrics["prom_file"])
+    except (IOError, OSError) as exp:
+        vcdata["mylogger"].warning(f"Unable to write Prometheus textfile {metrics['prom_file']}. Exception details: {exp}")
+
+
+def close_metrics(vcdata):
+    metrics = vcdata.get("metrics")
+    if(metrics is not None and metrics["fh"] is not None):
+        metrics["fh"].close()
+        metrics["fh"] = None
+
+
+# name the run and its directories. Every run keeps its remote scripts and installer logs,
+# and its downloaded logs, apart from the other runs of this and other controller hosts.
+#
+def init_run_dirs(vcdata):
+    vcdata["run_id"] = time.strftime('%Y%m%d_%H%M%S') + '_' + uuid.uuid4().hex[:8]
+    vcdata["remote_dir"] = ntpath.join(remote_base_dir, vcdata["run_id"])
+    vcdata["local_dir"] = os.path.join(local_base_dir, vcdata["run_id"])
+    vcdata["mylogger"].info(f"Run {vcdata['run_id']}: scripts and installer logs in {vcdata['remote_dir']} on the Veeam servers, "
+                            f"downloaded logs in {vcdata['local_dir']}")
+    prune_local_run_dirs(vcdata)
+
+
+def get_keep_runs(vcdata):
+    return max(1, int(vcdata.get("options", {}).get("keep_runs", default_keep_runs)))
+
+
+# the run directories to remove. runs maps every run directory name to the rc its run
+# recorded when it finished, or None while the run is running (or crashed). The newest
+# keep_runs directories, this run's included, are kept. An older directory is only removed
+# when its run succeeded or is older than run_keep_age, and never when it is newer than the
+# oldest running run: a run started earlier may still use its directory.
+#
+def get_prunable_run_dirs(runs, run_id, keep_runs, now=None):
+    now = time.time() if now is None else now
+    age = lambda name: now - time.mktime(time.strptime(name[:15], '%Y%m%d_%H%M%S'))
+    oldest_running = min([ name for (name, rc) in runs.items() if rc is None and age(name) < run_keep_age ] + [run_id])
+    names = sorted(name for name in runs if name != run_id)
+    return [ name for name in names[:max(0, len(names) - keep_runs + 1)]
+             if name < oldest_running and (runs[name] == 0 or age(name) >= run_keep_age) ]
+
+
+# the rc recorded in a run_finished_file, None if the run has not finished
+#
+def parse_run_rc(text):
+    if text is None:
+        return None
+    return int(text.strip()) if text.strip().lstrip('-').isdigit() else 1
+
+
+# remove the local run directories of the earlier runs that get_prunable_run_dirs allows
+#
+def prune_local_run_dirs(vcdata):
+    runs = {}
+    try:
+        for name in os.listdir(local_base_dir):
+            if re.match(run_dir_pattern, name):
+                runs[name] = None
+                finished = os.path.join(local_base_dir, name, run_finished_file)
+                if os.path.exists(finished):
+                    with open(finished, 'r') as fh:
+                        runs[name] = parse_run_rc(fh.read())
+    except (IOError, OSError):    # no run yet
+        return
+    for name in get_prunable_run_dirs(runs, vcdata["run_id"], get_keep_runs(vcdata)):
+        shutil.rmtree(os.path.join(local_base_dir, name), ignore_errors=True)
+        vcdata["mylogger"].debug(f"Removed run directory {os.path.join(local_base_dir, name)}")
+
+
+# record in the local run directory that the run is done with it
+#
+def mark_local_run_finished(vcdata, rc):
+    try:
+        os.makedirs(vcdata["local_dir"], exist_ok=True)
+        with open(os.path.join(vcdata["local_dir"], run_finished_file), 'w') as fh:
+            fh.write(f"{rc}\n")
+    except (IOError, OSError) as exp:
+        vcdata["mylogger"].warning(f"Unable to mark run directory {vcdata['local_dir']} finished. Exception details: {exp}")
+
+
+# path of a script or installer log in the run directory of the Veeam servers. Only the
+# file name of a configured path is kept.
+#
+def remote_run_path(vcdata, fname):
+    return ntpath.join(vcdata["remote_dir"], ntpath.basename(fname))
+
+
+# local file of the run for a Veeam server
+#
+def local_run_path(vcdata, veeam_serv, fname):
+    path = os.path.join(vcdata["local_dir"], veeam_serv)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, fname)
+
+
+# convert a Windows path to its sftp form: "c:\temp\xxx.log" becomes "/c:/temp/xxx.log"
+#
+def sftp_path(path):
+    return '/' + path.replace('\\', '/')
+
+
+# create the per-host ssh connection pool. Each Veeam server keeps one authenticated
+# transport (with its sftp and exec channels) for the whole install chain.
+#
+def init_ssh_pool(vcdata):
+    vcdata["ssh_pool"] = {"lock": threading.Lock(), "hosts": {}, "stats": {"hit": 0, "miss": 0, "reconnect": 0}}
+
+
+def count_ssh_pool(pool, counter):
+    with pool["lock"]:
+        pool["stats"][counter] += 1
+
+
+# get the pooled ssh connection to a Veeam server. A new connection is opened on the
+# first use and whenever the pooled transport is no longer active, e.g. after a reboot.
+#
+def get_connection(vcdata, veeam_serv):
+    pool = vcdata["ssh_pool"]
+    with pool["lock"]:
+        entry = pool["hosts"].setdefault(veeam_serv, {"conn": None, "opened": 0, "lock": threading.Lock()})
+
+    with entry["lock"]:
+        conn = entry["conn"]
+        if conn is not None and conn.is_connected:
+            count_ssh_pool(pool, "hit")
+            return conn
+
+        if conn is not None:
+            close_quietly(conn)
+            entry["conn"] = None
+        count_ssh_pool(pool, "reconnect" if entry["opened"] > 0 else "miss")
+
+        vcdata["mylogger"].debug(f"Opening ssh connection to Veeam backup server {veeam_serv}")
+        with trace_span(vcdata, "connect"):
+            conn = Connection(veeam_serv, user=veeam_serv_user, connect_kwargs={"password": veeam_serv_pw}, connect_timeout=ssh_connect_timeout)
+            conn.open()
+            conn.transport.set_keepalive(ssh_keepalive)
+        entry["conn"] = conn
+        entry["opened"] += 1
+        return conn
+
+
+# close the pooled connection to a Veeam server. The next get_connection() reconnects.
+#
+def drop_connection(vcdata, veeam_serv):
+    pool = vcdata["ssh_pool"]
+    with pool["lock"]:
+        entry = pool["hosts"].get(veeam_serv)
+    if entry is None:
+        return
+
+    with entry["lock"]:
+        if entry["conn"] is not None:
+            close_quietly(entry["conn"])
+            entry["conn"] = None
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def log_ssh_pool_stats(vcdata):
+    stats = vcdata["ssh_pool"]["stats"]
+    vcdata["mylogger"].info(f"SSH connection pool: {stats['hit']} hit(s), {stats['miss']} miss(es), {stats['reconnect']} reconnect(s)")
+
+
+# queue depths of the provisioning and install stages of the pipeline
+#
+def init_pipeline(vcdata):
+    vcdata["pipeline"] = {"lock": threading.Lock(), "depth": {"provision": 0, "install": 0}, "max_depth": {"provision": 0, "install": 0}}
+
+
+def update_queue_depth(vcdata, stage, delta):
+    pipeline = vcdata["pipeline"]
+    with pipeline["lock"]:
+        pipeline["depth"][stage] += delta
+        depth = pipeline["depth"][stage]
+        pipeline["max_depth"][stage] = max(pipeline["max_depth"][stage], depth)
+    vcdata["mylogger"].debug(f"Pipeline {stage} queue depth: {depth}")
+    return depth
+
+
+# run func(*args) taken from the queue of a pipeline stage. The time since enqueued is
+# recorded as a "queue" span of the item.
+#
+def run_queued(vcdata, stage, item, enqueued, func, *args):
+    depth = update_queue_depth(vcdata, stage, -1)
+    with trace_span(vcdata, "queue", stage=stage, item=item) as span:
+        span.update({"start": enqueued, "depth": depth, "rc": 0})
+    return func(*args)
+
+
+# log where the pipeline waited: the time spent deploying, waiting for the VMs to be ready and
+# queueing for a worker, and how much of the installation overlapped the deployments
+#
+def log_pipeline_summary(vcdata):
+    mylogger = vcdata["mylogger"]
+    metrics = vcdata.get("metrics")
+    if(metrics is None or "pipeline" not in vcdata):
+        return
+
+    spans = list(metrics["spans"])
+    stages = [ ("provision", [ span for span in spans if span["span"] == "provision" ]),
+               ("vm ready", [ span for span in spans if span["span"] == "vm_ready" ]),
+               ("provision queue", [ span for span in spans if span["span"] == "queue" and span["stage"] == "provision" ]),
+               ("install queue", [ span for span in spans if span["span"] == "queue" and span["stage"] == "install" ]),
+               ("install", [ span for span in spans if span["span"] == "server" ]) ]
+    mylogger.info('-'*15 + "Pipeline stages" + '-'*15)
+    mylogger.info(f"{'stage':<20}{'items':>6}{'mean':>10}{'max':>10}")
+    for (stage, stage_spans) in stages:
+        if stage_spans:
+            durations = [ span["duration"] for span in stage_spans ]
+            mylogger.info(f"{stage:<20}{len(durations):>6}{sum(durations) / len(durations):>10.1f}{max(durations):>10.1f}")
+
+    max_depth = vcdata["pipeline"]["max_depth"]
+    mylogger.info(f"Maximum queue depth: provision {max_depth['provision']}, install {max_depth['install']}")
+    (provisions, installs) = (stages[0][1], stages[-1][1])
+    if(provisions and installs):
+        overlap = max(provisions, key=lambda span: span["end"])["end"] - min(installs, key=lambda span: span["start"])["start"]
+        mylogger.info(f"Installation overlapped the deployments by {max(overlap, 0):.1f} seconds")
+
+
+# poll check() with exponential backoff until it returns True or the deadline passes.
+# Return 0 when the condition is met, 1 on timeout.
+#
+def wait_until(mylogger, desc, check, timeout, interval=wait_initial_interval, max_interval=wait_max_interval):
+    deadline = time.time() + timeout
+    mylogger.debug(f"Waiting up to {timeout} seconds for {desc}")
+    with trace_span(None, "wait", desc=desc) as span:
+        while True:
+            try:
+                ready = check()
+            except Exception as exp:
+                mylogger.debug(f"Checking {desc} caught an exception. Exception details: {exp}")
+                ready = False
+
+            if ready:
+                span["rc"] = 0
+                return 0
+
+            remaining = deadline - time.time()
+            if(remaining <= 0):
+                mylogger.warning(f"Timed out after {timeout} seconds waiting for {desc}")
+                span["rc"] = 1
+                return 1
+
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+
+# check whether the ssh port of a Veeam server accepts connections
+#
+def ssh_port_open(veeam_serv, port=22, timeout=5):
+    try:
+        with socket.create_connection((veeam_serv, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+# check whether a remote file exists and is not empty. remote_path is in the sftp form "/C:/temp/xxx.log"
+#
+def remote_file_ready(conn, remote_path):
+    return conn.sftp().stat(remote_path).st_size > 0
+
+
+# run a PowerShell script on a Veeam server without uploading it. The script is passed
+# base64 encoded so that it needs no quoting for the remote cmd.exe shell. A script too long
+# for the cmd.exe command line is uploaded to the run directory and run from there.
+#
+def run_powershell(vcdata, veeam_serv, script, timeout=180, results=None):
+    script = "$ProgressPreference = 'SilentlyContinue' \n" + script    # progress records would come back on stderr
+    encoded = base64.b64encode(script.encode("utf-16-le")).decode("ascii")
+    cmd = f"powershell -NoProfile -NonInteractive -EncodedCommand {encoded}"
+    if(len(cmd) > cmd_line_limit and "remote_dir" in vcdata):
+        remote_script = remote_run_path(vcdata, f"script_{hashlib.sha256(script.encode()).hexdigest()[:16]}.ps1")
+        if(put_script(vcdata, veeam_serv, script, remote_script) != 0):
+            return 1
+        cmd = f"powershell -NoProfile -NonInteractive -File {remote_script}"
+    try:
+        conn = get_connection(vcdata, veeam_serv)
+    except Exception as exp:
+        vcdata["mylogger"].warning(f"Unable to establish connection to Veeam backup server {veeam_serv}. Exception details: {exp}")
+        return 1
+
+    return run_command(cmd, conn, vcdata["mylogger"], timeout, results)
+
+
+# get the LastBootUpTime of a Veeam server. Return None if it cannot be queried.
+#
+def get_last_boot_time(vcdata, veeam_serv):
+    results = []
+    script = "(Get-CimInstance -ClassName Win32_OperatingSystem).LastBootUpTime.ToUniversalTime().ToString('o')"
+    rc = run_powershell(vcdata, veeam_serv, script, results=results)
+    if(rc != 0 or not results or not results[0].strip()):
+        return None
+    return results[0].strip()
+
+
+# check that no other Windows Installer transaction is running on a Veeam server
+#
+def installer_idle(vcdata, veeam_serv):
+    results = []
+    script = ("try { $mutex = [System.Threading.Mutex]::OpenExisting('Global\\_MSIExecute'); $mutex.Dispose(); 'busy' } "
+              "catch { 'idle' }")
+    rc = run_powershell(vcdata, veeam_serv, script, results=results)
+    return rc == 0 and results == ["idle"]
+
+
+# check that every automatic Veeam service of a Veeam server is running
+#
+def veeam_services_running(vcdata, veeam_serv):
+    results = []
+    script = ("$services = @(Get-Service -Name 'Veeam*' | Where-Object { $_.StartType -eq 'Automatic' }) \n"
+              "$stopped = @($services | Where-Object { $_.Status -ne 'Running' }) \n"
+              "\"$($services.Count) $($stopped.Count)\"")
+    rc = run_powershell(vcdata, veeam_serv, script, results=results)
+    if(rc != 0 or not results):
+        return False
+
+    (total, stopped) = results[-1].split()
+    return int(total) > 0 and int(stopped) == 0
+
+
+# reboot a Veeam server and wait till it is back
+#
+def reboot_veeam_server(vcdata, veeam_serv, timeout=180):
+    with trace_span(vcdata, "reboot") as span:
+        rc = wait_for_reboot(vcdata, veeam_serv, timeout)
+        span["rc"] = rc
+    return rc
+
+
+# reboot a Veeam server and wait till its ssh port closes and reopens, LastBootUpTime
+# changes and the Veeam services are running again
+#
+def wait_for_reboot(vcdata, veeam_serv, timeout):
+    mylogger = vcdata["mylogger"]
+    boot_time = get_last_boot_time(vcdata, veeam_serv)
+
+    cmd = "shutdown -r -t 5"
+    try:
+        conn = get_connection(vcdata, veeam_serv)
+        rc = run_command(cmd, conn, mylogger, timeout)
+        if(rc != 0):
+            mylogger.warning(f"Error: unable to reboot Veeam Backup & Replication server {veeam_serv}")
+    except Exception as exp:
+        mylogger.warning(f"Unable to establish connection to Veeam backup server {veeam_serv}. Exception details: {exp}")
+        rc = 1 
+    finally:
+        drop_connection(vcdata, veeam_serv)    # the transport does not survive the reboot
+        if(rc != 0): return rc
+
+    # a quick reboot may be missed here. The LastBootUpTime check below decides.
+    wait_until(mylogger, f"server {veeam_serv} to go down", lambda: not ssh_port_open(veeam_serv), reboot_down_timeout, max_interval=5)
+
+    rc = wait_until(mylogger, f"server {veeam_serv} ssh port to reopen", lambda: ssh_port_open(veeam_serv), reboot_up_timeout)
+    if(rc != 0): return rc
+
+    if boot_time is not None:
+        rc = wait_until(mylogger, f"server {veeam_serv} LastBootUpTime to change",
+                        lambda: get_last_boot_time(vcdata, veeam_serv) not in (None, boot_time), reboot_up_timeout)
+        if(rc != 0): return rc
+
+    rc = wait_until(mylogger, f"Veeam services on server {veeam_serv}", lambda: veeam_services_running(vcdata, veeam_serv), services_ready_timeout)
+    if(rc == 0):
+        mylogger.info(f"Veeam Backup & Replication server {veeam_serv} is back after the reboot")
+    return rc
+
+
+# run commands through ssh to VBR server
+#
+def run_command(cmd, conn, mylogger, timeout=180, results = None):
+    with trace_span(None, "exec") as span:
+        span["rc"] = 1
+        try:
+            mylogger.debug("Running command: %s" % cmd)
+            res = conn.run(cmd, hide=True, timeout=timeout)
+
+            if(res.stderr):
+                mylogger.warning("Running command through ssh to Veeam backup server returned error: %s" % res.stderr)
+                note_failure("stderr", res.stderr)
+                return 1
+
+            if isinstance(results, list):
+                tmp_res = (res.stdout.rstrip()).split('\n')
+                for item in tmp_res:
+                    results.append(item)
+        except Exception as exp:
+            mylogger.warning("Running command through ssh to Veeam backup server caught an exception. Exception details:  %s" % exp)
+            note_failure("exception", exp)
+            return 1
+
+        span["rc"] = 0
+    return 0
+
+
+# detect the encoding of an installer log from its BOM. The powershell output log file
+# can be either utf-16 or utf-8 encoding. Return (encoding, offset of the first character).
+#
+def detect_log_encoding(fh):
+    fh.seek(0)
+    head = fh.read(4)
+    if head.startswith(b'\xff\xfe'):
+        return ("utf-16-le", 2)
+    if head.startswith(b'\xfe\xff'):
+        return ("utf-16-be", 2)
+    if head.startswith(b'\xef\xbb\xbf'):
+        return ("utf-8", 3)
+    if(len(head) >= 4 and head[0] != 0 and head[1] == 0 and head[3] == 0):    # utf-16 without BOM
+        return ("utf-16-le", 0)
+    return ("utf-8", 0)
+
+
+# find the last newline of buf that starts on a character boundary
+#
+def rfind_newline(buf, newline, unit):
+    end = len(buf)
+    while True:
+        idx = buf.rfind(newline, 0, end)
+        if(idx < 0 or idx % unit == 0):
+            return idx
+        end = idx + len(newline) - 1
+
+
+# yield the lines of an opened log file from the last one backwards. The file is read
+# in blocks of block_size bytes from its end, so memory use does not depend on the log size.
+#
+def reverse_log_lines(fh, encoding, data_start, block_size=log_block_size):
+    unit = 2 if encoding.startswith("utf-16") else 1
+    newline = "\n".encode(encoding)
+    block_size = block_size - block_size % unit
+
+    fh.seek(0, os.SEEK_END)
+    pos = fh.tell()
+    pos -= (pos - data_start) % unit    # ignore a truncated last character
+    buf = b''
+    while(pos > data_start):
+        read_size = min(block_size, pos - data_start)
+        pos -= read_size
+        fh.seek(pos)
+        buf = fh.read(read_size) + buf
+
+        idx = rfind_newline(buf, newline, unit)
+        while(idx >= 0):
+            yield buf[idx+unit:].decode(encoding, errors="replace")
+            buf = buf[:idx]
+            idx = rfind_newline(buf, newline, unit)
+
+    if buf:
+        yield buf.decode(encoding, errors="replace")
+
+
+# compiled patterns used to verify an installer log. Cached per success string.
+#
+@functools.lru_cache(maxsize=None)
+def get_log_patterns(success_str):
+    return {"success": re.compile(r'(%s)' % success_str, re.I),
+            "failure": [ re.compile(pattern, re.I) for pattern in log_failure_markers ],
+            "msi_return": re.compile(r'(?:MainEngineThread is returning|success or error status:)\s*(\d+)', re.I)}
+
+
+# search the last valid tail_lines lines of an installer log for success_str. Return the
+# structured result: rc (0 if success_str was found), the matched line, the failure
+# markers found in the tail and the MSI return value.
+#
+def verify_ps_log(ps_log, success_str, tail_lines=log_tail_lines):
+    patterns = get_log_patterns(success_str)
+    verdict = {"rc": 1, "matched_line": None, "failures": [], "msi_return": None, "lines": 0}
+
+    with open(ps_log, 'rb') as fh:
+        (encoding, data_start) = detect_log_encoding(fh)
+        for line in reverse_log_lines(fh, encoding, data_start):
+            line = line.strip()
+            if(line == ''): 
+                continue
+            verdict["lines"] += 1
+
+            if verdict["msi_return"] is None:
+                searchobj = patterns["msi_return"].search(line)
+                if(searchobj):
+                    verdict["msi_return"] = int(searchobj.group(1))
+
+            if any(pattern.search(line) for pattern in patterns["failure"]):
+                verdict["failures"].append(line)
+
+            if(verdict["matched_line"] is None and patterns["success"].search(line)):
+                verdict["matched_line"] = line
+                verdict["rc"] = 0
+
+            if(verdict["lines"] >= tail_lines):
+                break
+
+    return verdict
+
+
+# PowerShell counterpart of verify_ps_log(). Get-Content -Tail reads the log from its end
+# on the Veeam server, so only the verdict and the matched lines come back.
+#
+ps_log_verdict_function = r"""
+function Get-LogVerdict([string]$Path, [string]$Success, [string[]]$Failure, [int]$Tail) {
+    $verdict = [ordered]@{ rc = 1; matched_line = $null; failures = @(); msi_return = $null; lines = 0; size = 0 }
+    if (-not (Test-Path -LiteralPath $Path)) { return $verdict }
+    $verdict.size = (Get-Item -LiteralPath $Path).Length
+    $lines = @(Get-Content -LiteralPath $Path -Tail ($Tail * 10) | Where-Object { $_.Trim() -ne '' } | Select-Object -Last $Tail)
+    [array]::Reverse($lines)
+    $verdict.lines = $lines.Count
+    foreach ($line in $lines) {
+        $line = $line.Trim()
+        if (($verdict.msi_return -eq $null) -and ($line -match '(?:MainEngineThread is returning|success or error status:)\s*(\d+)')) { $verdict.msi_return = [int]$Matches[1] }
+        foreach ($pattern in $Failure) { if ($line -match $pattern) { $verdict.failures += $line; break } }
+        if (($verdict.matched_line -eq $null) -and ($line -match "($Success)")) { $verdict.matched_line = $line; $verdict.rc = 0 }
+    }
+    return $verdict
+}
+"""
+
+
+# quote a string as a PowerShell single-quoted literal
+#
+def ps_quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def ps_string_array(values):
+    return "@(" + ", ".join(ps_quote(value) for value in values) + ")"
+
+
+# PowerShell expression that evaluates an installer log with Get-LogVerdict. path_expr, a
+# PowerShell expression, replaces the literal path ps_log when given.
+#
+def render_log_verdict_call(ps_log, success_str, tail_lines=log_tail_lines, path_expr=None):
+    return (f"Get-LogVerdict -Path {path_expr or ps_quote(ps_log)} -Success {ps_quote(success_str)} "
+            f"-Failure {ps_string_array(log_failure_markers)} -Tail {tail_lines}")
+
+
+# verify an installer log on the Veeam server. ps_log is the Windows path, e.g. c:\temp\xxx.log
+# Return the same structured result as verify_ps_log().
+#
+def remote_verify_ps_log(vcdata, veeam_serv, ps_log, success_str):
+    mylogger = vcdata["mylogger"]
+    verdict = {"rc": 1, "matched_line": None, "failures": [], "msi_return": None, "lines": 0}
+
+    results = []
+    script = ps_log_verdict_function + render_log_verdict_call(ps_log, success_str) + " | ConvertTo-Json -Compress"
+    rc = run_powershell(vcdata, veeam_serv, script, results=results)
+    if(rc != 0):
+        mylogger.warning(f"Verifying PowerShell log file {ps_log} on server {veeam_serv} fails")
+        return verdict
+
+    try:
+        verdict.update(json.loads('\n'.join(results)))
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the verdict of PowerShell log file {ps_log} on server {veeam_serv}. Exception details: {exp}")
+        return verdict
+
+    if(verdict["lines"] == 0):
+        mylogger.warning(f"Powershell log file {ps_log} on server {veeam_serv} does not have any content")
+    elif(verdict["rc"] == 0):
+        mylogger.debug(f"Powershell log file {ps_log} on server {veeam_serv}: found \"{verdict['matched_line']}\"")
+    else:
+        mylogger.warning(f"Powershell log file {ps_log} on server {veeam_serv}: \"{success_str}\" not found in the last {verdict['lines']} lines. "
+                         f"MSI return value: {verdict['msi_return']}. Failure lines: {verdict['failures']}")
+    return verdict
+
+
+# download a full installer log for troubleshooting, optionally zipped on the Veeam server first
+#
+def fetch_ps_log(vcdata, veeam_serv, ps_log, local_ps_log, compress=False):
+    mylogger = vcdata["mylogger"]
+    if compress:
+        zip_log = ps_log + ".zip"
+        script = f"Compress-Archive -LiteralPath {ps_quote(ps_log)} -DestinationPath {ps_quote(zip_log)} -Force"
+        if(run_powershell(vcdata, veeam_serv, script) == 0):
+            (ps_log, local_ps_log) = (zip_log, local_ps_log + ".zip")
+        else:
+            mylogger.warning(f"Unable to compress PowerShell log file {ps_log} on server {veeam_serv}. Downloading it uncompressed.")
+
+    remote_path = sftp_path(ps_log)
+    try:
+        conn = get_connection(vcdata, veeam_serv)
+        with trace_span(vcdata, "get"):
+            conn.get(remote_path, local_ps_log)
+    except Exception as exp:
+        mylogger.warning(f"Downloading PowerShell log file {remote_path} to local machine as {local_ps_log} caught an exception. Exception details: {exp}")
+        drop_connection(vcdata, veeam_serv)
+        return 1
+
+    mylogger.warning(f"Full PowerShell log file of server {veeam_serv} saved as {local_ps_log}")
+    return 0
+
+
+# check the downloaded powershell log for success_str. Return the verify_ps_log() result.
+#
+def check_ps_log(vcdata, ps_log, success_str):
+    mylogger = vcdata["mylogger"]
+    try:
+        verdict = verify_ps_log(ps_log, success_str)
+    except (IOError, OSError) as exp:
+        mylogger.warning("Hit IOError while opening file %s. Exception details: %s" % (ps_log, exp) )
+        return {"rc": 1, "matched_line": None, "failures": [], "msi_return": None, "lines": 0}
+
+    if(verdict["lines"] == 0):
+        mylogger.warning("Powershell log file %s does not have any content" % ps_log)
+    elif(verdict["rc"] == 0):
+        mylogger.debug("Powershell log file %s: found \"%s\"" % (ps_log, verdict["matched_line"]) )
+    else:
+        mylogger.warning("Powershell log file %s: \"%s\" not found in the last %d lines. MSI return value: %s. Failure lines: %s"
+                         % (ps_log, success_str, verdict["lines"], verdict["msi_return"], verdict["failures"]) )
+    return verdict
+
+
+# remote file that holds the process id of the installer started by remote_script
+#
+def remote_pid_file(remote_script):
+    return ntpath.splitext(remote_script)[0] + ".pid"
+
+
+# create the remote directory of vcdata (the run directory, or the scratch directory of
+# verify mode) on a Veeam server
+#
+def make_remote_dir(vcdata, veeam_serv):
+    try:
+        sftp = get_connection(vcdata, veeam_serv).sftp()
+        path = ""
+        for part in vcdata["remote_dir"].split('\\'):
+            path = ntpath.join(path, part) if path else part + '\\'
+            try:
+                sftp.mkdir(sftp_path(path))
+            except IOError:    # the directory exists
+                pass
+        sftp.stat(sftp_path(vcdata["remote_dir"]))
+    except Exception as exp:
+        vcdata["mylogger"].warning(f"Creating directory {vcdata['remote_dir']} on server {veeam_serv} caught an exception. Exception details: {exp}")
+        drop_connection(vcdata, veeam_serv)
+        return 1
+    return 0
+
+
+# create the run directory on a Veeam server and remove the earlier runs' ones
+#
+def make_remote_run_dir(vcdata, veeam_serv):
+    if(make_remote_dir(vcdata, veeam_serv) != 0):
+        return 1
+    prune_remote_run_dirs(vcdata, veeam_serv)
+    return 0
+
+
+# remove the run directories of the earlier runs on a Veeam server that get_prunable_run_dirs
+# allows. Every run directory is listed with the rc of its run_finished_file, if any.
+#
+def prune_remote_run_dirs(vcdata, veeam_serv):
+    mylogger = vcdata["mylogger"]
+    results = []
+    script = (f"Get-ChildItem -LiteralPath {ps_quote(remote_base_dir)} -Directory | Where-Object {{ $_.Name -match {ps_quote(run_dir_pattern)} }} | "
+              f"ForEach-Object {{ $finished = Join-Path $_.FullName {ps_quote(run_finished_file)} \n"
+              f"  if (Test-Path -LiteralPath $finished) {{ \"$($_.Name) $((Get-Content -LiteralPath $finished -Raw).Trim())\" }} else {{ $_.Name }} }}")
+    if(run_powershell(vcdata, veeam_serv, script, results=results) != 0):
+        mylogger.debug(f"Unable to list the run directories of {remote_base_dir} on server {veeam_serv}")
+        return
+
+    runs = {}
+    for line in results:
+        parts = line.split(None, 1)
+        if(parts and re.match(run_dir_pattern, parts[0])):
+            runs[parts[0]] = parse_run_rc(parts[1] if len(parts) > 1 else None)
+    names = get_prunable_run_dirs(runs, vcdata["run_id"], get_keep_runs(vcdata))
+    if not names:
+        return
+    script = '\n'.join(f"Remove-Item -LiteralPath {ps_quote(ntpath.join(remote_base_dir, name))} -Recurse -Force -ErrorAction SilentlyContinue" for name in names)
+    if(run_powershell(vcdata, veeam_serv, script) != 0):
+        mylogger.debug(f"Unable to remove the earlier run directories of {remote_base_dir} on server {veeam_serv}")
+    else:
+        mylogger.debug(f"Removed run directories {', '.join(names)} of {remote_base_dir} on server {veeam_serv}")
+
+
+# record in the run directory of a Veeam server that the run is done with it
+#
+def mark_remote_run_finished(vcdata, veeam_serv, rc):
+    try:
+        get_connection(vcdata, veeam_serv).put(io.BytesIO(f"{rc}\n".encode("utf-8")), sftp_path(remote_run_path(vcdata, run_finished_file)))
+    except Exception as exp:
+        vcdata["mylogger"].debug(f"Unable to mark run directory {vcdata['remote_dir']} on server {veeam_serv} finished. Exception details: {exp}")
+
+
+# upload a rendered script from memory to remote_script on a Veeam server
+#
+def put_script(vcdata, veeam_serv, script, remote_script):
+    try:
+        conn = get_connection(vcdata, veeam_serv)
+        with trace_span(vcdata, "put"):
+            conn.put(io.BytesIO(script.encode("utf-8")), sftp_path(remote_script))
+    except Exception as exp:
+        vcdata["mylogger"].warning(f"Uploading PowerShell {remote_script} to server {veeam_serv} caught an exception. Exception details: {exp}")
+        note_failure("exception", exp)
+        drop_connection(vcdata, veeam_serv)
+        return 1
+    return 0
+
+
+# PowerShell lines that start program with the arguments $params, record its process id in
+# pid_file and wait for it to exit. The arguments are PowerShell expressions. The log of an
+# earlier run is removed first, so that the log monitor only reads the lines of this run.
+#
+def render_start_process(program, log, pid_file, indent=""):
+    lines = [f"Remove-Item -LiteralPath {log} -Force -ErrorAction SilentlyContinue",
+             f"$process = Start-Process {program} -ArgumentList $params -WindowStyle Hidden -PassThru",
+             "$null = $process.Handle",    # keeps the exit code readable after WaitForExit()
+             f"Set-Content -LiteralPath {pid_file} -Value $process.Id",
+             "$process.WaitForExit()"]
+    return ''.join(f"{indent}{line} \n" for line in lines)
+
+
+# read the lines appended to a remote installer log since the last call. state holds the
+# read offset, the incremental decoder and the unfinished last line of the log.
+#
+def read_log_increment(sftp, log, state):
+    remote_path = sftp_path(log)
+    size = sftp.stat(remote_path).st_size
+    if(size < state["offset"]):    # the installer created a new log
+        state.update({"offset": 0, "decoder": None, "partial": ""})
+    if(size - state["offset"] < (4 if state["decoder"] is None else 1)):
+        return []
+
+    with sftp.open(remote_path, 'rb') as fh:
+        fh.seek(state["offset"])
+        data = fh.read(min(size - state["offset"], log_read_limit))
+
+    if state["decoder"] is None:
+        (encoding, data_start) = detect_log_encoding(io.BytesIO(data))
+        state["decoder"] = codecs.getincrementaldecoder(encoding)(errors="replace")
+        state["offset"] += data_start
+        data = data[data_start:]
+
+    state["offset"] += len(data)
+    lines = (state["partial"] + state["decoder"].decode(data)).split('\n')
+    state["partial"] = lines.pop()
+    return [ line.strip() for line in lines if line.strip() ]
+
+
+# wait up to timeout seconds for thread to end. Return True if it ended.
+#
+def wait_for_thread(thread, timeout):
+    deadline = time.time() + timeout
+    while(thread.is_alive() and time.time() < deadline):
+        time.sleep(min(0.5, max(deadline - time.time(), 0)))
+    return not thread.is_alive()
+
+
+# tail the logs of a running installer until the worker thread running it ends. Report the
+# progress and return (reason, longest log gap in seconds). reason tells why the installer
+# should be aborted: a failure marker in a log, or no log growth for stall_window seconds.
+# It is None if the installer ended by itself.
+#
+def monitor_installer_logs(vcdata, veeam_serv, conn, worker, logs, stall_window):
+    mylogger = vcdata["mylogger"]
+    failure_patterns = get_log_patterns(msi_success_str)["failure"]
+    action_pattern = re.compile(r'(?:Action start \d+:\d+:\d+: |Doing action: )(\S+?)\.?$')
+    states = { log: {"offset": 0, "decoder": None, "partial": "", "lines": 0, "action": None} for log in logs }
+    active = logs[0]
+    last_growth = last_progress = time.time()
+    max_gap = 0.0
+
+    mylogger.debug(f"Monitoring installer log {', '.join(logs)} on server {veeam_serv}")
+    while not wait_for_thread(worker, log_monitor_interval):
+        try:
+            sftp = conn.sftp()
+        except Exception as exp:
+            mylogger.debug(f"Opening sftp session to server {veeam_serv} caught an exception. Exception details: {exp}")
+            sftp = None
+
+        for log in logs:
+            state = states[log]
+            try:
+                lines = read_log_increment(sftp, log, state) if sftp else []
+            except Exception as exp:    # the installer did not create the log yet
+                mylogger.debug(f"Reading installer log {log} on server {veeam_serv} caught an exception. Exception details: {exp}")
+                continue
+
+            if lines:
+                max_gap = max(max_gap, time.time() - last_growth)
+                (active, last_growth) = (log, time.time())
+            for line in lines:
+                state["lines"] += 1
+                searchobj = action_pattern.search(line)
+                if searchobj:
+                    state["action"] = searchobj.group(1)
+                if any(pattern.search(line) for pattern in failure_patterns):
+                    return (f"installer log {log} reports \"{line}\"", max_gap)
+
+        if(time.time() - last_growth > stall_window):
+            return (f"installer log {active} did not grow for {stall_window} seconds", max_gap)
+        if(time.time() - last_progress >= log_progress_interval):
+            state = states[active]
+            mylogger.info(f"Installer log {active} on server {veeam_serv}: {state['lines']} lines, {state['offset']} bytes, "
+                          f"current action: {state['action']}")
+            last_progress = time.time()
+
+    return (None, max_gap)
+
+
+# kill the installer process recorded in pid_file, with all its child processes
+#
+def kill_installer(vcdata, veeam_serv, pid_file):
+    script = (f"$id = Get-Content -LiteralPath {ps_quote(pid_file)} -ErrorAction SilentlyContinue \n"
+              "if ($id) { taskkill.exe /PID $id /T /F 2>&1 | Out-Null } \n"
+              "$id")
+    return run_powershell(vcdata, veeam_serv, script)
+
+
+# run an installer command like run_command() while tailing its logs. A failing or stalled
+# installer is killed through its pid file instead of being waited for till it ends. The
+# longest log gap is kept in the enclosing span for the run history.
+#
+def run_monitored_command(vcdata, veeam_serv, cmd, conn, timeout, results, logs, pid_file, stall_window=None):
+    mylogger = vcdata["mylogger"]
+    options = vcdata.get("options", {})
+    if not options.get("log_monitor", default_log_monitor):
+        return run_command(cmd, conn, mylogger, timeout, results)
+
+    # an installer command replaces a log only when its installer starts. The log of an earlier
+    # attempt, e.g. of a batch package that has not started yet, would show its old failure
+    # lines to the monitor, so all the logs are removed before the command runs.
+    script = ''.join(f"Remove-Item -LiteralPath {ps_quote(log)} -Force -ErrorAction SilentlyContinue \n" for log in logs)
+    if(run_powershell(vcdata, veeam_serv, script) != 0):
+        mylogger.warning(f"Unable to remove the installer log {', '.join(logs)} of an earlier attempt on server {veeam_serv}")
+        return 1
+
+    outcome = {"rc": 1}
+    context = contextvars.copy_context()
+    worker = threading.Thread(target=lambda: outcome.update(rc=context.run(run_command, cmd, conn, mylogger, timeout, results)),
+                              name=f"{threading.current_thread().name}-exec", daemon=True)
+    worker.start()
+
+    stall_window = stall_window or int(options.get("stall_window", default_stall_window))
+    (reason, max_gap) = monitor_installer_logs(vcdata, veeam_serv, conn, worker, logs, stall_window)
+    span = trace_context.get()
+    if span is not None:
+        span["log_gap"] = round(max(span.get("log_gap", 0.0), max_gap), 1)
+    if reason:
+        mylogger.warning(f"Abort the installer on server {veeam_serv}: {reason}")
+        note_failure("abort", reason)
+        with trace_span(vcdata, "abort", reason=reason) as span:
+            span["rc"] = kill_installer(vcdata, veeam_serv, pid_file)
+        if not wait_for_thread(worker, installer_kill_grace):
+            mylogger.warning(f"Installer command on server {veeam_serv} did not return after the installer was killed. Close its connection")
+            drop_connection(vcdata, veeam_serv)
+    worker.join()
+
+    return 1 if reason else outcome["rc"]
+
+
+# run Veeam installation powershell in the remote Veeam server
+#
+def run_veeam_install_ps(vcdata, veeam_serv, script, remote_script, ps_log, timeout, success_str, stall_window=None):
+    mylogger = vcdata["mylogger"]
+    options = vcdata.get("options", {})
+    win_ps_log = ps_log
+    ps_log = sftp_path(ps_log)
+    path, log_fname = os.path.split(ps_log)
+    local_ps_log = local_run_path(vcdata, veeam_serv, log_fname)
+
+    mylogger.info(f"Start running PowerShell file {remote_script} on server {veeam_serv}")
+    if(put_script(vcdata, veeam_serv, script, remote_script) != 0):
+        return 1
+    conn = get_connection(vcdata, veeam_serv)
+
+    results = []
+    cmd = f"powershell -File {remote_script}"
+
+    rc = run_monitored_command(vcdata, veeam_serv, cmd, conn, timeout, results, [win_ps_log], remote_pid_file(remote_script), stall_window)
+
+    res = '\n'.join(results)
+    if(rc != 0):
+        mylogger.warning(f"Error: running PowerShell {remote_script} on server {veeam_serv} fails")
+        return rc
+
+    # wait till the powershell log file is created and written
+    wait_until(mylogger, f"log file {ps_log} on server {veeam_serv}", lambda: remote_file_ready(conn, ps_log), log_wait_timeout)
+
+    # check the PowerShell log for success_str
+    if(options.get("log_verify", default_log_verify) == "remote"):
+        with trace_span(vcdata, "verify"):
+            verdict = remote_verify_ps_log(vcdata, veeam_serv, win_ps_log, success_str)
+        if((res != "0" or verdict["rc"] != 0) and not is_reboot_required(res, verdict)):
+            fetch_ps_log(vcdata, veeam_serv, win_ps_log, local_ps_log, options.get("compress_failed_logs", True))
+    else:
+        try:
+            with trace_span(vcdata, "get"):
+                conn.get(ps_log, local_ps_log)
+        except Exception as exp:
+            mylogger.warning(f"Downloading PowerShell log file {ps_log} to local machine as {local_ps_log} caught an exception. Exception details: {exp}")
+            note_failure("exception", exp)
+            drop_connection(vcdata, veeam_serv)
+            return 1
+
+        with trace_span(vcdata, "verify"):
+            verdict = check_ps_log(vcdata, local_ps_log, success_str)
+ 
+    if(res == "0" and verdict["rc"] == 0 ):
+        mylogger.info(f"Success: running PowerShell {remote_script} on server {veeam_serv} succeeds")
+        rc = 0
+    elif is_reboot_required(res, verdict):
+        mylogger.info(f"Success: running PowerShell {remote_script} on server {veeam_serv} succeeds. Exit code {res}: a reboot is required")
+        note_failure("reboot_required", int(res))
+        rc = 0
+    else:
+        mylogger.warning(f"Error: running PowerShell {remote_script} on server {veeam_serv} fails")
+        note_failure("exit_code", res)
+        note_failure("log", verdict)
+        rc = 1
+
+    return rc
+
+
+# placeholder values for the arguments of the install plan steps
+#
+def get_install_context():
+    return {"vbr_service_user": f"{veeam_serv_hostname}\\{veeam_serv_user}",    # veeam-serv1\Administrator
+            "veeam_serv_pw": veeam_serv_pw,
+            "vbr_sqlserv": f"{veeam_serv_hostname}\\{veeam_serv_sqlinst}",        # veeam-serv1\veeamsql2016
+            "veeam_licensefile": "c:\\veeam_soft\\veeam_license.lic"}
+
+
+# render the PowerShell script that runs the installer of an "msi" or "exe" step and returns its exit code.
+# The step's "log" and "script" are the paths in the run directory.
+#
+def render_install_script(step):
+    context = dict(get_install_context(), log=step["log"])
+    params = [ arg.format_map(context) for arg in step["args"] ]
+    if(step["kind"] == "msi"):
+        program = "msiexec.exe"
+        params = ['/qn', '/i', step["installer"]] + params + ['/L*V', step["log"]]
+    else:
+        program = step["installer"]
+
+    return (f"$params = {', '.join(ps_quote(param) for param in params)} \n"
+            + render_start_process(ps_quote(program), ps_quote(step["log"]), ps_quote(remote_pid_file(step["script"]))) +
+            "$process.ExitCode")
+
+
+# install the component of an "msi" or "exe" install plan step
+#
+def install_step(vcdata, veeam_serv, step):
+    mylogger = vcdata["mylogger"]
+    step = dict(step, log=remote_run_path(vcdata, step["log"]), script=remote_run_path(vcdata, step["ps_file"]))
+
+    mylogger.info('-'*15 + "Start installing %s on server %s" % (step["description"], veeam_serv) + '-'*15)
+
+    rc = run_veeam_install_ps(vcdata, veeam_serv, render_install_script(step), step["script"], step["log"], step["timeout"], step["success"],
+                              step.get("stall_window"))
+    if(rc == 0):
+        mylogger.info("Successfully install %s on server %s" % (step["description"], veeam_serv) )
+    else:
+        mylogger.warning("Error installing %s on server %s" % (step["description"], veeam_serv) )
+    
+    return rc
+
+
+# install several msi packages with one PowerShell driver: one upload, one run and one
+# JSON report with the exit code and log verdict of every package. The packages are
+# installed in order; the ones after the first failure are skipped. The driver times out
+# after timeout seconds, by default the sum of the package timeouts.
+#
+def install_service_pkgs_batch(vcdata, veeam_serv, pkgs, timeout=None, stall_window=None):
+    mylogger = vcdata["mylogger"]
+    remote_script = remote_run_path(vcdata, "veeam_servicepkgs_install.ps1")
+    pkgs = [ dict(pkg, log=remote_run_path(vcdata, pkg["log"])) for pkg in pkgs ]
+    ps_timeout = timeout or sum(pkg["timeout"] for pkg in pkgs)
+    services = ', '.join(pkg["service"] for pkg in pkgs)
+
+    mylogger.info('-'*15 + "Start installing %s on server %s" % (services, veeam_serv) + '-'*15)
+
+    pkg_entries = [ f"    @{{ service = {ps_quote(pkg['service'])}; msi = {ps_quote(pkg['msi'])}; log = {ps_quote(pkg['log'])}; success = {ps_quote(pkg['success'])} }}"
+                    for pkg in pkgs ]
+    cmd = ("$ProgressPreference = 'SilentlyContinue' \n"
+           + ps_log_verdict_function +
+           "$packages = @(\n" + ",\n".join(pkg_entries) + ")\n"
+           f"$failure = {ps_string_array(log_failure_markers)} \n"
+           "$report = @() \n"
+           "$failed = $false \n"
+           "foreach ($pkg in $packages) { \n"
+           "    $result = [ordered]@{ service = $pkg.service; exit_code = $null; verdict = $null; reboot = $false; skipped = $failed } \n"
+           "    if (-not $failed) { \n"
+           "        $params = '/qn', '/i', $pkg.msi, 'ACCEPTEULA=\"1\"', 'ACCEPT_THIRDPARTY_LICENSES=\"1\"', '/L*V', $pkg.log \n"
+           + render_start_process("'msiexec.exe'", "$pkg.log", ps_quote(remote_pid_file(remote_script)), indent=" "*8) +
+           "        $result.exit_code = $process.ExitCode \n"
+           f"        $result.verdict = Get-LogVerdict -Path $pkg.log -Success $pkg.success -Failure $failure -Tail {log_tail_lines} \n"
+           f"        $result.reboot = (@({', '.join(str(code) for code in sorted(reboot_exit_codes))}) -contains $result.exit_code) -and "
+           "($result.verdict.lines -gt 0) -and (@($result.verdict.failures).Count -eq 0) \n"
+           "        if ((($result.exit_code -ne 0) -or ($result.verdict.rc -ne 0)) -and -not $result.reboot) { $failed = $true } \n"
+           "    } \n"
+           "    $report += $result \n"
+           "} \n"
+           "ConvertTo-Json -InputObject $report -Depth 4 -Compress")
+
+    if(put_script(vcdata, veeam_serv, cmd, remote_script) != 0):
+        return 1
+    conn = get_connection(vcdata, veeam_serv)
+
+    results = []
+    rc = run_monitored_command(vcdata, veeam_serv, f"powershell -File {remote_script}", conn, ps_timeout, results,
+                               [ pkg["log"] for pkg in pkgs ], remote_pid_file(remote_script), stall_window)
+    if(rc != 0):
+        mylogger.warning(f"Error: running PowerShell {remote_script} on server {veeam_serv} fails")
+        return rc
+
+    try:
+        report = json.loads('\n'.join(results))
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the report of PowerShell {remote_script} on server {veeam_serv}. Exception details: {exp}")
+        return 1
+    if(not isinstance(report, list) or len(report) != len(pkgs)):
+        mylogger.warning(f"Unexpected report of PowerShell {remote_script} on server {veeam_serv}: {report}")
+        return 1
+
+    rc = 0
+    for (pkg, result) in zip(pkgs, report):
+        verdict = result["verdict"]
+        if result["skipped"]:
+            mylogger.warning("Skip installing %s on server %s after the previous failure" % (pkg["service"], veeam_serv) )
+            rc = 1
+        elif(result["exit_code"] == 0 and verdict["rc"] == 0):
+            mylogger.info("Successfully install %s on server %s" % (pkg["service"], veeam_serv) )
+        elif is_reboot_required(result["exit_code"], verdict):
+            mylogger.info("Successfully install %s on server %s. Exit code %s: a reboot is required" % (pkg["service"], veeam_serv, result["exit_code"]) )
+            note_failure("reboot_required", result["exit_code"])
+        else:
+            mylogger.warning("Error installing %s on server %s. Exit code: %s. MSI return value: %s. Failure lines: %s"
+                             % (pkg["service"], veeam_serv, result["exit_code"], verdict["msi_return"], verdict["failures"]) )
+            note_failure("exit_code", result["exit_code"])
+            note_failure("log", verdict)
+            path, log_fname = ntpath.split(pkg["log"])
+            fetch_ps_log(vcdata, veeam_serv, pkg["log"], local_run_path(vcdata, veeam_serv, log_fname), vcdata.get("options", {}).get("compress_failed_logs", True))
+            rc = 1
+
+    return rc
+
+
+# For Veeam server, after installing patch, update the server components. After that, create a new registry value
+#
+def update_server_component(vcdata, veeam_serv, step):
+    mylogger = vcdata["mylogger"]
+    remote_script = remote_run_path(vcdata, step["ps_file"])
+    ps_timeout = step["timeout"]
+
+    mylogger.info('-'*10 + "Start updating Veeam Backup & Replication server components" + '-'*10)
+
+    # reboot the VBR server for its Veeam powershell components to fully work
+    rc = reboot_veeam_server(vcdata, veeam_serv)
+    if(rc != 0):
+        mylogger.warning(f"Error: Veeam Backup & Replication server {veeam_serv} is not ready after the reboot")
+        note_failure("timeout", "the server is not ready after the reboot")
+        return rc
+
+    cmd = ("$ProgressPreference = \"SilentlyContinue\" \n"
+           "Update-VBRServerComponent \n"
+           f"New-ItemProperty -Path \"HKLM:\\SOFTWARE\\Veeam\\Veeam Backup and Replication\" -Name MaxSnapshotsPerDatastore -Value {veeam_maxsnapshots_value} -PropertyType DWord")
+
+    if(put_script(vcdata, veeam_serv, cmd, remote_script) != 0):
+        return 1
+    conn = get_connection(vcdata, veeam_serv)
+
+    results = []
+    cmd = f"powershell -File {remote_script}"
+
+    rc = run_command(cmd, conn, mylogger, ps_timeout, results)
+
+    res = '\n'.join(results)
+    if(rc != 0):
+        mylogger.warning(f"Error: running PowerShell {remote_script} on server {veeam_serv} fails")
+        return rc
+    else: 
+        mylogger.info(f"Successfully update Veeam Backup & Replication server components for {veeam_serv}")
+        mylogger.info(f"Successfully update Veeam Backup & Replication server {veeam_serv} registry.")
+        return 0
+
+
+# SHA-256 of a local file
+#
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# build the manifest of the installer media: one entry per file of media_dir with its path
+# relative to media_dir, size and SHA-256. Hashes of files whose size and mtime did not change
+# are taken from the manifest file of the previous run, which is then rewritten.
+#
+def build_media_manifest(media_dir, mylogger):
+    manifest_path = os.path.join(media_dir, media_manifest_file)
+    cached = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as fh:
+                cached = { entry["path"]: entry for entry in json.load(fh)["files"] }
+        except (IOError, OSError, ValueError, KeyError, TypeError) as exp:
+            mylogger.warning(f"Unable to read media manifest {manifest_path}. Exception details: {exp}")
+
+    files = []
+    hashed = 0
+    for (root, dirs, fnames) in os.walk(media_dir):
+        dirs.sort()
+        for fname in sorted(fnames):
+            local = os.path.join(root, fname)
+            rel = os.path.relpath(local, media_dir).replace(os.sep, '/')
+            if(rel == media_manifest_file):
+                continue
+            stat = os.stat(local)
+            entry = cached.get(rel)
+            if(entry is None or entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns):
+                entry = {"path": rel, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": hash_file(local)}
+                hashed += 1
+            files.append(entry)
+    mylogger.info(f"Media manifest of {media_dir}: {len(files)} file(s), {hashed} hashed, {len(files) - hashed} from the cache")
+
+    tmp_file = f"{manifest_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w') as fh:
+            json.dump({"files": files}, fh, indent=1)
+        os.replace(tmp_file, manifest_path)
+    except (IOError, OSError) as exp:
+        mylogger.warning(f"Unable to write media manifest {manifest_path}. Exception details: {exp}")
+    return files
+
+
+# the media manifest of the run, built once and shared by all servers
+#
+def get_media_manifest(vcdata):
+    media = vcdata.setdefault("media", {"lock": threading.Lock(), "manifest": None})
+    with media["lock"]:
+        if media["manifest"] is None:
+            media["manifest"] = build_media_manifest(vcdata["options"]["media_dir"], vcdata["mylogger"])
+    return media["manifest"]
+
+
+def media_remote_path(entry):
+    return ntpath.join(media_remote_dir, *entry["path"].split('/'))
+
+
+# probe the media on a Veeam server in one round trip: the SHA-256 of every file that has the
+# manifest size, and the size of the partial uploads in the staging directory
+#
+def render_media_probe(manifest, staging):
+    request = {"staging": staging, "files": [ {"path": media_remote_path(entry), "size": entry["size"]} for entry in manifest ],
+               "blobs": sorted({ entry["sha256"] for entry in manifest })}
+    return (f"$request = ConvertFrom-Json {ps_quote(json.dumps(request))} \n"
+            "$report = [ordered]@{ files = @{}; partials = @{} } \n"
+            "foreach ($file in $request.files) { \n"
+            "    $item = Get-Item -LiteralPath $file.path -ErrorAction SilentlyContinue \n"
+            "    if ($item -and ($item.Length -eq $file.size)) { $report.files[$file.path] = (Get-FileHash -LiteralPath $file.path -Algorithm SHA256).Hash.ToLower() } \n"
+            "} \n"
+            "foreach ($sha in $request.blobs) { \n"
+            "    $partial = Join-Path $request.staging \"$sha.partial\" \n"
+            "    if (Test-Path -LiteralPath $partial) { $report.partials[$sha] = (Get-Item -LiteralPath $partial).Length } \n"
+            "} \n"
+            "New-Item -ItemType Directory -Force -Path $request.staging | Out-Null \n"
+            "ConvertTo-Json -InputObject $report -Compress")
+
+
+# verify the uploaded blobs on a Veeam server and copy each good one to the media files that
+# have its content. Bad blobs are removed. Report the SHA-256 found per blob.
+#
+def render_media_place(blobs, staging):
+    request = {"staging": staging, "blobs": [ {"sha": sha, "targets": targets} for (sha, targets) in sorted(blobs.items()) ]}
+    return (f"$request = ConvertFrom-Json {ps_quote(json.dumps(request))} \n"
+            "$report = @{} \n"
+            "foreach ($blob in $request.blobs) { \n"
+            "    $partial = Join-Path $request.staging \"$($blob.sha).partial\" \n"
+            "    $hash = (Get-FileHash -LiteralPath $partial -Algorithm SHA256).Hash.ToLower() \n"
+            "    $report[$blob.sha] = $hash \n"
+            "    if ($hash -ne $blob.sha) { Remove-Item -LiteralPath $partial -Force; continue } \n"
+            "    foreach ($target in $blob.targets) { \n"
+            "        New-Item -ItemType Directory -Force -Path (Split-Path -Parent $target) | Out-Null \n"
+            "        Copy-Item -LiteralPath $partial -Destination $target -Force \n"
+            "    } \n"
+            "    Remove-Item -LiteralPath $partial -Force \n"
+            "} \n"
+            "ConvertTo-Json -InputObject $report -Compress")
+
+
+# journal of the chunks of a blob already uploaded to a Veeam server
+#
+def media_journal_path(veeam_serv, sha):
+    path = os.path.join(media_journal_dir, veeam_serv)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, f"{sha}.json")
+
+
+def load_media_journal(journal):
+    try:
+        with open(journal, 'r') as fh:
+            return set(json.load(fh)["chunks"])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return set()
+
+
+def save_media_journal(journal, chunks):
+    tmp_file = f"{journal}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w') as fh:
+        json.dump({"chunks": sorted(chunks)}, fh)
+    os.replace(tmp_file, journal)
+
+
+def remove_media_journal(veeam_serv, sha):
+    journal = media_journal_path(veeam_serv, sha)
+    if os.path.exists(journal):
+        os.remove(journal)
+
+
+# upload one blob to <staging>\<sha>.partial in chunks over parallel sftp streams. Chunks
+# recorded in the journal by an interrupted upload of the same partial file are not sent again.
+#
+def upload_media_blob(vcdata, veeam_serv, local, size, sha, partial, partial_size, streams):
+    mylogger = vcdata["mylogger"]
+    journal = media_journal_path(veeam_serv, sha)
+    conn = get_connection(vcdata, veeam_serv)
+    remote_path = sftp_path(partial)
+
+    done = load_media_journal(journal) if(partial_size == size) else set()
+    if(partial_size != size):
+        with conn.sftp().open(remote_path, 'wb') as fh:
+            fh.truncate(size)
+    chunks = [ index for index in range(max(1, -(-size // media_chunk_size))) if index not in done ]
+    if done:
+        mylogger.info(f"Resume uploading {local} to server {veeam_serv}: {len(done)} chunk(s) already sent, {len(chunks)} to go")
+
+    journal_lock = threading.Lock()
+
+    def send_chunks(indexes):
+        sftp = conn.client.open_sftp()
+        try:
+            with open(local, 'rb') as src, sftp.open(remote_path, 'r+b') as dst:
+                dst.set_pipelined(True)
+                for index in indexes:
+                    src.seek(index * media_chunk_size)
+                    dst.seek(index * media_chunk_size)
+                    dst.write(src.read(media_chunk_size))
+                    dst.flush()    # a chunk lost after being journaled fails the SHA-256 verification
+                    with journal_lock:
+                        done.add(index)
+                        save_media_journal(journal, done)
+        finally:
+            sftp.close()
+
+    streams = max(1, min(streams, len(chunks)))
+    with trace_span(vcdata, "put", file=local, bytes=size, chunks=len(chunks), streams=streams):
+        with ThreadPoolExecutor(max_workers=streams, thread_name_prefix=f"{threading.current_thread().name}-media") as executor:
+            for future in [ executor.submit(contextvars.copy_context().run, send_chunks, chunks[i::streams]) for i in range(streams) ]:
+                future.result()
+
+
+# stage the installer media of install_options media_dir on a Veeam server: probe the files
+# already there, upload the content that is missing or changed once per distinct SHA-256 and
+# put every file in place after verifying it
+#
+def stage_media(vcdata, veeam_serv, step):
+    mylogger = vcdata["mylogger"]
+    streams = int(vcdata["options"].get("media_streams", default_media_streams))
+    staging = ntpath.join(media_remote_dir, ".staging")
+
+    mylogger.info('-'*15 + "Start staging %s on server %s" % (step["description"], veeam_serv) + '-'*15)
+    manifest = get_media_manifest(vcdata)
+
+    results = []
+    with trace_span(vcdata, "probe"):
+        rc = run_powershell(vcdata, veeam_serv, render_media_probe(manifest, staging), timeout=step["timeout"], results=results)
+    try:
+        probe = json.loads('\n'.join(results)) if(rc == 0) else None
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the media probe of server {veeam_serv}. Exception details: {exp}")
+        probe = None
+    if probe is None:
+        mylogger.warning(f"Error probing the installer media on server {veeam_serv}")
+        return 1
+
+    blobs = {}
+    for entry in manifest:
+        if(probe["files"].get(media_remote_path(entry)) != entry["sha256"]):
+            blobs.setdefault(entry["sha256"], []).append(entry)
+    if not blobs:
+        mylogger.info(f"Installer media on server {veeam_serv} are up to date ({len(manifest)} file(s))")
+        return 0
+
+    total = sum(entries[0]["size"] for entries in blobs.values())
+    mylogger.info(f"Uploading {len(blobs)} distinct file(s), {total} bytes, of the installer media to server {veeam_serv}")
+    for (sha, entries) in blobs.items():
+        local = os.path.join(vcdata["options"]["media_dir"], *entries[0]["path"].split('/'))
+        try:
+            upload_media_blob(vcdata, veeam_serv, local, entries[0]["size"], sha, ntpath.join(staging, f"{sha}.partial"),
+                              probe["partials"].get(sha), streams)
+        except Exception as exp:
+            mylogger.warning(f"Uploading {local} to server {veeam_serv} caught an exception. Exception details: {exp}")
+            drop_connection(vcdata, veeam_serv)
+            return 1
+
+    results = []
+    with trace_span(vcdata, "verify"):
+        rc = run_powershell(vcdata, veeam_serv, render_media_place({ sha: [ media_remote_path(entry) for entry in entries ] for (sha, entries) in blobs.items() }, staging),
+                            timeout=step["timeout"], results=results)
+    try:
+        placed = json.loads('\n'.join(results)) if(rc == 0) else {}
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the media verification of server {veeam_serv}. Exception details: {exp}")
+        placed = {}
+
+    rc = 0
+    for (sha, entries) in blobs.items():
+        if(placed.get(sha) == sha):
+            remove_media_journal(veeam_serv, sha)
+        else:
+            mylogger.warning(f"Installer media {', '.join(entry['path'] for entry in entries)} on server {veeam_serv} failed verification: "
+                             f"SHA-256 {placed.get(sha)} instead of {sha}")
+            if(sha in placed):    # the partial upload was removed
+                remove_media_journal(veeam_serv, sha)
+            rc = 1
+    if(rc == 0):
+        mylogger.info(f"Successfully staged the installer media on server {veeam_serv}")
+    return rc
+
+
+# load the checkpoint store: the state file keeps, per VM name, the ip address and the
+# install plan steps completed on it
+#
+def init_checkpoint_store(vcdata, state_file):
+    servers = {}
+    if os.path.exists(state_file):
+        try:
+            with open(state_file, 'r') as fh:
+                servers = json.load(fh).get("servers", {})
+        except (IOError, OSError, ValueError) as exp:
+            vcdata["mylogger"].warning(f"Unable to read state file {state_file}. Exception details: {exp}")
+    vcdata["checkpoint"] = {"path": state_file, "lock": threading.Lock(), "servers": servers}
+
+
+# write the state file. The new content replaces the old file atomically.
+#
+def save_checkpoints(vcdata):
+    store = vcdata["checkpoint"]
+    tmp_file = f"{store['path']}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w') as fh:
+            json.dump({"servers": store["servers"]}, fh, indent=2, sort_keys=True)
+        os.replace(tmp_file, store["path"])
+    except (IOError, OSError) as exp:
+        vcdata["mylogger"].warning(f"Unable to write state file {store['path']}. Exception details: {exp}")
+
+
+def checkpoint_key(server):
+    return server.get("vm_name") or server["vm_ip"]
+
+
+# add a Veeam server to the checkpoint store. A freshly deployed VM starts without completed steps.
+#
+def register_checkpoint_server(vcdata, server, fresh):
+    store = vcdata["checkpoint"]
+    with store["lock"]:
+        entry = store["servers"].get(checkpoint_key(server))
+        if(fresh or entry is None):
+            entry = {"steps": {}, "complete": False}
+        entry.update({"vm_name": server.get("vm_name"), "vm_ip": server["vm_ip"], "esx": server.get("esx"), "datastore": server.get("datastore")})
+        store["servers"][checkpoint_key(server)] = entry
+        save_checkpoints(vcdata)
+
+
+# record that an install plan step is done on a Veeam server. how is "installed" or "detected".
+#
+def record_checkpoint(vcdata, server, step_name, how="installed"):
+    store = vcdata["checkpoint"]
+    with store["lock"]:
+        entry = store["servers"].setdefault(checkpoint_key(server), {"steps": {}, "complete": False})
+        entry["steps"][step_name] = {"status": how, "time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}
+        save_checkpoints(vcdata)
+
+
+def mark_checkpoint_complete(vcdata, server, golden=False):
+    store = vcdata["checkpoint"]
+    with store["lock"]:
+        store["servers"][checkpoint_key(server)].update({"complete": True, "golden": golden})
+        save_checkpoints(vcdata)
+
+
+def get_checkpoint_steps(vcdata, server):
+    store = vcdata["checkpoint"]
+    with store["lock"]:
+        entry = store["servers"].get(checkpoint_key(server), {})
+        return set(entry.get("steps", {}))
+
+
+# the ESX host and datastore of a Veeam server VM: from its deployment, or from the state file
+# of a resumed run. vm_operation does not report them in general; they fall back to the
+# "veeam_install" entries: the entry a deployed VM came from (vm_operation deploys the entries
+# and their vm_count VMs in order), or the placement all the entries share.
+#
+def get_server_placement(vcdata, server, entries=()):
+    placement = {"esx": None, "datastore": None}
+    names = [ vm.get("vm_name") for vm in vcdata.get("deployed_vm") or [] ]
+    if server.get("vm_name") in names:
+        index = names.index(server.get("vm_name"))
+        placement = { key: vcdata["deployed_vm"][index].get(key) for key in placement }
+        entry = get_entry_of_vm(entries, index)
+    else:
+        checkpoint = vcdata["checkpoint"]["servers"].get(checkpoint_key(server), {})
+        placement = { key: checkpoint.get(key) for key in placement }
+        shared = { (entry.get("esx"), entry.get("datastore")) for entry in entries }
+        entry = dict(zip(("esx", "datastore"), shared.pop())) if len(shared) == 1 else None
+    return { key: value or (entry or {}).get(key) for (key, value) in placement.items() }
+
+
+# the "veeam_install" entry of the index-th VM deployed from entries, None if there is none
+#
+def get_entry_of_vm(entries, index):
+    for entry in entries:
+        index -= int(entry.get("vm_count", 1))
+        if(index < 0):
+            return entry
+    return None
+
+
+# the Veeam version a plan installs: the version in the name of its last versioned installer,
+# e.g. 11.0.1.1261 for the cumulative patch
+#
+def get_veeam_version(plan):
+    for step in reversed(plan):
+        searchobj = re.search(r'(\d+\.\d+\.\d+\.\d+)', str(step.get("installer", "")))
+        if searchobj:
+            return searchobj.group(1)
+    return "unknown"
+
+
+# open the run history: a SQLite database of the durations and longest installer log gaps of
+# the install plan steps that succeeded at the first attempt, per step, Veeam version and
+# datastore. An empty history_db turns the history off.
+#
+def init_run_history(vcdata, history_db, version):
+    history = {"path": history_db, "lock": threading.Lock(), "db": None, "version": version, "baselines": {}, "datastores": {}}
+    if history_db:
+        try:
+            db = sqlite3.connect(history_db, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS step_runs (run_id TEXT, finished REAL, step TEXT, version TEXT, datastore TEXT, "
+                       "server TEXT, duration REAL, log_gap REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS step_runs_key ON step_runs (step, version, datastore)")
+            db.commit()
+            history["db"] = db
+        except sqlite3.Error as exp:
+            vcdata["mylogger"].warning(f"Unable to open run history {history_db}. Exception details: {exp}")
+    vcdata["history"] = history
+
+
+def close_run_history(vcdata):
+    history = vcdata.get("history")
+    if(history is not None and history["db"] is not None):
+        history["db"].close()
+        history["db"] = None
+
+
+# nearest-rank percentile of a list of numbers
+#
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+
+# the duration statistics of the recent successful runs of a step. The runs with the same
+# Veeam version on the same datastore are used first, then those with the same version,
+# then all of them. Return None if none of these has history_min_samples runs.
+#
+def query_step_baseline(history, step_name, datastore):
+    scopes = [ (f"version {history['version']} on datastore {datastore}", "AND version = ? AND datastore IS ?", (history["version"], datastore)),
+               (f"version {history['version']}", "AND version = ?", (history["version"],)),
+               ("all versions", "", ()) ]
+    for (scope, condition, params) in scopes:
+        rows = history["db"].execute(f"SELECT duration, log_gap FROM step_runs WHERE step = ? {condition} ORDER BY finished DESC LIMIT ?",
+                                     (step_name,) + params + (history_window,)).fetchall()
+        if(len(rows) < history_min_samples):
+            continue
+        durations = [ row[0] for row in rows ]
+        gaps = [ row[1] for row in rows if row[1] is not None ]
+        return {"scope": scope, "samples": len(rows), "p50": percentile(durations, 50), "p95": percentile(durations, 95),
+                "gap_p95": percentile(gaps, 95) if len(gaps) >= history_min_samples else None}
+    return None
+
+
+# the baseline of a step on a datastore, queried once per run so that the learned limits and
+# the slow step report of a run use the same numbers
+#
+def get_step_baseline(vcdata, step_name, datastore):
+    history = vcdata.get("history")
+    if(history is None or history["db"] is None):
+        return None
+    key = (step_name, datastore)
+    with history["lock"]:
+        if key not in history["baselines"]:
+            try:
+                history["baselines"][key] = query_step_baseline(history, step_name, datastore)
+            except sqlite3.Error as exp:
+                vcdata["mylogger"].warning(f"Querying run history {history['path']} caught an exception. Exception details: {exp}")
+                history["baselines"][key] = None
+        return history["baselines"][key]
+
+
+# derive the timeout and the stall window of the plan steps of a Veeam server from the run
+# history. A learned limit is the 95th percentile times a safety factor, never shorter than
+# a floor and never longer than the static value. Steps without enough history keep their
+# static limits.
+#
+def apply_learned_limits(vcdata, server, plan):
+    history = vcdata.get("history")
+    if history is None:
+        return plan
+    with history["lock"]:
+        history["datastores"][server["vm_ip"]] = server.get("datastore")
+
+    stall_window = int(vcdata["options"].get("stall_window", default_stall_window))
+    learned_plan = []
+    learned = []
+    for step in plan:
+        baseline = get_step_baseline(vcdata, step["name"], server.get("datastore")) if step["kind"] in history_learned_kinds else None
+        if baseline is None:
+            learned_plan.append(step)
+            continue
+
+        static_timeout = sum(pkg["timeout"] for pkg in step["packages"]) if step["kind"] == "msi_batch" else step["timeout"]
+        step = dict(step, learned=True, timeout=int(min(static_timeout, max(history_min_timeout, baseline["p95"] * history_timeout_factor))))
+        if baseline["gap_p95"] is not None:
+            step["stall_window"] = int(min(stall_window, max(history_min_stall, baseline["gap_p95"] * history_stall_factor)))
+        learned_plan.append(step)
+        learned.append(f"{step['name']} {step['timeout']}s/{step.get('stall_window', stall_window)}s ({baseline['samples']} runs, {baseline['scope']})")
+
+    if learned:
+        vcdata["mylogger"].info(f"Learned timeout/stall window on server {server['vm_ip']}: {', '.join(learned)}")
+    return learned_plan
+
+
+# report the steps of this run that took much longer than their history
+#
+def log_slow_steps(vcdata):
+    mylogger = vcdata["mylogger"]
+    history = vcdata.get("history")
+    metrics = vcdata.get("metrics")
+    if(history is None or metrics is None):
+        return
+
+    slow = 0
+    for span in list(metrics["spans"]):
+        if(span["span"] != "step" or span["rc"] != 0):
+            continue
+        baseline = history["baselines"].get((span["step"], history["datastores"].get(span["server"])))
+        if(baseline is not None and span["duration"] > baseline["p95"] * slow_step_factor):
+            mylogger.warning(f"Slow step {span['step']} on server {span['server']} took {span['duration']:.0f}s, "
+                             f"{span['duration'] / max(baseline['p50'], 1):.1f} times the median of {baseline['samples']} earlier runs "
+                             f"({baseline['scope']}, 95th percentile {baseline['p95']:.0f}s)")
+            slow += 1
+    if(history["db"] is not None):
+        mylogger.info(f"{slow} step(s) ran abnormally slowly compared to run history {history['path']}")
+
+
+# add the steps of this run that succeeded at the first attempt to the run history
+#
+def record_run_history(vcdata):
+    history = vcdata.get("history")
+    metrics = vcdata.get("metrics")
+    if(history is None or history["db"] is None or metrics is None):
+        return
+
+    rows = [ (vcdata["run_id"], span["end"], span["step"], history["version"], history["datastores"].get(span["server"]), span["server"],
+              span["duration"], span.get("log_gap"))
+             for span in list(metrics["spans"]) if span["span"] == "step" and span["rc"] == 0 and span.get("attempts") == 1 ]
+    try:
+        with history["db"]:
+            history["db"].executemany("INSERT INTO step_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    except sqlite3.Error as exp:
+        vcdata["mylogger"].warning(f"Unable to write run history {history['path']}. Exception details: {exp}")
+
+
+# PowerShell lines that add a registry value {path, name} to $probe.registry
+#
+def render_registry_probe(entry):
+    key = f"{entry['path']}\\{entry['name']}"
+    return (f"$value = Get-ItemProperty -Path {ps_quote(entry['path'])} -Name {ps_quote(entry['name'])} -ErrorAction SilentlyContinue \n"
+            f"if ($value) {{ $probe.registry[{ps_quote(key)}] = [string]$value.{ps_quote(entry['name'])} }} \n")
+
+
+# render the PowerShell probe that reports, in one round trip, the installed Veeam programs
+# and the files, registry values and logs named by the "detect" entries of the plan. extra
+# lines may add more fields to $probe.
+#
+def render_install_probe(plan, extra=""):
+    detects = []
+    for step in plan:
+        detects.append((step["detect"], step.get("log"), step.get("success")))
+        for pkg in step.get("packages", []):
+            detects.append((pkg["detect"], pkg["log"], pkg["success"]))
+
+    files = sorted({ detect["file"] for (detect, log, success) in detects if detect.get("file") })
+    registry = [ detect["registry"] for (detect, log, success) in detects if detect.get("registry") ]
+    logs = [ (log, success) for (detect, log, success) in detects if detect.get("log") and log ]
+
+    script = ps_log_verdict_function
+    script += ("function Find-InstallLog([string]$Pattern, [string]$Path) { \n"
+               "    $found = @(Get-ChildItem -Path $Pattern -ErrorAction SilentlyContinue | Sort-Object LastWriteTime -Descending) \n"
+               "    if ($found.Count -gt 0) { return $found[0].FullName } \n"
+               "    return $Path \n"
+               "} \n")
+    script += ("$uninstall = 'HKLM:\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\*', 'HKLM:\\SOFTWARE\\WOW6432Node\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\*' \n"
+               "$probe = [ordered]@{ products = @(Get-ItemProperty -Path $uninstall -ErrorAction SilentlyContinue | "
+               "Where-Object { $_.DisplayName -like 'Veeam*' } | ForEach-Object { $_.DisplayName }); files = @{}; registry = @{}; logs = @{} } \n")
+    for path in files:
+        script += (f"if (Test-Path -LiteralPath {ps_quote(path)}) {{ $probe.files[{ps_quote(path)}] = "
+                   f"(Get-Item -LiteralPath {ps_quote(path)}).VersionInfo.ProductVersion }} \n")
+    for entry in registry:
+        script += render_registry_probe(entry)
+    for (log, success) in logs:
+        # the newest log of the earlier runs, or the configured path of runs without run directories
+        path_expr = f"(Find-InstallLog {ps_quote(ntpath.join(remote_base_dir, '*', ntpath.basename(log)))} {ps_quote(log)})"
+        script += f"$probe.logs[{ps_quote(log)}] = ({render_log_verdict_call(log, success, path_expr=path_expr)}).rc \n"
+    script += extra
+    script += "ConvertTo-Json -InputObject $probe -Depth 4 -Compress"
+    return script
+
+
+# probe a Veeam server for the components that are already installed. Return the probe
+# result, or None if the probe fails.
+#
+def probe_installed_components(vcdata, veeam_serv, plan):
+    mylogger = vcdata["mylogger"]
+    results = []
+    rc = run_powershell(vcdata, veeam_serv, render_install_probe(plan), results=results)
+    if(rc != 0):
+        mylogger.warning(f"Probing the installed Veeam components on server {veeam_serv} fails")
+        return None
+
+    try:
+        probe = json.loads('\n'.join(results))
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the installed Veeam components of server {veeam_serv}. Exception details: {exp}")
+        return None
+
+    mylogger.info(f"Installed Veeam programs on server {veeam_serv}: {', '.join(probe['products']) or 'none'}")
+    return probe
+
+
+# check a "detect" entry against the probe result
+#
+def is_detected(probe, detect, log=None):
+    if not detect:
+        return False
+    if detect.get("product"):
+        if not any(product.lower().startswith(detect["product"].lower()) for product in probe["products"]):
+            return False
+    if detect.get("file"):
+        version = probe["files"].get(detect["file"])
+        if(version is None or not version.startswith(str(detect.get("version", "")))):
+            return False
+    if detect.get("registry"):
+        if f"{detect['registry']['path']}\\{detect['registry']['name']}" not in probe["registry"]:
+            return False
+    if detect.get("log"):
+        if(probe["logs"].get(log) != 0):
+            return False
+    return True
+
+
+# apply the probe result to the install plan of a server. Return the plan with the already
+# installed packages removed from batch steps, and the names of the steps already installed.
+#
+def apply_install_probe(plan, probe):
+    resumed_plan = []
+    detected = set()
+    for step in plan:
+        if(step["kind"] == "msi_batch"):
+            packages = [ pkg for pkg in step["packages"] if not is_detected(probe, pkg["detect"], pkg["log"]) ]
+            if not packages:
+                detected.add(step["name"])
+            step = dict(step, packages=packages)
+        elif is_detected(probe, step["detect"], step.get("log")):
+            detected.add(step["name"])
+        resumed_plan.append(step)
+    return (resumed_plan, detected)
+
+
+# render the health probe of verify mode: the install probe of the plan plus the automatic
+# Veeam services, the SQL instance service, the version of the Veeam backup service and the
+# MaxSnapshotsPerDatastore registry value
+#
+def render_health_probe(plan):
+    return render_install_probe(plan, extra=(
+        "$probe.services = @(Get-Service -Name 'Veeam*' -ErrorAction SilentlyContinue | Where-Object { $_.StartType -eq 'Automatic' } | "
+        "ForEach-Object { [ordered]@{ name = $_.Name; status = [string]$_.Status } }) \n"
+        f"$sql = Get-Service -Name {ps_quote(veeam_sql_service)} -ErrorAction SilentlyContinue \n"
+        "$probe.sql = if ($sql) { [string]$sql.Status } else { $null } \n"
+        f"$probe.version = if (Test-Path -LiteralPath {ps_quote(veeam_service_exe)}) {{ "
+        f"(Get-Item -LiteralPath {ps_quote(veeam_service_exe)}).VersionInfo.ProductVersion }} else {{ $null }} \n"
+        + render_registry_probe(veeam_maxsnapshots_reg)))
+
+
+# evaluate the health probe of a Veeam server. Return {check: (passed, details)}.
+#
+def check_server_health(probe, plan, version):
+    checks = {}
+    services = probe.get("services") or []
+    stopped = [ service["name"] for service in services if service["status"] != "Running" ]
+    checks["services"] = (bool(services) and not stopped, f"{len(services)} automatic Veeam services"
+                          + (f", not running: {', '.join(stopped)}" if stopped else ""))
+    checks["sql"] = (probe.get("sql") == "Running", f"{veeam_sql_service} {probe.get('sql') or 'not found'}")
+
+    value = probe["registry"].get(f"{veeam_maxsnapshots_reg['path']}\\{veeam_maxsnapshots_reg['name']}")
+    checks["registry"] = (value == str(veeam_maxsnapshots_value), f"{veeam_maxsnapshots_reg['name']} is {value}, expected {veeam_maxsnapshots_value}")
+
+    if(version == "unknown"):
+        checks["version"] = (True, f"version {probe.get('version')}, no expected version in the install plan")
+    else:
+        checks["version"] = (str(probe.get("version") or "").startswith(version), f"version {probe.get('version')}, expected {version}")
+
+    (plan, detected) = apply_install_probe(plan, probe)
+    missing = [ step["name"] for step in plan if step["kind"] != "stage_media" and step["name"] not in detected ]
+    checks["components"] = (not missing, f"not installed: {', '.join(missing)}" if missing else "all install plan steps detected")
+    return checks
+
+
+# run the health probe on one Veeam server. Return {"vm_name", "vm_ip", "checks", "elapsed"}.
+#
+def verify_veeam_server(vcdata, server):
+    mylogger = vcdata["mylogger"]
+    veeam_serv = server["vm_ip"]
+    result = {"vm_name": server.get("vm_name"), "vm_ip": veeam_serv, "checks": {}, "elapsed": 0}
+    start_time = time.time()
+
+    with trace_span(vcdata, "verify_server", server=veeam_serv, vm_name=server.get("vm_name")) as span:
+        probe = None
+        results = []
+        try:
+            # the probe is longer than a command line and is run from the verify scratch directory
+            if(make_remote_dir(vcdata, veeam_serv) == 0 and run_powershell(vcdata, veeam_serv, render_health_probe(vcdata["install_plan"]), results=results) == 0):
+                probe = json.loads('\n'.join(results))
+        except Exception as exp:
+            mylogger.warning(f"Probing the health of server {veeam_serv} caught an exception. Exception details: {exp}")
+        drop_connection(vcdata, veeam_serv)
+
+        result["elapsed"] = time.time() - start_time
+        if probe is None:
+            result["checks"]["probe"] = (False, "the health probe failed")
+        else:
+            result["checks"]["probe"] = (True, f"probed in {result['elapsed']:.1f} seconds")
+            result["checks"].update(check_server_health(probe, vcdata["install_plan"], get_veeam_version(vcdata["install_plan"])))
+        span["rc"] = 0 if all(passed for (passed, details) in result["checks"].values()) else 1
+    return result
+
+
+# log the pass/fail matrix of verify mode and the details of every failed check
+#
+def log_health_matrix(mylogger, results):
+    mylogger.info('-'*15 + "Veeam Backup & Replication health check" + '-'*15)
+    mylogger.info(f"{'server':<20}{'ip':<18}" + ''.join(f"{check:>12}" for check in health_checks) + f"{'time':>8}")
+    for result in results:
+        cells = [ ("PASS" if result["checks"][check][0] else "FAIL") if check in result["checks"] else "-" for check in health_checks ]
+        mylogger.info(f"{str(result['vm_name']):<20}{result['vm_ip']:<18}" + ''.join(f"{cell:>12}" for cell in cells) + f"{result['elapsed']:>7.1f}s")
+
+    for result in results:
+        for check in health_checks:
+            if(check in result["checks"] and not result["checks"][check][0]):
+                mylogger.warning(f"{result['vm_name']} ({result['vm_ip']}) fails the {check} check: {result['checks'][check][1]}")
+
+    healthy = len([ result for result in results if all(passed for (passed, details) in result["checks"].values()) ])
+    mylogger.info(f"{healthy} of {len(results)} Veeam servers pass all health checks")
+
+
+# the VMs the install runs recorded as deployed: every server of the state file and of the
+# task state files of the work queue
+#
+def get_deployed_servers(options, mylogger):
+    state_files = [ options.get("state_file", default_state_file) ]
+    state_dir = os.path.join(options.get("queue_dir", default_queue_dir), "state")
+    if os.path.isdir(state_dir):
+        state_files += sorted(os.path.join(state_dir, name) for name in os.listdir(state_dir) if name.endswith(".json"))
+
+    servers = []
+    for state_file in state_files:
+        if not os.path.exists(state_file):
+            continue
+        try:
+            with open(state_file, 'r') as fh:
+                servers += json.load(fh).get("servers", {}).values()
+        except (IOError, OSError, ValueError) as exp:
+            mylogger.warning(f"Unable to read state file {state_file}. Exception details: {exp}")
+    return servers
+
+
+# the Veeam servers verify mode checks: the "hosts" option, or the VMs deployed from the
+# "veeam_install" entries of the YAML file (on the ESX host and datastore of an entry, or
+# with no recorded placement), except the powered off golden VMs. Their ip addresses are looked up in the vCenter of
+# the "VCenter" section, like install mode does for the deployed VMs.
+#
+def get_verify_servers(yamlfile, options, mylogger, yaml_section="veeam_install"):
+    if options.get("hosts"):
+        return [ {"vm_name": host, "vm_ip": host} for host in options["hosts"] ]
+
+    (rc, vcdata, yaml_data, units) = get_deploy_units(yamlfile, mylogger, yaml_section)
+    if(rc != 0): return []
+    placements = { (entry.get("esx"), entry.get("datastore")) for entry in units }
+    placements.add((None, None))    # recorded by earlier runs that did not know the placement
+    deployed_vm = sorted({ entry["vm_name"] for entry in get_deployed_servers(options, mylogger)
+                           if entry.get("vm_name") and not entry.get("golden") and (entry.get("esx"), entry.get("datastore")) in placements })
+    if not deployed_vm:
+        mylogger.warning(f"No VM deployed from the {yaml_section} entries of {yamlfile} is recorded")
+        return []
+
+    veeam_servers = vm_operation.get_vm_ip(vc_name = vcdata["vcenter_name"], vc_user = vcdata["vcenter_user"], vc_pw = vcdata["vcenter_pw"],
+                                           vc_ssl_check = vcdata["ssl-check"], mylogger = mylogger, vm_list = deployed_vm)
+    found = { server["vm_name"] for server in veeam_servers or [] if server.get("vm_ip") }
+    for vm_name in deployed_vm:
+        if vm_name not in found:
+            mylogger.warning(f"Unable to get the ip address of Veeam Backup & Replication Server {vm_name}")
+    return [ {"vm_name": server["vm_name"], "vm_ip": server["vm_ip"]} for server in veeam_servers or [] if server.get("vm_ip") ]
+
+
+# verify mode: probe every Veeam server at the same time and log the pass/fail matrix.
+# Return 0 if every server passes every check.
+#
+def start_verify_vbr(yamlfile, mylogger, cli_options=None):
+    options = get_install_options(yamlfile, mylogger)
+    options.update({ key: value for (key, value) in (cli_options or {}).items() if value is not None })
+    install_plan = get_install_plan(yamlfile, mylogger, options)
+    if install_plan is None: return 1
+
+    veeam_servers = get_verify_servers(yamlfile, options, mylogger)
+    if not veeam_servers:
+        mylogger.warning("No Veeam Backup & Replication Server to verify. Give --hosts, or install the veeam_install entries of the YAML file first")
+        return 1
+
+    # a health check is read-only: it uses a scratch directory and leaves the run directories alone
+    vcdata = {"mylogger": mylogger, "options": options, "install_plan": install_plan, "remote_dir": verify_remote_dir}
+    init_ssh_pool(vcdata)
+    init_metrics(vcdata, options.get("metrics_file", options["outlogfile"] + '_metrics.jsonl'))
+
+    workers = max(1, min(int(options.get("verify_workers", default_verify_workers)), len(veeam_servers)))
+    mylogger.info(f"Verifying {len(veeam_servers)} Veeam Backup & Replication server(s) with {workers} concurrent worker(s)")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="veeam-verify") as executor:
+        futures = [ executor.submit(verify_veeam_server, vcdata, server) for server in veeam_servers ]
+        results = []
+        for (future, server) in zip(futures, veeam_servers):
+            try:
+                results.append(future.result())
+            except Exception as exp:
+                mylogger.warning(f"Verifying server {server['vm_ip']} caught an exception. Exception details: {exp}")
+                results.append({"vm_name": server.get("vm_name"), "vm_ip": server["vm_ip"], "checks": {"probe": (False, str(exp))}, "elapsed": 0})
+
+    log_health_matrix(mylogger, results)
+    close_metrics(vcdata)
+    return 0 if all(all(passed for (passed, details) in result["checks"].values()) for result in results) else 1
+
+
+# read the YAML configuration file. Return None if it cannot be read.
+#
+def load_yaml_file(yamlfile, mylogger):
+    try:
+        with open(yamlfile, 'r') as fh:
+            return yaml.safe_load(fh)
+    except Exception as exp:
+        mylogger.warning(f"Unable to read YAML file {yamlfile}. Exception details: {exp}")
+        return None
+
+
+# load the optional "install_options" section of the YAML configuration file
+#
+def get_install_options(yamlfile, mylogger):
+    yaml_data = load_yaml_file(yamlfile, mylogger)
+    options = yaml_data.get("install_options") if isinstance(yaml_data, dict) else None
+    if not isinstance(options, dict):
+        return {}
+    return options
+
+
+# fill in the default values of an install plan step
+#
+def normalize_install_step(step):
+    step = dict(install_step_defaults, **step)
+    step.setdefault("description", step.get("name"))
+    step.setdefault("ps_file", f"veeam_{step.get('name')}_install.ps1")
+    if(step.get("kind") == "msi"):
+        step.setdefault("detect", {"product": step["description"]})
+    if(step.get("kind") == "msi_batch"):
+        step["packages"] = [ dict({"timeout": install_step_defaults["timeout"], "success": msi_success_str,
+                                   "ps_file": f"veeam_{step.get('name')}{i}_install.ps1", "detect": {"product": pkg.get("service")}}, **pkg)
+                             for (i, pkg) in enumerate(step.get("packages") or []) ]
+    step.setdefault("detect", {})
+    return step
+
+
+# replace every "msi_batch" step by one "msi" step per package. Steps depending on the
+# batch depend on all its packages instead.
+#
+def expand_batch_steps(plan):
+    expanded = []
+    replaced = {}
+    for step in plan:
+        if(step["kind"] != "msi_batch"):
+            expanded.append(step)
+            continue
+
+        replaced[step["name"]] = []
+        for (i, pkg) in enumerate(step["packages"]):
+            name = f"{step['name']}{i}"
+            expanded.append(normalize_install_step({"name": name, "description": pkg["service"], "kind": "msi", "installer": pkg["msi"],
+                                                    "args": ['ACCEPTEULA="1"', 'ACCEPT_THIRDPARTY_LICENSES="1"'], "log": pkg["log"],
+                                                    "ps_file": pkg["ps_file"], "timeout": pkg["timeout"], "success": pkg["success"],
+                                                    "depends": step["depends"], "lock": step["lock"], "detect": pkg["detect"]}))
+            replaced[step["name"]].append(name)
+
+    for step in expanded:
+        depends = []
+        for dep in step["depends"]:
+            depends.extend(replaced.get(dep, [dep]))
+        step["depends"] = depends
+    return expanded
+
+
+# check that the install plan steps are complete and that their dependencies form a DAG
+#
+def validate_install_plan(plan, mylogger):
+    names = [ step.get("name") for step in plan ]
+    if(None in names or len(set(names)) != len(names)):
+        mylogger.warning(f"Install plan steps need unique names: {names}")
+        return 1
+
+    for step in plan:
+        if(step.get("kind") not in install_step_kinds):
+            mylogger.warning(f"Install plan step {step['name']} has unknown kind {step.get('kind')}. Choose among {install_step_kinds}")
+            return 1
+        required = {"msi": ["installer", "log"], "exe": ["installer", "log"], "msi_batch": ["packages"], "update_components": [], "stage_media": []}[step["kind"]]
+        missing = [ key for key in required if not step.get(key) ]
+        if(step["kind"] == "msi_batch"):
+            missing += [ f"packages.{key}" for pkg in step["packages"] for key in ["service", "msi", "log"] if not pkg.get(key) ]
+        if missing:
+            mylogger.warning(f"Install plan step {step['name']} misses {', '.join(missing)}")
+            return 1
+        if(not isinstance(step["weight"], (int, float)) or step["weight"] < 0):
+            mylogger.warning(f"Install plan step {step['name']} needs a weight of 0 or more, not {step['weight']}")
+            return 1
+        unknown = [ dep for dep in step["depends"] if dep not in names ]
+        if unknown:
+            mylogger.warning(f"Install plan step {step['name']} depends on unknown step(s) {', '.join(unknown)}")
+            return 1
+
+    # Kahn's algorithm: every step must become ready once its dependencies are done
+    done = set()
+    while(len(done) < len(plan)):
+        ready = [ step["name"] for step in plan if step["name"] not in done and all(dep in done for dep in step["depends"]) ]
+        if not ready:
+            mylogger.warning(f"Install plan has a dependency cycle among steps {', '.join(name for name in names if name not in done)}")
+            return 1
+        done.update(ready)
+
+    return 0
+
+
+# get the install plan: the "install_plan" section of the YAML configuration file, or the
+# default plan. Return None if the plan is not valid.
+#
+def get_install_plan(yamlfile, mylogger, options):
+    yaml_data = load_yaml_file(yamlfile, mylogger)
+    plan = yaml_data.get("install_plan") if isinstance(yaml_data, dict) else None
+    if plan is None:
+        plan = default_install_plan
+    elif not isinstance(plan, list) or not all(isinstance(step, dict) for step in plan):
+        mylogger.warning(f"The install_plan section of YAML file {yamlfile} must be a list of steps")
+        return None
+
+    plan = [ normalize_install_step(step) for step in plan ]
+    if not options.get("batch_service_pkgs", True):
+        plan = expand_batch_steps(plan)
+    if(options.get("media_dir") and not any(step["kind"] == "stage_media" for step in plan)):
+        # stage the installer media before the first installer runs
+        for step in plan:
+            if not step["depends"]:
+                step["depends"] = ["media"]
+        plan.insert(0, normalize_install_step(media_stage_step))
+    if(validate_install_plan(plan, mylogger) != 0):
+        return None
+    return plan
+
+
+def install_batch_step(vcdata, veeam_serv, step):
+    return install_service_pkgs_batch(vcdata, veeam_serv, step["packages"], step["timeout"] if step.get("learned") else None,
+                                      step.get("stall_window"))
+
+
+install_step_runners = {"msi": install_step, "exe": install_step, "msi_batch": install_batch_step, "update_components": update_server_component,
+                        "stage_media": stage_media}
+
+
+# create the admission pools of the heavy install plan steps from the install_options
+# "admission" limits
+#
+def init_admission(vcdata):
+    limits = dict(default_admission_limits, **(vcdata["options"].get("admission") or {}))
+    vcdata["admission"] = {"limits": { scope: int(limits[scope] or 0) for scope in default_admission_limits },
+                           "cond": threading.Condition(), "used": {}}
+
+
+# the limited pools a step of a Veeam server draws from: ("global", None), ("esx", host), ("datastore", name)
+#
+def get_admission_pools(admission, server):
+    pools = [("global", None)] + [ (scope, server[scope]) for scope in ("esx", "datastore") if server.get(scope) ]
+    return [ pool for pool in pools if admission["limits"][pool[0]] > 0 ]
+
+
+# admit a heavy step: wait until every pool of its server has room for the step's weight and
+# take it from all of them at once, so that a step never holds one pool while waiting for
+# another. A step heavier than a limit runs alone in that pool.
+#
+@contextlib.contextmanager
+def admitted(vcdata, server, step):
+    admission = vcdata.get("admission")
+    weight = step.get("weight", 0)
+    if(admission is None or not weight):
+        yield
+        return
+
+    pools = get_admission_pools(admission, server)
+    used = admission["used"]
+    with trace_span(vcdata, "admit", weight=weight) as span:
+        with admission["cond"]:
+            admission["cond"].wait_for(lambda: all(used.get(pool, 0) == 0 or used.get(pool, 0) + weight <= admission["limits"][pool[0]]
+                                                   for pool in pools))
+            for pool in pools:
+                used[pool] = used.get(pool, 0) + weight
+        span["rc"] = 0
+    if(span.get("duration", 0) >= 1):
+        vcdata["mylogger"].info(f"Admitted {step['description']} on server {server['vm_ip']} after waiting {span['duration']:.0f} seconds for "
+                                + ', '.join(f"{scope} {name}" if name else scope for (scope, name) in pools))
+    try:
+        yield
+    finally:
+        with admission["cond"]:
+            for pool in pools:
+                used[pool] -= weight
+            admission["cond"].notify_all()
 
 
-# run commands through ssh to VBR server
+# log the time every Veeam server waited for the admission of its heavy steps
 #
-def run_command(cmd, conn, mylogger, timeout=180, results = None):
-    try:
-        mylogger.debug("Running command: %s" % cmd)
-        res = conn.run(cmd, hide=True, timeout=timeout)
+def log_admission_summary(vcdata):
+    metrics = vcdata.get("metrics")
+    admission = vcdata.get("admission")
+    if(metrics is None or admission is None):
+        return
+
+    waits = {}
+    for span in list(metrics["spans"]):
+        if(span["span"] == "admit"):
+            entry = waits.setdefault(span["server"], {"steps": 0, "wait": 0.0})
+            entry["steps"] += 1
+            entry["wait"] += span["duration"]
+    if waits:
+        limits = ', '.join(f"{scope} {limit or 'unlimited'}" for (scope, limit) in admission["limits"].items())
+        vcdata["mylogger"].info(f"Admission wait of the heavy steps ({limits}): "
+                                + ', '.join(f"{server} {entry['wait']:.1f}s over {entry['steps']} step(s)" for (server, entry) in sorted(waits.items())))
+
+
+# record evidence of why the running install step attempt fails: ("exception", exception),
+# ("exit_code", code), ("log", verdict), ("abort", reason), ("stderr", text) or ("timeout", text).
+# A successful attempt records ("reboot_required", code) when its installer asks for a reboot.
+#
+def note_failure(kind, value):
+    evidence = failure_context.get()
+    if evidence is not None:
+        evidence.append((kind, value))
 
-        if(res.stderr):
-            mylogger.warning("Running command through ssh to Veeam backup server returned error: %s" % res.stderr)
-            return 1
 
-        if isinstance(results, list):
-            tmp_res = (res.stdout.rstrip()).split('\n')
-            for item in tmp_res:
-                results.append(item)
-    except Exception as exp:
-        mylogger.warning("Running command through ssh to Veeam backup server caught an exception. Exception details:  %s" % exp)
-        return 1
+# True if an installer run that did not report plain success succeeded with a reboot required:
+# its exit code is 3010 or 1641 and its log was read and shows no failure
+#
+def is_reboot_required(exit_code, verdict):
+    return (str(exit_code).strip() in [ str(code) for code in reboot_exit_codes ] and verdict.get("lines", 0) > 0
+            and not verdict.get("failures") and verdict.get("msi_return") in (None, 0, int(str(exit_code).strip())))
 
-    return 0
 
+def is_exception_of(exp, names):
+    return any(cls.__name__ in names for cls in type(exp).__mro__)
 
-# search the last valid 10 lines of the powershell log for success_str
+
+# classify the failure of a step attempt from its evidence. Return (failure class, details).
 #
-def check_ps_log(vcdata, ps_log, success_str):
-    mylogger = vcdata["mylogger"]
-    encoding = ["utf-16", "utf-8"]
-    log_content = []
-    for item in encoding:  # the powershell output log file can be either utf-16 or utf-8 encoding.
-        try:
-            with open(ps_log, 'r', encoding=item) as fh:
-                log_content = fh.readlines()
-            break
-        except (IOError, OSError) as exp:
-            mylogger.warning("Hit IOError while opening file %s. Exception details: %s" % (ps_log, exp) )
-            return 1
-        except UnicodeDecodeError as exp:
-            mylogger.debug("Hit UnicodeDecodeError while opening file %s. Exception details: %s" % (ps_log, exp) )
-        except Exception as exp:
-            exp_str = str(exp)
-            mylogger.debug("Hit exception while opening file %s. Exception details: %s" % (ps_log, exp_str) )
-            if( re.search("UTF-16 stream does not start with BOM", exp_str, re.M|re.I) != None ):
-                pass
-            else:
-                return 1 
-    if(len(log_content) == 0):
-        mylogger.warning("Powershell log file %s does not have any content" % ps_log)
-        return 1
+def classify_failure(evidence):
+    exit_codes = set()
+    lines = []
+    for (kind, value) in evidence:
+        if(kind == "exit_code" and str(value).strip().lstrip('-').isdigit() and int(value) != 0):
+            exit_codes.add(int(value))
+        elif(kind == "log"):
+            lines += value.get("failures") or []
+            if value.get("msi_return"):
+                exit_codes.add(value["msi_return"])
+        elif(kind in ("abort", "stderr")):
+            lines.append(str(value))
+    text = '\n'.join(lines)
+    msi_return = get_log_patterns(msi_success_str)["msi_return"]
+    exit_codes.update(int(code) for code in msi_return.findall(text) if int(code) != 0)    # return values in abort reasons
+    codes = f"exit code {', '.join(str(code) for code in sorted(exit_codes))}" if exit_codes else None
+
+    for (failure_class, class_codes, pattern) in failure_classes:
+        if(exit_codes & class_codes or re.search(pattern, text, re.IGNORECASE)):
+            return (failure_class, codes or text.split('\n')[0])
+    for (kind, value) in evidence:
+        if(kind == "abort" and "did not grow" in value):
+            return ("stalled", value)
+    if(exit_codes or lines):
+        return ("install_failed", codes or lines[0])
+    exceptions = [ value for (kind, value) in evidence if kind == "exception" ]
+    timed_out = [ exp for exp in exceptions if is_exception_of(exp, timeout_exceptions) ]
+    if timed_out:
+        return ("timed_out", f"{type(timed_out[0]).__name__}: {timed_out[0]}")
+    if(any(is_exception_of(exp, transient_exceptions) for exp in exceptions) or any(kind == "timeout" for (kind, value) in evidence)):
+        return ("transient", f"{type(exceptions[0]).__name__}: {exceptions[0]}" if exceptions else "timeout")
+    local = [ exp for exp in exceptions if isinstance(exp, OSError) ]
+    if local:
+        return ("fatal", f"{type(local[0]).__name__}: {local[0]}")
+    return ("unknown", f"{type(exceptions[0]).__name__}: {exceptions[0]}" if exceptions else "no details")
+
+
+# the retry policy of every failure class, with the install_options "retry_policy" overrides
+#
+def get_retry_policy(vcdata):
+    overrides = vcdata["options"].get("retry_policy") or {}
+    return { failure_class: dict(policy, **(overrides.get(failure_class) or {})) for (failure_class, policy) in default_retry_policy.items() }
+
+
+# get a Veeam server ready for the next attempt of a failed step: reboot it when a reboot is
+# pending, otherwise wait for Windows Installer to be idle. After a transport failure the
+# installer may still run, and the next attempt starts on a new connection.
+#
+def prepare_retry(vcdata, veeam_serv, failure_class):
+    if(failure_class == "reboot_pending"):
+        return reboot_veeam_server(vcdata, veeam_serv)
+    if(failure_class == "transient"):
+        drop_connection(vcdata, veeam_serv)
+    return wait_until(vcdata["mylogger"], f"Windows Installer to be idle on server {veeam_serv}", lambda: installer_idle(vcdata, veeam_serv), installer_idle_timeout)
 
-    # search the last valid 10 lines of the powershell log for success_str
-    count = 0 
-    for i in range( len(log_content)-1, -1,-1 ):
-        if(log_content[i].rstrip() == ''): 
-            continue
-        searchobj = re.search(r'(%s)' % success_str, log_content[i], re.M|re.I)
-        if(searchobj):
-            return 0
-        count = count + 1
-        if(count > 10):
-            return 1
 
-    return 1
+# True once the work queue lease of the task of this install is lost: another worker took
+# the task over, so no further step or retry may start on its servers
+#
+def is_cancelled(vcdata):
+    return vcdata.get("cancel") is not None and vcdata["cancel"].is_set()
 
 
-# run Veeam installation powershell in the remote Veeam server
+# run one install plan step. A failed attempt is classified and re-run while the retry budget
+# of its failure class lasts, after an exponential backoff. Fatal failures are not re-run.
+# Heavy steps run once the admission control lets them. A step that succeeds with a reboot
+# required is added to reboots.
 #
-def run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, timeout, success_str):
+def run_plan_step(vcdata, server, step, locks, reboots=None):
     mylogger = vcdata["mylogger"]
-    ps_log = '/' + ps_log.replace('\\', '/')    # need to convert from "C:\\temp\\veeam_bkupcatalog_install.log" to this: "/C:/temp/veeam_bkupcatalog_install.log"
-    path, log_fname = os.path.split(ps_log)
-    local_ps_log = f"/tmp/{log_fname}" 
+    veeam_serv = server["vm_ip"]
+    lock = locks[step["lock"]] if step["lock"] else contextlib.nullcontext()
+    policies = get_retry_policy(vcdata)
+    retries = {}
+    attempt = 0
+
+    with trace_span(vcdata, "step", step=step["name"]) as span:
+        while True:
+            attempt += 1
+            evidence = []
+            token = failure_context.set(evidence)
+            try:
+                with lock, admitted(vcdata, server, step):
+                    rc = install_step_runners[step["kind"]](vcdata, veeam_serv, step)
+            except Exception as exp:
+                mylogger.warning(f"Installing {step['description']} on server {veeam_serv} caught an exception. Exception details: {exp}")
+                note_failure("exception", exp)
+                rc = 1
+            finally:
+                failure_context.reset(token)
+            if(rc == 0):
+                if(reboots is not None and any(kind == "reboot_required" for (kind, value) in evidence)):
+                    reboots.add(step["name"])
+                    span["reboot_required"] = True
+                break
+
+            (failure_class, details) = classify_failure(evidence)
+            span["failure"] = failure_class
+            budget = step["retries"] if policies[failure_class]["budget"] is None else policies[failure_class]["budget"]
+            retries[failure_class] = retries.get(failure_class, 0) + 1
+            if is_cancelled(vcdata):
+                mylogger.warning(f"{step['description']} on server {veeam_serv} failed: {failure_class} ({details}). "
+                                 "Not retried: another worker took the task over")
+                break
+            if(retries[failure_class] > budget):
+                mylogger.warning(f"{step['description']} on server {veeam_serv} failed: {failure_class} ({details}). "
+                                 + ("Not retried" if budget == 0 else f"Retry budget of {budget} used up"))
+                break
+
+            delay = min(retry_backoff_max, policies[failure_class]["backoff"] * 2 ** (retries[failure_class] - 1))
+            mylogger.warning(f"{step['description']} on server {veeam_serv} failed: {failure_class} ({details}). "
+                             f"Re-run {retries[failure_class]} of {budget}" + (f" in {delay} seconds" if delay else " once the server is ready"))
+            with trace_span(vcdata, "retry", failure=failure_class) as retry_span:
+                if delay:
+                    time.sleep(delay)
+                retry_span["rc"] = prepare_retry(vcdata, veeam_serv, failure_class)
+            if(retry_span["rc"] != 0):
+                mylogger.warning(f"Server {veeam_serv} is not ready for a re-run of {step['description']}. Not retried")
+                break
+        span.update({"rc": rc, "attempts": attempt})
 
-    mylogger.info(f"Start running PowerShell file {ps_file} on server {veeam_serv}")
-    try:
-        conn = Connection(veeam_serv, user=veeam_serv_user, connect_kwargs={"password": veeam_serv_pw}, connect_timeout=600)
-        conn.put(f"/tmp/{ps_file}", f"/c:/temp/{ps_file}")
-    except Exception as exp:
-        mylogger.warning(f"Uploading file /tmp/{ps_file} to server {veeam_serv} directory c:\\temp caught an exception. Exception details: {exp}")
-        conn.close()
-        return 1
+    return rc
 
-    results = []
-    cmd = f"powershell -File c:\\temp\\{ps_file}"
 
-    rc = run_command(cmd, conn, mylogger, timeout, results)
+# run the install plan on one Veeam server. A step starts as soon as the steps it depends
+# on are done; independent steps run at the same time unless they share a lock. Steps
+# depending on a failed step are skipped. Steps in done are not run again. Every completed
+# step is recorded in the checkpoint store. When a step succeeds with a reboot required, the
+# steps depending on it wait: the server is rebooted once no step runs on it, also at the end
+# of the plan. Return (rc, description of the first failed step).
+#
+def run_install_plan(vcdata, server, plan, done=()):
+    mylogger = vcdata["mylogger"]
+    veeam_serv = server["vm_ip"]
+    workers = int(vcdata.get("options", {}).get("plan_workers", default_plan_workers))
+    plan = apply_learned_limits(vcdata, server, plan)
+    locks = { step["lock"]: threading.Lock() for step in plan if step["lock"] }
+    status = { step["name"]: "done" if step["name"] in done else "pending" for step in plan }
+    return_rc = 0
+    failed_step = None
+    reboots = set()
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=threading.current_thread().name) as executor:
+        while True:
+            for step in plan:
+                if is_cancelled(vcdata):
+                    break
+                if(status[step["name"]] == "pending" and all(status[dep] == "done" for dep in step["depends"])
+                   and not reboots & set(step["depends"])):
+                    status[step["name"]] = "running"
+                    running[executor.submit(contextvars.copy_context().run, run_plan_step, vcdata, server, step, locks, reboots)] = step
+            if(not running and reboots and not is_cancelled(vcdata)):
+                mylogger.info(f"Reboot server {veeam_serv}: {', '.join(sorted(reboots))} installed with a reboot required")
+                if(reboot_veeam_server(vcdata, veeam_serv) != 0):
+                    if failed_step is None:
+                        (return_rc, failed_step) = (1, f"reboot after {', '.join(sorted(reboots))}")
+                    break
+                reboots.clear()
+                continue
+            if not running:
+                break
+
+            (finished, pending) = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    rc = future.result()
+                except Exception as exp:
+                    mylogger.warning(f"Installing {step['description']} on server {veeam_serv} caught an exception. Exception details: {exp}")
+                    rc = 1
+
+                if(rc == 0):
+                    status[step["name"]] = "done"
+                    record_checkpoint(vcdata, server, step["name"])
+                else:
+                    status[step["name"]] = "failed"
+                    if failed_step is None:
+                        (return_rc, failed_step) = (rc, step["description"])
+
+    skipped = [ name for name in status if status[name] == "pending" ]
+    if(skipped and is_cancelled(vcdata)):
+        mylogger.warning(f"Stop installing on server {veeam_serv}: another worker took its task over. Not started: {', '.join(skipped)}")
+        if failed_step is None:
+            (return_rc, failed_step) = (1, "lease lost")
+    elif skipped:
+        mylogger.warning(f"Skip step(s) {', '.join(skipped)} on server {veeam_serv} after the failure of {failed_step}")
+
+    return (return_rc, failed_step)
+
+
+# install all the Veeam components on one Veeam server. A failure only stops the
+# install chain of this server. Return the per-server summary.
+#
+def install_veeam_server(vcdata, server):
+    mylogger = vcdata["mylogger"]
+    veeam_serv = server["vm_ip"]
+    summary = {"vm_name": server.get("vm_name"), "vm_ip": veeam_serv, "rc": 0, "failed_step": None, "elapsed": 0}
+
+    start_time = time.time()
+
+    with trace_span(vcdata, "server", server=veeam_serv, vm_name=server.get("vm_name")) as span:
+        mylogger.info("Start installing Veeam Backup & Replication on server %s (%s)" % (veeam_serv, server.get("vm_name")))
+        plan = vcdata["install_plan"]
+        done = set()
+        if(make_remote_run_dir(vcdata, veeam_serv) != 0):
+            (summary["rc"], summary["failed_step"], span["rc"]) = (1, "run_dir", 1)
+            drop_connection(vcdata, veeam_serv)
+            summary["elapsed"] = time.time() - start_time
+            return summary
+
+        if vcdata["options"].get("resume"):
+            # skip the steps completed by an earlier run and the components found on the server
+            done = get_checkpoint_steps(vcdata, server)
+            with trace_span(vcdata, "probe"):
+                probe = probe_installed_components(vcdata, veeam_serv, plan)
+            if probe is not None:
+                (plan, detected) = apply_install_probe(plan, probe)
+                for name in sorted(detected - done):
+                    record_checkpoint(vcdata, server, name, "detected")
+                done |= detected
+            if done:
+                mylogger.info(f"Resume installation on server {veeam_serv}. Already done: {', '.join(sorted(done))}")
+
+        (summary["rc"], summary["failed_step"]) = run_install_plan(vcdata, server, plan, done)
+        span["rc"] = summary["rc"]
+        if(summary["rc"] == 0):
+            mylogger.info("Successfully complete Veeam Backup & Replication installation on server %s" % veeam_serv)
+        mark_remote_run_finished(vcdata, veeam_serv, summary["rc"])
+
+    drop_connection(vcdata, veeam_serv)
+    summary["elapsed"] = time.time() - start_time
+    if(summary["rc"] == 0):
+        mark_checkpoint_complete(vcdata, server)
+
+    return summary
+
+
+# log the per-server installation summary at the end of the run
+#
+def log_install_summary(mylogger, summaries):
+    mylogger.info('-'*15 + "Veeam Backup & Replication installation summary" + '-'*15)
+    for summary in summaries:
+        status = "SUCCESS" if summary["rc"] == 0 else f"FAILED at {summary['failed_step']}"
+        elapsed = time.strftime('%H:%M:%S', time.gmtime(summary["elapsed"]))
+        mylogger.info(f"{summary['vm_name']} ({summary['vm_ip']}): {status}, elapsed {elapsed}")
+
+    failed = len([ summary for summary in summaries if summary["rc"] != 0 ])
+    mylogger.info(f"{len(summaries) - failed} of {len(summaries)} Veeam servers installed successfully")
 
-    res = '\n'.join(results)
-    if(rc != 0):
-        mylogger.warning(f"Error: running PowerShell c:\temp\{ps_file} on server {veeam_serv} fails")
-        return rc
 
-    time.sleep(60)  # wait for 60 seconds till powershell log file is created
+# get the existing VMs of a resumed run: every VM of the state file whose installation is
+# not complete and that was not handed off to the work queue. The vCenter settings come from the "VCenter" section of the YAML file.
+# Return (rc, vcdata, vm names).
+#
+def get_resume_vms(yamlfile, mylogger, options):
+    state_file = options.get("state_file", default_state_file)
+    yaml_data = load_yaml_file(yamlfile, mylogger)
+    if(not isinstance(yaml_data, dict) or not isinstance(yaml_data.get("VCenter"), dict)):
+        mylogger.warning(f"YAML file {yamlfile} has no VCenter section")
+        return (1, {}, [])
 
     try:
-        conn.get(ps_log, local_ps_log)
-    except Exception as exp:
-        mylogger.warning(f"Downloading PowerShell log file {ps_log} to local machine as {local_ps_log} caught an exception. Exception details: {exp}")
-        conn.close()
-        return 1
+        with open(state_file, 'r') as fh:
+            servers = json.load(fh).get("servers", {})
+    except (IOError, OSError, ValueError) as exp:
+        mylogger.warning(f"Unable to resume: cannot read state file {state_file}. Exception details: {exp}")
+        return (1, {}, [])
 
-    ps_success = check_ps_log(vcdata, local_ps_log, success_str)   # check the PowerShell log for success_str
- 
-    if(res == "0" and ps_success == 0 ):
-        mylogger.info(f"Success: running PowerShell c:\\temp\\{ps_file} on server {veeam_serv} succeeds")
-        rc = 0
-    else:
-        mylogger.warning(f"Error: running PowerShell c:\\temp\\{ps_file} on server {veeam_serv} fails")
-        rc = 1
+    vm_list = [ entry["vm_name"] for entry in servers.values() if entry.get("vm_name") and not entry.get("complete") and not entry.get("queued") ]
+    if not vm_list:
+        mylogger.warning(f"State file {state_file} has no unfinished Veeam Backup & Replication Server to resume")
+        return (1, {}, [])
 
-    conn.close()
-    return rc
+    mylogger.info("Resume installing Veeam Backup & Replication on virtual machine %s" % ', '.join(vm_list))
+    return (0, dict(yaml_data["VCenter"]), vm_list)
+
+
+# load the deployment units of pipeline mode: every "veeam_install" entry is deployed by
+# its own vm_operation.create_from_yaml() call. Return (rc, vcdata from the VCenter section,
+# YAML data, entries).
+#
+def get_deploy_units(yamlfile, mylogger, yaml_section):
+    yaml_data = load_yaml_file(yamlfile, mylogger)
+    if(not isinstance(yaml_data, dict) or not isinstance(yaml_data.get("VCenter"), dict)):
+        mylogger.warning(f"YAML file {yamlfile} has no VCenter section")
+        return (1, {}, None, [])
+
+    entries = yaml_data.get(yaml_section)
+    if(not isinstance(entries, list) or not entries):
+        mylogger.warning(f"YAML file {yamlfile} has no {yaml_section} entry")
+        return (1, {}, None, [])
 
+    return (0, dict(yaml_data["VCenter"]), yaml_data, entries)
 
-# install Veeam Backup Catalog
+
+# deploy the VMs of one "veeam_install" entry. The entry is written to a YAML file of its own,
+# readable by the owner only, for vm_operation.create_from_yaml().
 #
-def install_bkup_catalog(vcdata, veeam_serv):
+def deploy_unit(vcdata, yaml_data, yaml_section, index, entry, deplogfile):
     mylogger = vcdata["mylogger"]
-    ps_file = "veeam_bkupcatalog_install.ps1"    # powershell file name
-    ps_log = "c:\\temp\\veeam_bkupcatalog_install.log"
-    ps_timeout = 900
-    ps_success_str = "MainEngineThread is returning 0"
+    os.makedirs(vcdata["local_dir"], exist_ok=True)
+    unit_yamlfile = os.path.join(vcdata["local_dir"], f"deploy_unit{index}.yaml")
+    try:
+        with os.fdopen(os.open(unit_yamlfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fh:
+            yaml.safe_dump(dict(yaml_data, **{yaml_section: [entry]}), fh)
+        return vm_operation.create_from_yaml(unit_yamlfile, yaml_section, mylogger, deplogfile)
+    except Exception as exp:
+        mylogger.warning(f"Deploying {yaml_section} entry {index} caught an exception. Exception details: {exp}")
+        return (1, {})
+    finally:
+        if os.path.exists(unit_yamlfile):
+            os.remove(unit_yamlfile)
 
-    mylogger.info('-'*15 + "Start installing Veeam Backup Catalog on server %s" % veeam_serv + '-'*15)
 
-    vbrc_service_user = f"{veeam_serv_hostname}\\{veeam_serv_user}"      # veeam-serv1\Administrator
+# wait until a deployed VM reports its ip address and opens its ssh port. Return the server
+# {"vm_name", "vm_ip"}, or None on timeout.
+#
+def wait_for_vm_ready(vcdata, vm_name):
+    mylogger = vcdata["mylogger"]
+    server = {}
 
-    cmd = ("$params = '/qn', '/i', \"c:\\veeam_soft\\catalog\\VeeamBackupCatalog64.msi\", 'ACCEPTEULA=\"1\"', 'ACCEPT_THIRDPARTY_LICENSES=\"1\"', "  
-           f"'VBRC_SERVICE_USER=\"{vbrc_service_user}\"', 'VBRC_SERVICE_PASSWORD=\"{veeam_serv_pw}\"', '/L*V', '{ps_log}' \n" 
-            "$process = Start-Process 'msiexec.exe' -ArgumentList $params -WindowStyle Hidden -Wait -PassThru \n"
-            "$process.ExitCode")
+    def vm_ready():
+        if not server:
+            found = vm_operation.get_vm_ip(vc_name = vcdata["vcenter_name"], vc_user = vcdata["vcenter_user"], vc_pw = vcdata["vcenter_pw"],
+                                           vc_ssl_check = vcdata["ssl-check"], mylogger = mylogger, vm_list = [vm_name])
+            server.update(next((vm for vm in found or [] if vm.get("vm_ip")), {}))
+        return bool(server) and ssh_port_open(server["vm_ip"])
 
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
+    with trace_span(vcdata, "vm_ready", vm_name=vm_name) as span:
+        span["rc"] = wait_until(mylogger, f"virtual machine {vm_name} to get an ip address and open its ssh port", vm_ready, vm_ready_timeout)
+    return server if span["rc"] == 0 else None
 
-    rc = run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str)
-    if(rc == 0):
-        mylogger.info("Successfully install Veeam Backup Catalog on server %s" % veeam_serv)
-    else:
-        mylogger.warning("Error installing Veeam Backup Catalog on server %s" % veeam_serv)
 
-    return rc
+# provisioning stage of the pipeline: deploy one "veeam_install" entry and queue each of its
+# VMs for installation by install_func as soon as it is ready. Return the summaries of the VMs that failed here.
+#
+def provision_unit(vcdata, yaml_data, yaml_section, index, entry, deplogfile, installer, install_futures, install_func=install_veeam_server):
+    (rc, deployed_vm, failures) = provision_entry(vcdata, yaml_data, yaml_section, index, entry, deplogfile)
+    if(rc != 0):
+        return failures
+    return queue_deployed_vms(vcdata, deployed_vm, entry, installer, install_futures, install_func, fresh=True)
 
 
-# install Veeam Backup & Replication Server
+# deploy one "veeam_install" entry. Return (rc, deployed VMs, summaries of a failed deployment).
 #
-def install_bkup_repl_serv(vcdata, veeam_serv):
+def provision_entry(vcdata, yaml_data, yaml_section, index, entry, deplogfile):
     mylogger = vcdata["mylogger"]
-    ps_file = "veeam_br_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_br_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
+    with trace_span(vcdata, "provision", unit=index, vm_count=entry.get("vm_count", 1)) as span:
+        (span["rc"], unit_vcdata) = deploy_unit(vcdata, yaml_data, yaml_section, index, entry, deplogfile)
+    if(span["rc"] != 0):
+        mylogger.warning(f"Error deploying {yaml_section} entry {index} on ESX {entry.get('esx')}")
+        return (1, [], [ {"vm_name": f"{yaml_section} entry {index}", "vm_ip": None, "rc": 1, "failed_step": "provision", "elapsed": span["duration"]} ])
 
-    mylogger.info('-'*15 + "Start installing Veeam Backup & Replication Server on server %s" % veeam_serv + '-'*15) 
+    for vm in unit_vcdata["deployed_vm"]:
+        mylogger.info("Successfully deployed virtual machine %s as Veeam Backup & Replication Server" % vm["vm_name"])
+    return (0, unit_vcdata["deployed_vm"], [])
 
-    veeam_licensefile = "c:\\veeam_soft\\veeam_license.lic"
-    vbr_sqlserv = "%s\\%s" % (veeam_serv_hostname, veeam_serv_sqlinst)   # veeam-serv1\veeamsql2016 
-    vbr_service_user = "%s\\%s" % (veeam_serv_hostname, veeam_serv_user) # veeam-serv1\Administrator 
 
-    cmd = ("$params = '/qn', '/i', \"c:\\veeam_soft\\backup\\Server.x64.msi\", 'ACCEPTEULA=\"1\"', 'ACCEPT_THIRDPARTY_LICENSES=\"1\"', "
-           f"'VBR_LICENSE_FILE=\"{veeam_licensefile}\"', 'VBR_SERVICE_USER=\"{vbr_service_user}\"', 'VBR_SERVICE_PASSWORD=\"{veeam_serv_pw}\"', "
-           f"'VBR_SQLSERVER_SERVER=\"{vbr_sqlserv}\"', '/L*V', '{ps_log}' \n"
-            "$process = Start-Process 'msiexec.exe' -ArgumentList $params -WindowStyle Hidden -Wait -PassThru \n"
-            "$process.ExitCode")
-    
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
+# queue each deployed VM for installation by install_func as soon as it is ready. A VM that is
+# not fresh keeps the steps of its checkpoint. Return the summaries of the VMs that failed here.
+#
+def queue_deployed_vms(vcdata, deployed_vm, entry, installer, install_futures, install_func=install_veeam_server, fresh=True):
+    failures = []
+    for vm in deployed_vm:
+        if is_cancelled(vcdata):
+            failures.append({"vm_name": vm["vm_name"], "vm_ip": None, "rc": 1, "failed_step": "lease lost", "elapsed": 0})
+            continue
+        server = wait_for_vm_ready(vcdata, vm["vm_name"])
+        if server is None:
+            failures.append({"vm_name": vm["vm_name"], "vm_ip": None, "rc": 1, "failed_step": "vm_ready", "elapsed": 0})
+            continue
+
+        server.update({"esx": vm.get("esx", entry.get("esx")), "datastore": vm.get("datastore", entry.get("datastore"))})
+        register_checkpoint_server(vcdata, server, fresh=fresh)
+        update_queue_depth(vcdata, "install", 1)
+        install_futures[installer.submit(run_queued, vcdata, "install", server["vm_ip"], time.time(), install_func, vcdata, server)] = server
+    return failures
 
-    for i in range(0,2):
-        rc = run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str)
-        if(rc == 0):
-            mylogger.info("Successfully install Veeam Backup & Replication Server on server %s" % veeam_serv)
-            break
-        else:
-            mylogger.warning("Error installing Veeam Backup & Replication Server on server %s" % veeam_serv)
-            if(i == 0): 
-                mylogger.warning("Re-run the Veeam Backup & Replication Server installation on server %s" % veeam_serv)
-                time.sleep(60)
-    
-    return rc
+
+# the summary of a finished install_veeam_server() future
+#
+def get_install_summary(mylogger, future, server):
+    try:
+        return future.result()
+    except Exception as exp:
+        mylogger.warning(f"Installing Veeam Backup & Replication on server {server['vm_ip']} caught an exception. Exception details: {exp}")
+        return {"vm_name": server.get("vm_name"), "vm_ip": server["vm_ip"], "rc": 1, "failed_step": "unknown", "elapsed": 0}
 
 
-# install Veeam Backup & Replication Console 
+# install Veeam Backup & Replication on servers that already exist, workers at a time
+#
+def install_servers(vcdata, veeam_servers, workers):
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="veeam-install") as executor:
+        futures = { executor.submit(install_veeam_server, vcdata, server): server for server in veeam_servers }
+        return [ get_install_summary(vcdata["mylogger"], future, futures[future]) for future in as_completed(futures) ]
+
+
+# deploy the "veeam_install" entries and install every VM as soon as it is ready, while the
+# next entries are still being deployed. Return the per-server summaries.
+#
+def run_install_pipeline(vcdata, yaml_data, yaml_section, units, deplogfile, workers, install_func=install_veeam_server):
+    mylogger = vcdata["mylogger"]
+    provision_workers = max(1, min(int(vcdata["options"].get("provision_workers", default_provision_workers)), len(units)))
+    mylogger.info(f"Pipeline: deploying {len(units)} {yaml_section} entries with {provision_workers} provisioning worker(s), "
+                  f"installing with {workers} worker(s)")
+
+    summaries = []
+    install_futures = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="veeam-install") as installer:
+        with ThreadPoolExecutor(max_workers=provision_workers, thread_name_prefix="veeam-provision") as provisioner:
+            provision_futures = []
+            for (index, entry) in enumerate(units):
+                unit_deplogfile = deplogfile if len(units) == 1 else f"{deplogfile}_{index}"
+                update_queue_depth(vcdata, "provision", 1)
+                provision_futures.append(provisioner.submit(run_queued, vcdata, "provision", index, time.time(), provision_unit,
+                                                            vcdata, yaml_data, yaml_section, index, entry, unit_deplogfile, installer, install_futures, install_func))
+            for future in as_completed(provision_futures):
+                try:
+                    summaries.extend(future.result())
+                except Exception as exp:
+                    mylogger.warning(f"Provisioning caught an exception. Exception details: {exp}")
+                    summaries.append({"vm_name": yaml_section, "vm_ip": None, "rc": 1, "failed_step": "provision", "elapsed": 0})
+
+        # every VM is queued once the provisioning stage is done
+        for future in as_completed(list(install_futures)):
+            summaries.append(get_install_summary(mylogger, future, install_futures[future]))
+
+    return summaries
+
+
+# shut a Veeam server down and wait until its VM is powered off: vm_operation reports no ip
+# address for it any more
 #
-def install_bkup_repl_console(vcdata, veeam_serv):
+def shutdown_veeam_server(vcdata, server):
     mylogger = vcdata["mylogger"]
-    ps_file = "veeam_brconsole_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_brconsole_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
+    veeam_serv = server["vm_ip"]
+    try:
+        rc = run_command("shutdown -s -t 5", get_connection(vcdata, veeam_serv), mylogger)
+    except Exception as exp:
+        mylogger.warning(f"Unable to establish connection to Veeam backup server {veeam_serv}. Exception details: {exp}")
+        rc = 1
+    drop_connection(vcdata, veeam_serv)
+    if(rc != 0):
+        return rc
 
-    mylogger.info('-'*15 + "Start installing Veeam Backup & Replication Console on server %s" % veeam_serv + '-'*15)
+    def vm_powered_off():
+        found = vm_operation.get_vm_ip(vc_name = vcdata["vcenter_name"], vc_user = vcdata["vcenter_user"], vc_pw = vcdata["vcenter_pw"],
+                                       vc_ssl_check = vcdata["ssl-check"], mylogger = mylogger, vm_list = [server["vm_name"]])
+        return not any(vm.get("vm_ip") for vm in found or [])
 
-    cmd = (f"$params = '/qn', '/i', \"c:\\veeam_soft\\backup\\Shell.x64.msi\", 'ACCEPTEULA=\"1\"', 'ACCEPT_THIRDPARTY_LICENSES=\"1\"', '/L*V', '{ps_log}' \n"
-            "$process = Start-Process 'msiexec.exe' -ArgumentList $params -WindowStyle Hidden -Wait -PassThru \n"
-            "$process.ExitCode")
+    return wait_until(mylogger, f"virtual machine {server['vm_name']} to power off", vm_powered_off, golden_poweroff_timeout, max_interval=10)
 
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
 
-    rc = run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str)
-    if(rc == 0):
-        mylogger.info("Successfully install Veeam Backup & Replication Console on server %s" % veeam_serv)
+# render the PowerShell script that adapts a clone of the golden VM to its own hostname. The
+# Veeam and SQL services of the golden VM log on as veeam-serv1\administrator and the Veeam
+# configuration names SQL server veeam-serv1; both follow the new hostname and the services
+# are restarted. Nothing changes on a clone that kept the golden hostname.
+#
+def render_clone_fixup():
+    account_pattern = ps_quote(f"{veeam_serv_hostname}\\*")
+    return ("$report = [ordered]@{ hostname = $env:COMPUTERNAME; services = @(); sql_server = $null } \n"
+            f"if ($env:COMPUTERNAME -ne {ps_quote(veeam_serv_hostname)}) {{ \n"
+            f"    $account = \"$env:COMPUTERNAME\\{veeam_serv_user}\" \n"
+            f"    foreach ($service in @(Get-CimInstance -ClassName Win32_Service | Where-Object {{ $_.StartName -like {account_pattern} }})) {{ \n"
+            f"        $null = Invoke-CimMethod -InputObject $service -MethodName Change -Arguments @{{ StartName = $account; StartPassword = {ps_quote(veeam_serv_pw)} }} \n"
+            "        $report.services += $service.Name \n"
+            "    } \n"
+            f"    $key = {ps_quote(veeam_maxsnapshots_reg['path'])} \n"
+            "    $sql = (Get-ItemProperty -Path $key -Name SqlServerName -ErrorAction SilentlyContinue).SqlServerName \n"
+            f"    if ($sql -like {ps_quote(veeam_serv_hostname + '*')}) {{ \n"
+            f"        $report.sql_server = $env:COMPUTERNAME + $sql.Substring({len(veeam_serv_hostname)}) \n"
+            "        Set-ItemProperty -Path $key -Name SqlServerName -Value $report.sql_server \n"
+            "    } \n"
+            f"    Restart-Service -Name {ps_quote(veeam_sql_service)} -Force \n"
+            "    Get-Service -Name 'Veeam*' | Where-Object { $_.StartType -eq 'Automatic' } | Restart-Service -Force \n"
+            "} \n"
+            "ConvertTo-Json -InputObject $report -Compress")
+
+
+# apply the per-instance fixups to a clone of the golden VM
+#
+def fixup_clone(vcdata, veeam_serv):
+    mylogger = vcdata["mylogger"]
+    results = []
+    if(run_powershell(vcdata, veeam_serv, render_clone_fixup(), timeout=services_ready_timeout, results=results) != 0):
+        mylogger.warning(f"Error: adapting the clone {veeam_serv} of the golden VM fails")
+        return 1
+    try:
+        report = json.loads('\n'.join(results))
+    except ValueError as exp:
+        mylogger.warning(f"Unable to parse the fixup report of server {veeam_serv}. Exception details: {exp}")
+        return 1
+
+    if(report["hostname"].lower() == veeam_serv_hostname.lower()):
+        mylogger.info(f"Clone {veeam_serv} kept hostname {report['hostname']}; no service account fixup needed")
     else:
-        mylogger.warning("Error installing Veeam Backup & Replication Console on server %s" % veeam_serv)
-    
-    return rc
+        mylogger.info(f"Clone {veeam_serv} is {report['hostname']}: service account of {', '.join(report['services']) or 'no service'} "
+                      f"and SQL server {report['sql_server']} follow the new hostname")
+    return wait_until(mylogger, f"Veeam services on server {veeam_serv}", lambda: veeam_services_running(vcdata, veeam_serv), services_ready_timeout)
 
 
-def install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi):
+# the per-instance steps of a clone of the golden VM: hostname fixups and a health check.
+# Return the per-server summary like install_veeam_server().
+#
+def prepare_clone(vcdata, server):
     mylogger = vcdata["mylogger"]
-    mylogger.info('-'*15 + "Start installing %s on server %s" % (service, veeam_serv) + '-'*15)
+    veeam_serv = server["vm_ip"]
+    summary = {"vm_name": server.get("vm_name"), "vm_ip": veeam_serv, "rc": 0, "failed_step": None, "elapsed": 0}
+    start_time = time.time()
+
+    with trace_span(vcdata, "server", server=veeam_serv, vm_name=server.get("vm_name")) as span:
+        mylogger.info(f"Start preparing clone {server.get('vm_name')} ({veeam_serv}) of the golden VM")
+        with trace_span(vcdata, "step", step="clone_fixup") as step_span:
+            step_span["rc"] = fixup_clone(vcdata, veeam_serv)
+            step_span["attempts"] = 1
+        if(step_span["rc"] != 0):
+            (summary["rc"], summary["failed_step"]) = (1, "clone fixup")
+        else:
+            with trace_span(vcdata, "step", step="verify") as step_span:
+                result = verify_veeam_server(vcdata, server)
+                failed = [ check for (check, (passed, details)) in result["checks"].items() if not passed ]
+                step_span.update({"rc": 1 if failed else 0, "attempts": 1})
+            if failed:
+                mylogger.warning(f"Clone {veeam_serv} fails the health check(s) {', '.join(failed)}")
+                (summary["rc"], summary["failed_step"]) = (1, "verify")
+        span["rc"] = summary["rc"]
+
+    drop_connection(vcdata, veeam_serv)
+    summary["elapsed"] = time.time() - start_time
+    if(summary["rc"] == 0):
+        for step in vcdata["install_plan"]:
+            record_checkpoint(vcdata, server, step["name"], "cloned")
+        mark_checkpoint_complete(vcdata, server)
+        mylogger.info(f"Successfully prepare Veeam Backup & Replication server {veeam_serv} from the golden VM")
+    return summary
+
+
+# golden image mode: deploy one VM of the first "veeam_install" entry, install and verify it,
+# shut it down and clone the remaining VMs of every entry from it. vm_operation has no
+# snapshot, template or power on call, so the powered off golden VM itself is the clone
+# source and stays off. With the "golden_extra_vm" option (the default) it is an extra VM
+# kept as the image and all vm_count VMs are cloned; without it, the golden VM counts as the
+# first VM of the first entry and has to be powered on by hand. Return the per-server
+# summaries, the golden VM's first.
+#
+def run_golden_image(vcdata, yaml_data, yaml_section, units, deplogfile, workers):
+    mylogger = vcdata["mylogger"]
+    mylogger.info("Golden image: installing one golden VM, then cloning the Veeam servers from it")
+
+    with trace_span(vcdata, "provision", unit="golden", vm_count=1) as span:
+        (span["rc"], unit_vcdata) = deploy_unit(vcdata, yaml_data, yaml_section, "golden", dict(units[0], vm_count=1), f"{deplogfile}_golden")
+    if(span["rc"] != 0):
+        return [ {"vm_name": "golden VM", "vm_ip": None, "rc": 1, "failed_step": "provision", "elapsed": span["duration"]} ]
+
+    vm = unit_vcdata["deployed_vm"][0]
+    server = wait_for_vm_ready(vcdata, vm["vm_name"])
+    if server is None:
+        return [ {"vm_name": vm["vm_name"], "vm_ip": None, "rc": 1, "failed_step": "vm_ready", "elapsed": 0} ]
+    server.update({"esx": vm.get("esx", units[0].get("esx")), "datastore": vm.get("datastore", units[0].get("datastore"))})
+    register_checkpoint_server(vcdata, server, fresh=True)
+
+    golden = install_veeam_server(vcdata, server)
+    if(golden["rc"] == 0):
+        result = verify_veeam_server(vcdata, server)
+        failed = [ check for (check, (passed, details)) in result["checks"].items() if not passed ]
+        if failed:
+            mylogger.warning(f"Golden VM {server['vm_name']} fails the health check(s) {', '.join(failed)}")
+            (golden["rc"], golden["failed_step"]) = (1, "verify")
+    if(golden["rc"] == 0 and shutdown_veeam_server(vcdata, server) != 0):
+        (golden["rc"], golden["failed_step"]) = (1, "shutdown")
+    if(golden["rc"] != 0):
+        mylogger.warning(f"Error: golden VM {server['vm_name']} is not usable. No Veeam server is cloned")
+        return [golden]
+
+    mark_checkpoint_complete(vcdata, server, golden=True)
+    golden["vm_name"] = f"{server['vm_name']} (golden image)"
+    clone_yaml = dict(yaml_data, VCenter=dict(yaml_data["VCenter"], snapshot_name=None))
+    clone_units = [ dict(entry, template=server["vm_name"]) for entry in units ]
+    if not vcdata["options"].get("golden_extra_vm", default_golden_extra_vm):
+        clone_units[0]["vm_count"] = int(units[0].get("vm_count", 1)) - 1
+        clone_units = [ entry for entry in clone_units if int(entry.get("vm_count", 1)) > 0 ]
+        mylogger.info(f"Golden VM {server['vm_name']} is the first Veeam server of {yaml_section} entry 0. Power it on to use it")
+    mylogger.info(f"Golden VM {server['vm_name']} is installed, verified and shut down. Cloning {sum(int(entry.get('vm_count', 1)) for entry in clone_units)} "
+                  f"Veeam server(s) from it")
+    if not clone_units:
+        return [golden]
+    return [golden] + run_install_pipeline(vcdata, clone_yaml, yaml_section, clone_units, deplogfile, workers, prepare_clone)
+
+
+# create the directories of the shared work queue. Every worker process gets its own id; the
+# leases it holds map task ids to their lease content.
+#
+def init_work_queue(vcdata, queue_dir, lease_ttl):
+    for subdir in queue_subdirs:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+    vcdata["queue"] = {"dir": queue_dir, "ttl": lease_ttl, "worker": f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}",
+                       "lock": threading.Lock(), "leases": {}, "cancel": {}, "stop": threading.Event()}
 
-    cmd = (f"$params = '/qn', '/i', \"{install_msi}\", 'ACCEPTEULA=\"1\"', 'ACCEPT_THIRDPARTY_LICENSES=\"1\"', '/L*V', '{ps_log}' \n"
-            "$process = Start-Process 'msiexec.exe' -ArgumentList $params -WindowStyle Hidden -Wait -PassThru \n"
-            "$process.ExitCode")
 
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
+def get_queue_file(vcdata, subdir, task_id, suffix=".json"):
+    return os.path.join(vcdata["queue"]["dir"], subdir, f"{task_id}{suffix}")
 
-    rc = run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str)
-    if(rc == 0):
-        mylogger.info("Successfully install %s on server %s" % (service, veeam_serv) )
-    else:
-        mylogger.warning("Error installing %s on server %s" % (service, veeam_serv) )
-    
-    return rc
 
+# read a JSON file of the work queue. Return None if it is gone or cannot be read.
+#
+def read_queue_file(path):
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
 
-def install_veeam_service_pkgs(vcdata, veeam_serv):
-    
-    # install Veeam Mount Service
-    ps_file = "veeam_mountserv_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_mountserv_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Mount Service"
-    install_msi = "c:\\veeam_soft\\packages\\VeeamMountService.msi"
-
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
 
-    # install Veeam Distribution Service
-    ps_file = "veeam_distribserv_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_distribserv_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Distribution Service"
-    install_msi = "c:\\veeam_soft\\packages\\VeeamDistributionSvc.msi"
+# write a JSON file of the work queue. The new content replaces the old file atomically.
+#
+def write_queue_file(path, data):
+    tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, 'w') as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+    os.replace(tmp_file, path)
 
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
 
-    # install Veeam Backup Transport 
-    ps_file = "veeam_transport_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_transport_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Backup Transport"
-    install_msi = "c:\\veeam_soft\\packages\\VeeamTransport.msi"
+# the ids of the tasks still in the queue, oldest first
+#
+def get_queued_tasks(vcdata):
+    tasks_dir = os.path.join(vcdata["queue"]["dir"], "tasks")
+    return sorted(name[:-len(".json")] for name in os.listdir(tasks_dir) if name.endswith(".json"))
 
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
 
-    # install Veeam Agent for Linux Redistributable
-    ps_file = "veeam_agtlnxredist_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_agtlnxredist_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Agent for Linux Redistributable"
-    install_msi = "c:\\veeam_soft\\packages\\VALRedist.msi"
+# take the lease of a task. The lease file is linked into place, which fails if it already
+# exists, also on NFS, so only one worker of all the controller hosts gets it. An expired lease
+# is taken over. Return True if this worker holds the lease now.
+#
+def take_lease(vcdata, task_id):
+    queue = vcdata["queue"]
+    lease_file = get_queue_file(vcdata, "leases", task_id, ".lease")
+    lease = {"worker": queue["worker"], "token": uuid.uuid4().hex, "heartbeat": time.time()}
+    tmp_file = f"{lease_file}.{lease['token']}.tmp"
+    with open(tmp_file, 'w') as fh:
+        json.dump(lease, fh)
+    try:
+        for attempt in range(2):
+            try:
+                os.link(tmp_file, lease_file)
+            except FileExistsError:
+                if(attempt == 0 and steal_expired_lease(vcdata, task_id, lease_file)):
+                    continue
+                return False
+            with queue["lock"]:
+                queue["leases"][task_id] = lease
+            return True
+        return False
+    finally:
+        os.remove(tmp_file)
 
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
 
-    # install Veeam Agent for Unix Redistributable
-    ps_file = "veeam_agtunxredist_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_agtunxredist_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Agent for Unix Redistributable"
-    install_msi = "c:\\veeam_soft\\packages\\VAURedist.msi"
+# remove the lease of a task whose worker stopped its heartbeat more than the lease ttl ago.
+# The lease is first renamed to a name of this worker: only one worker wins the rename, and
+# a lease renewed since it was read is put back. Return True if the expired lease is removed.
+#
+def steal_expired_lease(vcdata, task_id, lease_file):
+    queue = vcdata["queue"]
+    lease = read_queue_file(lease_file)
+    if(lease is None or time.time() - lease["heartbeat"] <= queue["ttl"]):
+        return False
 
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
+    stale_file = f"{lease_file}.{queue['worker']}.stale"
+    try:
+        os.rename(lease_file, stale_file)
+    except FileNotFoundError:
+        return False
+    try:
+        if(read_queue_file(stale_file) != lease):
+            try:
+                os.link(stale_file, lease_file)
+            except FileExistsError:
+                pass
+            return False
+    finally:
+        os.remove(stale_file)
 
-    # install Veeam Agent for Windows Redistributable
-    ps_file = "veeam_agtwinredist_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_agtwinredist_install.log"
-    ps_timeout = 1800
-    ps_success_str = "MainEngineThread is returning 0"
-    service = "Veeam Agent for Windows Redistributable"
-    install_msi = "c:\\veeam_soft\\packages\\VAWRedist.msi"
+    vcdata["mylogger"].warning(f"Lease of task {task_id} held by worker {lease['worker']} expired {time.time() - lease['heartbeat']:.0f} seconds ago. "
+                               f"Worker {queue['worker']} takes the task over")
+    return True
 
-    rc = install_service_pkgs(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str, service, install_msi)
-    if(rc != 0):
-        return rc
 
-    return 0
+# renew the leases of this worker. A lease another worker took over is dropped: that worker
+# continues the task, this one does not complete it.
+#
+def renew_leases(vcdata):
+    queue = vcdata["queue"]
+    with queue["lock"]:
+        leases = list(queue["leases"].items())
+    for (task_id, lease) in leases:
+        lease_file = get_queue_file(vcdata, "leases", task_id, ".lease")
+        current = read_queue_file(lease_file)
+        if(current is None or current["token"] != lease["token"]):
+            vcdata["mylogger"].warning(f"Worker {queue['worker']} lost the lease of task {task_id}"
+                                       + (f" to worker {current['worker']}" if current else ""))
+            with queue["lock"]:
+                queue["leases"].pop(task_id, None)
+                cancel = queue["cancel"].get(task_id)
+            if cancel is not None:
+                cancel.set()
+            continue
+        lease = dict(lease, heartbeat=time.time())
+        try:
+            write_queue_file(lease_file, lease)
+            with queue["lock"]:
+                if task_id in queue["leases"]:
+                    queue["leases"][task_id] = lease
+        except (IOError, OSError) as exp:
+            vcdata["mylogger"].warning(f"Renewing the lease of task {task_id} caught an exception. Exception details: {exp}")
 
 
-# install Veeam Patch version veeam_backup_11.0.1.1261_CumulativePatch20220302.exe
+# heartbeat thread: renew the leases of this worker four times per lease ttl until stopped
 #
-def install_patch(vcdata, veeam_serv):
-    mylogger = vcdata["mylogger"]
-    patch_file = "c:\\veeam_soft\\updates\\veeam_backup_11.0.1.1261_CumulativePatch20220302.exe"
-    ps_file = "veeam_patch_install.ps1"      # powershell file name
-    ps_log = "c:\\temp\\veeam_patch_install.log"
-    ps_timeout = 1800
-    ps_success_str = "Return value 0"
+def run_lease_heartbeat(vcdata):
+    queue = vcdata["queue"]
+    while not queue["stop"].is_set():
+        deadline = time.time() + queue["ttl"] / 4
+        while(not queue["stop"].is_set() and time.time() < deadline):
+            time.sleep(1)
+        if not queue["stop"].is_set():
+            renew_leases(vcdata)
 
-    mylogger.info('-'*10 + "Start installing Veeam Patch \"veeam_backup_11.0.1.1261_CumulativePatch20220302\" on server %s" % veeam_serv + '-'*10)
 
-    cmd = (f"$params = '/silent', '/noreboot', 'VBR_AUTO_UPGRADE=\"0\"', '/log', '{ps_log}' \n"
-           f"$process = Start-Process '{patch_file}' -ArgumentList $params -WindowStyle Hidden -Wait -PassThru \n"
-            "$process.ExitCode")
+def holds_lease(vcdata, task_id):
+    queue = vcdata["queue"]
+    with queue["lock"]:
+        return task_id in queue["leases"]
 
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
 
-    rc = run_veeam_install_ps(vcdata, veeam_serv, ps_file, ps_log, ps_timeout, ps_success_str)
-    if(rc == 0):
-        mylogger.info("Successfully install Veeam Patch \"veeam_backup_11.0.1.1261_CumulativePatch20220302\" on server %s" % veeam_serv)
-    else:
-        mylogger.warning("Error installing Veeam Patch \"veeam_backup_11.0.1.1261_CumulativePatch20220302\" on server %s" % veeam_serv)
+def release_lease(vcdata, task_id):
+    queue = vcdata["queue"]
+    with queue["lock"]:
+        lease = queue["leases"].pop(task_id, None)
+    lease_file = get_queue_file(vcdata, "leases", task_id, ".lease")
+    current = read_queue_file(lease_file)
+    if(lease is not None and current is not None and current["token"] == lease["token"]):
+        os.remove(lease_file)
 
-    return rc
 
+# lease the oldest task of the queue that no live worker holds. Return the task, or None.
+#
+def claim_next_task(vcdata):
+    for task_id in get_queued_tasks(vcdata):
+        if(holds_lease(vcdata, task_id) or not take_lease(vcdata, task_id)):
+            continue
+        # a task completed after it was listed is gone by now
+        queued_task = read_queue_file(get_queue_file(vcdata, "tasks", task_id))
+        if queued_task is None:
+            release_lease(vcdata, task_id)
+            continue
+        return queued_task
+    return None
 
-# For Veeam server, after installing patch, update the server components. After that, create a new registry value
+
+# record the result of a task in the "done" directory and remove it from the queue. The result
+# is written before the task and its lease are removed, so a finished task is never leased again.
 #
-def update_server_component(vcdata, veeam_serv):
-    mylogger = vcdata["mylogger"]
-    ps_file = "veeam_update_servcomponent.ps1"
-    ps_timeout = 1800
+def complete_task(vcdata, queued_task, summaries):
+    queue = vcdata["queue"]
+    rc = 0 if all(summary["rc"] == 0 for summary in summaries) else 1
+    write_queue_file(get_queue_file(vcdata, "done", queued_task["id"]),
+                     dict(queued_task, rc=rc, worker=queue["worker"], summaries=summaries, finished=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())))
+    os.remove(get_queue_file(vcdata, "tasks", queued_task["id"]))
+    release_lease(vcdata, queued_task["id"])
 
-    mylogger.info('-'*10 + "Start updating Veeam Backup & Replication server components" + '-'*10)
 
-    cmd = "shutdown -r -t 5"
-    try:
-        conn = Connection(veeam_serv, user=veeam_serv_user, connect_kwargs={"password": veeam_serv_pw}, connect_timeout=600)
-        rc = run_command(cmd, conn, mylogger, ps_timeout)
-        if(rc != 0):
-            mylogger.warning(f"Error: unable to reboot Veeam Backup & Replication server {veeam_serv}")
-    except Exception as exp:
-        mylogger.warning(f"Unable to establish connection to Veeam backup server {veeam_serv}. Exception details: {exp}")
-        rc = 1 
-    finally:
-        conn.close()
+# write one task per "veeam_install" entry, or per unfinished VM of the state file when
+# resuming, to the work queue. Return rc.
+#
+def start_enqueue_vbr(yamlfile, mylogger, cli_options=None):
+    yaml_section = "veeam_install"
+    options = get_install_options(yamlfile, mylogger)
+    options.update({ key: value for (key, value) in (cli_options or {}).items() if value is not None })
+
+    vcdata = {"mylogger": mylogger}
+    queue_dir = options.get("queue_dir", default_queue_dir)
+    init_work_queue(vcdata, queue_dir, options.get("lease_ttl", default_lease_ttl))
+    batch = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+    tasks = []
+    handed_off = {}
+    if options.get("resume"):
+        # a resumed VM is a task that is already deployed; its checkpoint moves to the task's state file
+        init_checkpoint_store(vcdata, options.get("state_file", default_state_file))
+        for (key, entry) in sorted(vcdata["checkpoint"]["servers"].items()):
+            if(entry.get("vm_name") and not entry.get("complete") and not entry.get("queued")):
+                queued_task = {"id": f"{batch}_{len(tasks):04d}", "entry": {"esx": entry.get("esx"), "datastore": entry.get("datastore")},
+                        "deployed": [ {"vm_name": entry["vm_name"], "esx": entry.get("esx"), "datastore": entry.get("datastore")} ]}
+                write_queue_file(get_queue_file(vcdata, "state", queued_task["id"]), {"servers": {key: entry}})
+                tasks.append(queued_task)
+                handed_off[key] = queued_task["id"]
+    else:
+        (rc, vc, yaml_data, units) = get_deploy_units(yamlfile, mylogger, yaml_section)
         if(rc != 0): return rc
+        tasks = [ {"id": f"{batch}_{index:04d}", "entry": entry, "deployed": None} for (index, entry) in enumerate(units) ]
 
-    time.sleep(300)
-    # reboot the VBR server for its Veeam powershell components to fully work
+    if not tasks:
+        mylogger.warning("Nothing to queue: no unfinished Veeam Backup & Replication Server to resume")
+        return 1
+    for queued_task in tasks:
+        queued_task["enqueued"] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        write_queue_file(get_queue_file(vcdata, "tasks", queued_task["id"]), queued_task)
+    if handed_off:
+        # the queue owns the handed off VMs now: a later resume from the state file leaves them alone
+        for (key, task_id) in handed_off.items():
+            vcdata["checkpoint"]["servers"][key]["queued"] = task_id
+        save_checkpoints(vcdata)
+    mylogger.info(f"Queued {len(tasks)} task(s) in {queue_dir}. Start one or more workers on it with \"-m worker\"")
+    return 0
 
-    cmd = ("$ProgressPreference = \"SilentlyContinue\" \n"
-           "Update-VBRServerComponent \n"
-           "New-ItemProperty -Path \"HKLM:\\SOFTWARE\\Veeam\\Veeam Backup and Replication\" -Name MaxSnapshotsPerDatastore -Value 100 -PropertyType DWord")
 
-    with open(f"/tmp/{ps_file}", "w") as fh:
-        fh.write(cmd)
-    time.sleep(5)
+# run one leased task: deploy its "veeam_install" entry and install the VMs on the shared
+# installer pool. The deployed VMs are recorded in the task first, so a worker that takes the
+# task over from a crashed one continues on them from the task's checkpoints instead of
+# deploying again. Return the per-server summaries.
+#
+def run_queue_task(vcdata, yaml_data, yaml_section, queued_task, deplogfile, installer):
+    mylogger = vcdata["mylogger"]
+    task_vcdata = dict(vcdata, options=dict(vcdata["options"], resume=bool(queued_task.get("deployed"))), cancel=threading.Event())
+    with vcdata["queue"]["lock"]:
+        vcdata["queue"]["cancel"][queued_task["id"]] = task_vcdata["cancel"]
+    init_checkpoint_store(task_vcdata, get_queue_file(vcdata, "state", queued_task["id"]))
+    entry = queued_task["entry"]
+
+    install_futures = {}
+    if queued_task.get("deployed"):
+        mylogger.info(f"Task {queued_task['id']} is already deployed. Continue installing on {', '.join(vm['vm_name'] for vm in queued_task['deployed'])}")
+        failures = queue_deployed_vms(task_vcdata, queued_task["deployed"], entry, installer, install_futures, fresh=False)
+    else:
+        (rc, deployed_vm, failures) = provision_entry(task_vcdata, yaml_data, yaml_section, queued_task["id"], entry, f"{deplogfile}_{queued_task['id']}")
+        if(rc == 0):
+            queued_task["deployed"] = [ {"vm_name": vm["vm_name"], "esx": vm.get("esx", entry.get("esx")), "datastore": vm.get("datastore", entry.get("datastore"))}
+                                 for vm in deployed_vm ]
+            write_queue_file(get_queue_file(vcdata, "tasks", queued_task["id"]), queued_task)
+            failures = queue_deployed_vms(task_vcdata, queued_task["deployed"], entry, installer, install_futures, fresh=True)
 
+    summaries = failures + [ get_install_summary(mylogger, future, install_futures[future]) for future in as_completed(list(install_futures)) ]
+    with vcdata["queue"]["lock"]:
+        vcdata["queue"]["cancel"].pop(queued_task["id"], None)
+    return summaries
+
+
+# worker loop: lease tasks, provision_workers at a time, and install their VMs, workers at a
+# time, until the queue is empty. Tasks leased by live workers are waited for, so a task whose
+# worker dies is taken over once its lease expires. Return the per-server summaries.
+#
+def run_queue_worker(vcdata, yaml_data, yaml_section, deplogfile, workers):
+    mylogger = vcdata["mylogger"]
+    queue = vcdata["queue"]
+    provision_workers = max(1, int(vcdata["options"].get("provision_workers", default_provision_workers)))
+    mylogger.info(f"Worker {queue['worker']} takes tasks from {queue['dir']}: {provision_workers} task(s) at a time, "
+                  f"installing with {workers} worker(s)")
+
+    heartbeat = threading.Thread(target=run_lease_heartbeat, args=(vcdata,), name="veeam-heartbeat", daemon=True)
+    heartbeat.start()
+    summaries = []
+    running = {}
     try:
-        conn = Connection(veeam_serv, user=veeam_serv_user, connect_kwargs={"password": veeam_serv_pw}, connect_timeout=600)
-        conn.put(f"/tmp/{ps_file}", f"/c:/temp/{ps_file}")
-    except Exception as exp:
-        mylogger.warning(f"Uploading file /tmp/{ps_file} to server {veeam_serv} directory c:\\temp caught an exception. Exception details: {exp}")
-        conn.close()
-        return 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="veeam-install") as installer:
+            with ThreadPoolExecutor(max_workers=provision_workers, thread_name_prefix="veeam-task") as executor:
+                while True:
+                    while len(running) < provision_workers:
+                        queued_task = claim_next_task(vcdata)
+                        if queued_task is None:
+                            break
+                        mylogger.info(f"Worker {queue['worker']} leased task {queued_task['id']}")
+                        running[executor.submit(run_queue_task, vcdata, yaml_data, yaml_section, queued_task, deplogfile, installer)] = queued_task
+
+                    finished = [ future for future in running if future.done() ]
+                    for future in finished:
+                        queued_task = running.pop(future)
+                        try:
+                            task_summaries = future.result()
+                        except Exception as exp:
+                            mylogger.warning(f"Task {queued_task['id']} caught an exception. Exception details: {exp}")
+                            task_summaries = [ {"vm_name": f"task {queued_task['id']}", "vm_ip": None, "rc": 1, "failed_step": "unknown", "elapsed": 0} ]
+                        summaries.extend(task_summaries)
+                        if holds_lease(vcdata, queued_task["id"]):
+                            complete_task(vcdata, queued_task, task_summaries)
+                        else:
+                            mylogger.warning(f"Task {queued_task['id']} was taken over by another worker. Its result is left to that worker")
+
+                    if(not running and not get_queued_tasks(vcdata)):
+                        break
+                    if not finished:
+                        time.sleep(queue_poll_interval if not running else 1)
+    finally:
+        queue["stop"].set()
+        heartbeat.join()
+        for task_id in list(queue["leases"]):
+            release_lease(vcdata, task_id)
+    return summaries
 
-    results = []
-    cmd = f"powershell -File c:\\temp\\{ps_file}"
 
-    rc = run_command(cmd, conn, mylogger, ps_timeout, results)
-    conn.close()
+# worker mode: take tasks from the shared work queue until it is empty. Any number of workers,
+# also on other controller hosts sharing the queue directory, may run at the same time.
+#
+def start_worker_vbr(yamlfile, mylogger, deplogfile, cli_options=None):
+    yaml_section = "veeam_install"
+    options = get_install_options(yamlfile, mylogger)
+    options.update({ key: value for (key, value) in (cli_options or {}).items() if value is not None })
+    install_plan = get_install_plan(yamlfile, mylogger, options)
+    if install_plan is None: return 1
+
+    yaml_data = load_yaml_file(yamlfile, mylogger)
+    if(not isinstance(yaml_data, dict) or not isinstance(yaml_data.get("VCenter"), dict)):
+        mylogger.warning(f"YAML file {yamlfile} has no VCenter section")
+        return 1
+    if options.get("golden_image"):
+        mylogger.warning("Golden image mode is not supported by queue workers. Every task is installed")
 
-    res = '\n'.join(results)
-    if(rc != 0):
-        mylogger.warning(f"Error: running PowerShell c:\temp\{ps_file} on server {veeam_serv} fails")
-        return rc
-    else: 
-        mylogger.info(f"Successfully update Veeam Backup & Replication server components for {veeam_serv}")
-        mylogger.info(f"Successfully update Veeam Backup & Replication server {veeam_serv} registry.")
-        return 0
+    vcdata = dict(yaml_data["VCenter"])
+    init_install_run(vcdata, mylogger, options, install_plan)
+    init_pipeline(vcdata)
+    init_work_queue(vcdata, options.get("queue_dir", default_queue_dir), int(options.get("lease_ttl", default_lease_ttl)))
+    workers = max(1, int(options.get("workers", default_install_workers)))
+    summaries = run_queue_worker(vcdata, yaml_data, yaml_section, deplogfile, workers)
+    return finish_install_run(vcdata, summaries)
 
 
 # start installing Veeam backup and replication
 #
-def start_install_vbr(yamlfile, mylogger, deplogfile):
+def start_install_vbr(yamlfile, mylogger, deplogfile, cli_options=None):
     yaml_section = "veeam_install"
     vcdata = {}
 
-    (rc, vcdata) = vm_operation.create_from_yaml(yamlfile, yaml_section, mylogger, deplogfile)
-    if(rc != 0): return rc
+    options = get_install_options(yamlfile, mylogger)
+    # command line options override the YAML "install_options" values
+    options.update({ key: value for (key, value) in (cli_options or {}).items() if value is not None })
+    install_plan = get_install_plan(yamlfile, mylogger, options)
+    if install_plan is None: return 1
+
+    units = None
+    entries = []
+    if options.get("resume"):
+        (rc, vcdata, deployed_vm) = get_resume_vms(yamlfile, mylogger, options)
+        if(rc != 0): return rc
+        entries = get_deploy_units(yamlfile, mylogger, yaml_section)[3]
+    elif(options.get("golden_image", default_golden_image) or options.get("pipeline", default_pipeline)):
+        (rc, vcdata, yaml_data, units) = get_deploy_units(yamlfile, mylogger, yaml_section)
+        if(rc != 0): return rc
+    else:
+        (rc, vcdata) = vm_operation.create_from_yaml(yamlfile, yaml_section, mylogger, deplogfile)
+        if(rc != 0): return rc
+        entries = get_deploy_units(yamlfile, mylogger, yaml_section)[3]
+
+        deployed_vm = [ vm["vm_name"] for vm in vcdata["deployed_vm"] ]
+        mylogger.info("Successfully deployed virtual machine %s as Veeam Backup & Replication Server" % ', '.join(deployed_vm))
+
+    init_install_run(vcdata, mylogger, options, install_plan)
+    init_checkpoint_store(vcdata, options.get("state_file", default_state_file))
 
+    if units is not None:
+        init_pipeline(vcdata)
+        vm_count = sum(int(entry.get("vm_count", 1)) for entry in units)
+        workers = max(1, min(int(options.get("workers", default_install_workers)), vm_count))
+        if options.get("golden_image", default_golden_image):
+            summaries = run_golden_image(vcdata, yaml_data, yaml_section, units, deplogfile, workers)
+        else:
+            summaries = run_install_pipeline(vcdata, yaml_data, yaml_section, units, deplogfile, workers)
+    else:
+        veeam_servs = ', '.join(deployed_vm)
+
+        # get deployed veeam servers ip addresses
+        veeam_servers = vm_operation.get_vm_ip(vc_name = vcdata["vcenter_name"], vc_user = vcdata["vcenter_user"], vc_pw = vcdata["vcenter_pw"],
+                                               vc_ssl_check = vcdata["ssl-check"], mylogger = mylogger, vm_list = deployed_vm)
+        if not veeam_servers:
+            mylogger.warning("Unable to get the ip address of Veeam Backup & Replication Server %s" % veeam_servs)
+            return 1
+
+        for server in veeam_servers:
+            server.update(get_server_placement(vcdata, server, entries))
+            register_checkpoint_server(vcdata, server, fresh=not options.get("resume"))
+
+        workers = max(1, min(int(options.get("workers", default_install_workers)), len(veeam_servers)))
+        mylogger.info(f"Installing Veeam Backup & Replication on {len(veeam_servers)} server(s) with {workers} concurrent worker(s)")
+        summaries = install_servers(vcdata, veeam_servers, workers)
+
+    return finish_install_run(vcdata, summaries)
+
+
+# set up the shared state of an install run: connections, metrics, admission and run history
+#
+def init_install_run(vcdata, mylogger, options, install_plan):
     vcdata["mylogger"] = mylogger
+    vcdata["options"] = options
+    vcdata["install_plan"] = install_plan
+    init_run_dirs(vcdata)
+    init_ssh_pool(vcdata)
+    init_metrics(vcdata, options.get("metrics_file", options["outlogfile"] + '_metrics.jsonl'), options.get("prom_file"))
+    init_admission(vcdata)
+    init_run_history(vcdata, options.get("history_db", default_history_db), options.get("veeam_version") or get_veeam_version(install_plan))
 
-    deployed_vm = [ vm["vm_name"] for vm in vcdata["deployed_vm"] ]
-    veeam_servs = ', '.join(deployed_vm)
-    mylogger.info("Successfully deployed virtual machine %s as Veeam Backup & Replication Server" % veeam_servs)
-     
-    # get deployed veeam servers ip addresses
-    veeam_servers = vm_operation.get_vm_ip(vc_name = vcdata["vcenter_name"], vc_user = vcdata["vcenter_user"], vc_pw = vcdata["vcenter_pw"], 
-                                           vc_ssl_check = vcdata["ssl-check"], mylogger = mylogger, vm_list = deployed_vm)
+
+# log the summaries and statistics of an install run and close its files. Return the run's rc.
+#
+def finish_install_run(vcdata, summaries):
+    mylogger = vcdata["mylogger"]
+    log_install_summary(mylogger, summaries)
+    log_ssh_pool_stats(vcdata)
+    log_metrics_summary(vcdata)
+    log_pipeline_summary(vcdata)
+    log_admission_summary(vcdata)
+    log_slow_steps(vcdata)
+    record_run_history(vcdata)
+    close_run_history(vcdata)
+    write_prometheus_textfile(vcdata)
+    close_metrics(vcdata)
 
     return_rc = 0
-    for server in veeam_servers:
-        veeam_serv = server["vm_ip"]
+    for summary in summaries:
+        if(summary["rc"] != 0):
+            return_rc = summary["rc"]
 
-        mylogger.info("Start installing Veeam Backup & Replication on server %s" % veeam_serv)
-        rc = install_bkup_catalog(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
+    mark_local_run_finished(vcdata, return_rc)
+    return return_rc
 
-        rc = install_bkup_repl_serv(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
+# logging filter that adds the VM name, Veeam server and install plan step of the current span
+# to a log record. It runs in the thread that logs, where the span is known.
+#
+def add_log_context(record):
+    span = trace_context.get()
+    (record.vm_name, record.server, record.step) = (span.get("vm_name"), span["server"], span["step"]) if span else (None, None, None)
+    if(record.vm_name == record.server):    # a server given by its address only
+        record.vm_name = None
+    record.log_context = ' '.join(str(value) for value in (record.vm_name, record.server, record.step) if value) or '-'
+    return True
 
-        rc = install_bkup_repl_console(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
-  
-        rc = install_veeam_service_pkgs(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
 
-        rc = install_patch(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
- 
-        rc = update_server_component(vcdata, veeam_serv)
-        if(rc != 0):
-            return_rc = rc
-            continue
+# one JSON object per log record, with the VM name, server and step as fields
+#
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": f"{self.formatTime(record, log_date_format)}.{int(record.msecs):03d}", "level": record.levelname,
+                 "thread": record.threadName, "function": record.funcName, "vm_name": getattr(record, "vm_name", None), "server": getattr(record, "server", None),
+                 "step": getattr(record, "step", None), "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+# writes the records of every Veeam server to a log file of its own, <outlogfile>_<vm name>_<server ip>.log,
+# or <outlogfile>_<server ip>.log while the VM name is not known. The files are opened on the first
+# record of their server.
+#
+class ServerLogHandler(logging.Handler):
+    def __init__(self, outlogfile, level=logging.NOTSET):
+        super().__init__(level)
+        self.outlogfile = outlogfile
+        self.files = {}
+
+    def emit(self, record):
+        server = getattr(record, "server", None)
+        if not server:
+            return
+        if server not in self.files:
+            vm_name = getattr(record, "vm_name", None)
+            self.files[server] = logging.FileHandler(f"{self.outlogfile}_{vm_name}_{server}.log" if vm_name else f"{self.outlogfile}_{server}.log")
+            self.files[server].setFormatter(self.formatter)
+        self.files[server].emit(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        super().close()
+
+
+# configure the logger. The install threads only queue their records; a listener thread
+# writes them to the console, to outlogfile and to the per-server log files.
+# Return (logger, listener).
+#
+def setup_logging(name, outlogfile, loglevel, log_format="text", console=True):
+    formatter = logging.Formatter(log_format_text, datefmt=log_date_format)
+    file_formatter = JsonLogFormatter() if log_format == "json" else formatter
+
+    handlers = [logging.FileHandler(outlogfile), ServerLogHandler(outlogfile)]
+    for handler in handlers:
+        handler.setFormatter(file_formatter)
+    if console:
+        handlers.append(logging.StreamHandler())
+        handlers[-1].setFormatter(formatter)
+    for handler in handlers:
+        handler.setLevel(loglevel)
+
+    queue_handle = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handle.addFilter(add_log_context)
+
+    mylogger = logging.getLogger(name)
+    mylogger.setLevel(loglevel)
+    mylogger.addHandler(queue_handle)
+    mylogger.propagate = False
 
-        mylogger.info("Successfully complete Veeam Backup & Replication installation on server %s" % veeam_serv)
+    listener = logging.handlers.QueueListener(queue_handle.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return (mylogger, listener)
+
+
+# write the queued records and close the log files
+#
+def stop_logging(mylogger, listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    for handler in list(mylogger.handlers):
+        mylogger.removeHandler(handler)
 
-    return return_rc
 
 def main(argv):
     parser = argparse.ArgumentParser()
@@ -491,6 +3568,21 @@ def main(argv):
     parser.add_argument('-yf', '--yamlfile', required=True, help='YAML file', dest='yamlfile', type=str)
     parser.add_argument('-lg', '--loglevel', required=False, help='Log Level. Default is INFO', dest='loglevel', type=str)
     parser.add_argument('-of', '--outlogfile', required=False, help='Output log file', dest='outlogfile', type=str)
+    parser.add_argument('-w', '--workers', required=False, help='Number of Veeam servers installed concurrently. Overrides "install_options: workers" in the YAML file. Default is %d' % default_install_workers, dest='workers', type=int)
+    parser.add_argument('-sf', '--state-file', required=False, help='State file of the completed install steps per server. Default is %s' % default_state_file, dest='state_file', type=str)
+    parser.add_argument('-r', '--resume', required=False, action='store_true', default=None, help='Resume the installation on the existing VMs of the state file instead of deploying new VMs', dest='resume')
+    parser.add_argument('-mf', '--metrics-file', required=False, help='JSON-lines file of the timing spans. Default is <outlogfile>_metrics.jsonl', dest='metrics_file', type=str)
+    parser.add_argument('-pf', '--prom-file', required=False, help='Prometheus textfile to export the step durations to', dest='prom_file', type=str)
+    parser.add_argument('-sw', '--stall-window', required=False, help='Abort an installer whose log does not grow for this many seconds. Default is %d' % default_stall_window, dest='stall_window', type=int)
+    parser.add_argument('-hd', '--history-db', required=False, help='SQLite run history the step timeouts and stall windows are learned from. Default is %s' % default_history_db, dest='history_db', type=str)
+    parser.add_argument('-lf', '--log-format', required=False, default='text', choices=log_formats, help='Format of the log files: text or one JSON object per line. Default is text', dest='log_format', type=str)
+    parser.add_argument('-g', '--golden-image', required=False, action='store_true', default=None, help='Install one golden VM and clone the Veeam servers from it', dest='golden_image')
+    parser.add_argument('-m', '--mode', required=False, default='install', choices=['install', 'verify', 'enqueue', 'worker'],
+                        help='install: deploy and install Veeam servers. verify: check the health of installed Veeam servers. enqueue: queue the "veeam_install" entries '
+                             '(with -r the unfinished servers of the state file) in the shared work queue. worker: install the queued tasks. Default is install', dest='mode', type=str)
+    parser.add_argument('-q', '--queue-dir', required=False, help='Shared work queue directory of the enqueue and worker modes. Default is %s' % default_queue_dir, dest='queue_dir', type=str)
+    parser.add_argument('-H', '--hosts', required=False, help='Comma separated Veeam servers to verify. Default is every VM deployed from the veeam_install entries of the YAML file', dest='hosts', type=str)
+    parser.add_argument('-lv', '--log-verify', required=False, choices=['remote', 'local'], help='Verify installer logs on the Veeam server (remote) or download them first (local). Default is %s' % default_log_verify, dest='log_verify', type=str)
 
     args = parser.parse_args()
     yamlfile = args.yamlfile
@@ -513,28 +3605,28 @@ def main(argv):
 
     deplogfile = outlogfile + '_dep'
 
-    # configure logger and logging level
-    mylogger = logging.getLogger(__name__)
-    mylogger.setLevel(loglevel)
-
-    file_handle = logging.FileHandler(outlogfile)
-    file_handle.setLevel(loglevel)
+    # configure logger and logging level. Every Veeam server also gets its own log file <outlogfile>_<vm name>_<server ip>.log
+    (mylogger, listener) = setup_logging(__name__, outlogfile, loglevel, args.log_format)
 
-    stream_handle = logging.StreamHandler()
-    stream_handle.setLevel(loglevel)
-
-    formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s {%(module)s} [%(funcName)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    file_handle.setFormatter(formatter)
-    stream_handle.setFormatter(formatter)
-    mylogger.addHandler(file_handle)
-    mylogger.addHandler(stream_handle)
-
-    mylogger.propagate = False
-
-    # start operation
-    mylogger.info("Start installing Veeam backup and replication server")
-
-    rc = start_install_vbr(yamlfile, mylogger, deplogfile)
+    cli_options = {"outlogfile": outlogfile, "workers": args.workers, "log_verify": args.log_verify, "state_file": args.state_file,
+                   "resume": args.resume, "metrics_file": args.metrics_file, "prom_file": args.prom_file, "stall_window": args.stall_window,
+                   "history_db": args.history_db, "golden_image": args.golden_image, "queue_dir": args.queue_dir}
+    try:
+        if(args.mode == "verify"):
+            mylogger.info("Start verifying Veeam backup and replication servers")
+            cli_options["hosts"] = [ host.strip() for host in args.hosts.split(',') if host.strip() ] if args.hosts else None
+            rc = start_verify_vbr(yamlfile, mylogger, cli_options)
+        elif(args.mode == "enqueue"):
+            rc = start_enqueue_vbr(yamlfile, mylogger, cli_options)
+        elif(args.mode == "worker"):
+            mylogger.info("Start installing Veeam backup and replication servers of the work queue")
+            rc = start_worker_vbr(yamlfile, mylogger, deplogfile, cli_options)
+        else:
+            # start operation
+            mylogger.info("Start installing Veeam backup and replication server")
+            rc = start_install_vbr(yamlfile, mylogger, deplogfile, cli_options)
+    finally:
+        stop_logging(mylogger, listener)
     return rc
 
 if __name__ == "__main__":
@@ -0,0 +1,1004 @@
+# 2022 Pure Storage Portfolio Solutions Team
+# This python3 script runs the Veeam installation of veeam_install.py against
+# simulated Veeam servers, so that the orchestration can be measured and
+# regression-tested on any Linux box without a vCenter or Windows VMs.
+# It replaces:
+#   fabric.Connection            by SimConnection: put/get/run with configurable
+#                                latency, failure injection and synthetic utf-8/
+#                                utf-16 installer logs
+#   vm_operation.create_from_yaml
+#   vm_operation.get_vm_ip       by simulated VM deployment
+# Simulated time runs faster than real time by the factor given with "--scale".
+# All timers of veeam_install.py, including its metrics, run on the simulated clock.
+# To get help menu of this script, please run "python3 veeam_sim.py -h"
+#
+
+import sys
+import os
+import io
+import re
+import json
+import time
+import types
+import base64
+import random
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import contextlib
+import zipfile
+import fnmatch
+import hashlib
+
+real_time = time
+
+
+# simulated clock: time passes "scale" times faster than real time. Everything else
+# is taken from the time module, so the clock can replace it inside veeam_install.
+#
+class SimClock:
+    def __init__(self, scale):
+        self.scale = scale
+        self.real_start = real_time.time()
+        self.sim_start = self.real_start
+
+    def time(self):
+        return self.sim_start + (real_time.time() - self.real_start) * self.scale
+
+    def sleep(self, seconds):
+        if(seconds > 0):
+            real_time.sleep(seconds / self.scale)
+
+    def sleep_until(self, deadline):
+        self.sleep(deadline - self.time())
+
+    def __getattr__(self, name):
+        return getattr(real_time, name)
+
+
+# default simulated durations in seconds
+sim_defaults = {"connect": 2.0, "put": 0.5, "get": 0.5, "run": 1.0, "clone": 300.0, "boot": 60.0, "bandwidth": 20e6, "hash_rate": 400e6, "reboot": 90.0, "stall_hang": 3600.0, "service_restart": 30.0, "fail_codes": [1603],
+                "install": {"VeeamBackupCatalog64.msi": 60, "Server.x64.msi": 600, "Shell.x64.msi": 180,
+                            "veeam_backup_11.0.1.1261_CumulativePatch20220302.exe": 300, "Update-VBRServerComponent": 120},
+                "install_default": 30,
+                # installers contending for the I/O of their datastore: above datastore_slots at once, every one of them
+                # slows down by (running / datastore_slots) ** datastore_thrash
+                "heavy": ["Server.x64.msi", "veeam_backup_11.0.1.1261_CumulativePatch20220302.exe", "Update-VBRServerComponent"],
+                "datastore_slots": 2, "datastore_thrash": 1.5}
+
+# Windows programs registered by the simulated installers, by installer file name
+sim_products = {"VeeamBackupCatalog64.msi": "Veeam Backup Catalog", "Server.x64.msi": "Veeam Backup & Replication Server",
+                "Shell.x64.msi": "Veeam Backup & Replication Console", "VeeamMountService.msi": "Veeam Mount Service",
+                "VeeamDistributionSvc.msi": "Veeam Distribution Service", "VeeamTransport.msi": "Veeam Backup Transport",
+                "VALRedist.msi": "Veeam Agent for Linux Redistributable", "VAURedist.msi": "Veeam Agent for Unix Redistributable",
+                "VAWRedist.msi": "Veeam Agent for Microsoft Windows Redistributable"}
+
+# version of the Veeam backup service after a successful installer run
+sim_versions = {"Server.x64.msi": "11.0.0.837", "veeam_backup_11.0.1.1261_CumulativePatch20220302.exe": "11.0.1.1261"}
+# Windows Installer errors that end an msi run before its first action
+sim_msi_errors = {1618: "Another installation is already in progress. Complete that installation before proceeding with this install.",
+                  1638: "Another version of this product is already installed. Installation of this version cannot continue."}
+# automatic Veeam services of an installed Veeam Backup & Replication Server
+sim_services = ["VeeamBackupSvc", "VeeamBrokerSvc", "VeeamCatalogSvc", "VeeamCloudSvc", "VeeamMountSvc", "VeeamTransportSvc"]
+
+
+def sim_path(path):
+    return path.replace('\\', '/').lstrip('/').lower()
+
+
+# one simulated Veeam server: its file system, installed programs, registry values and boot state
+#
+class SimHost:
+    def __init__(self, sim, name, ip):
+        self.sim = sim
+        self.name = name
+        self.ip = ip
+        self.lock = threading.RLock()
+        self.files = {}
+        self.dirs = set()
+        self.mtimes = {}
+        self.products = []
+        self.registry = {}
+        self.processes = {}
+        self.boot_count = 1
+        self.datastore = None
+        self.version = None
+        self.hostname = veeam_install.veeam_serv_hostname
+        self.stopped_services = set()
+        self.boot_time = sim.clock.time() + sim.config["boot"]
+        self.down_until = self.boot_time
+
+    def is_up(self):
+        return self.sim.clock.time() >= self.down_until
+
+    def reboot(self):
+        with self.lock:
+            self.down_until = self.sim.clock.time() + 5 + self.sim.config["reboot"]
+            self.boot_count += 1
+            self.boot_time = self.down_until
+
+    def shutdown(self):
+        with self.lock:
+            self.down_until = float("inf")
+
+    # take over the installed state of a powered off golden VM
+    def clone_from(self, template):
+        with template.lock:
+            (self.files, self.dirs, self.mtimes) = (dict(template.files), set(template.dirs), dict(template.mtimes))
+            (self.products, self.registry, self.version) = (list(template.products), dict(template.registry), template.version)
+
+    def write_file(self, path, data):
+        with self.lock:
+            self.files[sim_path(path)] = data
+            self.mtimes[sim_path(path)] = self.sim.clock.time()
+
+    # the newest file matching a wildcard path
+    def find_newest(self, pattern):
+        with self.lock:
+            found = [ path for path in self.files if fnmatch.fnmatch(path, sim_path(pattern)) ]
+            return max(found, key=lambda path: self.mtimes[path]) if found else None
+
+    # remove a file or a directory tree
+    def remove_file(self, path):
+        with self.lock:
+            for name in [ name for name in self.files if name == sim_path(path) or name.startswith(sim_path(path) + '/') ]:
+                self.files.pop(name)
+                self.mtimes.pop(name, None)
+            self.dirs = { name for name in self.dirs if not(name == sim_path(path) or name.startswith(sim_path(path) + '/')) }
+
+    def read_file(self, path):
+        with self.lock:
+            if sim_path(path) not in self.files:
+                raise FileNotFoundError(f"No such file: {path}")
+            return self.files[sim_path(path)]
+
+
+class SimResult:
+    def __init__(self, stdout="", stderr="", exited=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exited = exited
+        self.return_code = exited
+
+
+class SimTransport:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def active(self):
+        return self.conn.is_connected
+
+    def is_active(self):
+        return self.conn.is_connected
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class SimStat:
+    def __init__(self, size):
+        self.st_size = size
+
+
+# file of a simulated sftp session. Writes go straight to the simulated server, at the
+# bandwidth of one sftp stream, so that several streams can write one file.
+#
+class SimFile:
+    def __init__(self, sim, host, path, mode):
+        (self.sim, self.host, self.path, self.pos, self.closed) = (sim, host, path, 0, False)
+        if('w' in mode):
+            host.write_file(path, b'')
+        else:
+            host.read_file(path)
+        if('a' in mode):
+            self.pos = len(host.read_file(path))
+
+    def read(self, size=-1):
+        data = self.host.read_file(self.path)
+        end = len(data) if(size is None or size < 0) else self.pos + size
+        chunk = data[self.pos:end]
+        self.pos += len(chunk)
+        return chunk
+
+    def write(self, chunk):
+        with self.host.lock:
+            data = self.host.read_file(self.path)
+            if not isinstance(data, bytearray):
+                data = bytearray(data)
+            data[len(data):] = bytes(max(0, self.pos - len(data)))
+            data[self.pos:self.pos + len(chunk)] = chunk
+            self.host.write_file(self.path, data)
+        self.pos += len(chunk)
+        self.sim.clock.sleep(len(chunk) / self.sim.config["bandwidth"])
+        return len(chunk)
+
+    def truncate(self, size):
+        with self.host.lock:
+            data = self.host.read_file(self.path)[:size]
+            self.host.write_file(self.path, data + bytes(size - len(data)))
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.pos = offset if(whence == os.SEEK_SET) else (self.pos + offset if(whence == os.SEEK_CUR) else len(self.host.read_file(self.path)) + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SimSftp:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def stat(self, path):
+        self.conn.check()
+        if sim_path(path) in self.conn.host.dirs:
+            return SimStat(0)
+        return SimStat(len(self.conn.host.read_file(path)))
+
+    def mkdir(self, path, mode=0o777):
+        self.conn.check()
+        with self.conn.host.lock:
+            self.conn.host.dirs.add(sim_path(path))
+
+    def open(self, path, mode='r', bufsize=-1):
+        self.conn.check()
+        return SimFile(self.conn.sim, self.conn.host, path, mode)
+
+    def close(self):
+        pass
+
+
+# stand-in for fabric.Connection
+#
+class SimConnection:
+    def __init__(self, host, user=None, connect_kwargs=None, connect_timeout=None, **kwargs):
+        self.sim = active_sim
+        self.host = self.sim.hosts_by_ip[host]
+        self.connected = False
+        self.boot_count = None
+        self.transport = SimTransport(self)
+        self.client = types.SimpleNamespace(open_sftp=self.sftp)
+
+    @property
+    def is_connected(self):
+        return self.connected and self.host.is_up() and self.boot_count == self.host.boot_count
+
+    def open(self):
+        if not self.host.is_up():
+            raise ConnectionRefusedError(f"[Errno 111] Connection refused: {self.host.ip}")
+        self.sim.count("connect")
+        self.sim.delay("connect")
+        self.sim.maybe_fail("connect")
+        self.connected = True
+        self.boot_count = self.host.boot_count
+
+    def close(self):
+        self.connected = False
+
+    def check(self):
+        if not self.is_connected:
+            if(self.connected and not self.host.is_up()):
+                raise EOFError("Connection closed by the remote host")
+            self.open()
+
+    def sftp(self):
+        return SimSftp(self)
+
+    def put(self, local, remote):
+        self.check()
+        self.sim.count("put")
+        self.sim.delay("put")
+        self.sim.maybe_fail("put")
+        if hasattr(local, "read"):
+            data = local.read()
+        else:
+            with open(local, 'rb') as fh:
+                data = fh.read()
+        self.host.write_file(remote, data if isinstance(data, bytes) else data.encode())
+
+    def get(self, remote, local):
+        self.check()
+        self.sim.count("get")
+        self.sim.delay("get")
+        self.sim.maybe_fail("get")
+        data = self.host.read_file(remote)
+        if hasattr(local, "write"):
+            local.write(data)
+        else:
+            with open(local, 'wb') as fh:
+                fh.write(data)
+
+    def run(self, cmd, hide=True, timeout=None, warn=False, **kwargs):
+        self.check()
+        self.sim.count("run")
+        self.sim.delay("run")
+        self.sim.maybe_fail("run")
+        return self.sim.execute(self.host, cmd, timeout)
+
+
+# the simulated fleet: configuration, hosts, counters and the PowerShell emulation
+#
+class Simulation:
+    def __init__(self, config, clock, seed=None):
+        self.config = config
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.hosts_by_ip = {}
+        self.hosts_by_name = {}
+        self.counters = {}
+        self.installer_time = 0.0
+        self.pids = itertools.count(1000)
+        self.vm_numbers = itertools.count(1)
+        self.datastore_running = {}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def random_choice(self, values):
+        with self.lock:
+            return self.random.choice(values)
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def delay(self, operation):
+        seconds = self.config[operation]
+        if(seconds > 0):
+            with self.lock:
+                seconds = seconds * self.random.uniform(0.8, 1.2)
+            self.clock.sleep(seconds)
+
+    def maybe_fail(self, operation):
+        if self.chance(self.config["transport_fail_rate"]):
+            self.count("injected_transport_failure")
+            raise EOFError(f"Simulated transport failure during {operation}")
+
+    def add_host(self, name):
+        with self.lock:
+            ip = f"10.99.{len(self.hosts_by_ip) // 250}.{len(self.hosts_by_ip) % 250 + 1}"
+            host = SimHost(self, name, ip)
+            self.hosts_by_ip[ip] = host
+            self.hosts_by_name[name] = host
+        return host
+
+    def ssh_port_open(self, veeam_serv, port=22, timeout=5):
+        host = self.hosts_by_ip.get(veeam_serv)
+        return host is not None and host.is_up()
+
+    # run an installer for its simulated duration, writing its log as it goes. A failing installer
+    # logs its failure part way and then keeps running till the end, like an msi rollback. A stalled
+    # installer stops writing its log and hangs. A killed installer stops at once with exit code 1.
+    #
+    # a heavy installer running on the datastore of host
+    @contextlib.contextmanager
+    def datastore_io(self, host, name):
+        heavy = bool(host.datastore) and name in self.config["heavy"]
+        if heavy:
+            with self.lock:
+                running = self.datastore_running[host.datastore] = self.datastore_running.get(host.datastore, 0) + 1
+                self.counters["datastore_peak"] = max(self.counters.get("datastore_peak", 0), running)
+        try:
+            yield
+        finally:
+            if heavy:
+                with self.lock:
+                    self.datastore_running[host.datastore] -= 1
+
+    # how much slower an installer progresses right now because of its datastore's load
+    def io_factor(self, host, name):
+        if(not host.datastore or name not in self.config["heavy"]):
+            return 1.0
+        with self.lock:
+            running = self.datastore_running.get(host.datastore, 0)
+        return max(1.0, running / self.config["datastore_slots"]) ** self.config["datastore_thrash"]
+
+    # sleep through duration seconds of installer work in slices, slowed down by the datastore load
+    def sleep_io(self, host, name, duration, slices=10):
+        deadline = self.clock.time()
+        for i in range(slices):
+            deadline += duration / slices * self.io_factor(host, name)
+            self.clock.sleep_until(deadline)
+
+    def run_installer(self, host, installer, log, kind, pid_file=None):
+        with self.datastore_io(host, ntbasename(installer)):
+            return self.run_installer_slices(host, installer, log, kind, pid_file)
+
+    def run_installer_slices(self, host, installer, log, kind, pid_file):
+        name = ntbasename(installer)
+        duration = self.config["install"].get(name, self.config["install_default"])
+        exit_code = 0
+        if self.chance(self.config["install_fail_rate"]):
+            exit_code = self.random_choice(self.config["fail_codes"])
+            self.count(f"injected_install_failure_{exit_code}")
+        stalled = self.chance(self.config["stall_rate"])
+        if stalled:
+            self.count("injected_stall")
+
+        with self.lock:
+            pid = next(self.pids)
+            host.processes[pid] = {"killed": False}
+            encoding = self.config["log_encoding"]
+            if(encoding == "mixed"):
+                encoding = self.random.choice(["utf-16", "utf-8"])
+            fail_at = self.random.uniform(0.1, 0.9)
+        if pid_file:
+            host.write_file(pid_file, f"{pid}\r\n".encode())
+
+        lines = synthetic_log(name, kind, exit_code, self.config["log_lines"], fail_at).split('\r\n')
+        written = 0
+        host.write_file(log, "".encode(encoding))    # the BOM of a utf-16 log
+        encoding = "utf-16-le" if(encoding == "utf-16") else encoding
+        (deadline, slices) = (self.clock.time(), 10)
+        for i in range(1, slices + 1):
+            work = duration / slices * self.io_factor(host, name)
+            deadline += work
+            self.clock.sleep_until(deadline)
+            with self.lock:
+                self.installer_time += work
+            if host.processes[pid]["killed"]:
+                return 1
+            if(stalled and i > slices * fail_at):
+                continue
+            end = int(len(lines) * i / slices)
+            if(end > written):
+                with host.lock:
+                    host.write_file(log, host.read_file(log) + ('\r\n'.join(lines[written:end]) + '\r\n').encode(encoding))
+                written = end
+
+        if stalled:
+            deadline = self.clock.time() + self.config["stall_hang"]
+            while(self.clock.time() < deadline and not host.processes[pid]["killed"]):
+                self.clock.sleep(60)
+            return 1 if host.processes[pid]["killed"] else 1603
+        # 3010 and 1641 install the product and ask for a reboot
+        installed = exit_code == 0 or exit_code in veeam_install.reboot_exit_codes
+        if(installed and name in sim_products and sim_products[name] not in host.products):
+            host.products.append(sim_products[name])
+        if(installed and name in sim_versions):
+            host.version = sim_versions[name]
+        return exit_code
+
+    # emulate the PowerShell scripts and commands veeam_install.py runs on a Veeam server
+    #
+    def execute(self, host, cmd, timeout):
+        if(cmd.startswith("shutdown -r")):
+            host.reboot()
+            return SimResult()
+        if(cmd.startswith("shutdown -s")):
+            host.shutdown()
+            return SimResult()
+
+        searchobj = re.search(r'-EncodedCommand (\S+)', cmd)
+        if searchobj:
+            return self.execute_script(host, base64.b64decode(searchobj.group(1)).decode("utf-16-le"))
+
+        searchobj = re.search(r'powershell (?:-NoProfile -NonInteractive )?-File (\S+)', cmd)
+        if searchobj:
+            return self.execute_script(host, host.read_file(searchobj.group(1)).decode("utf-8", errors="replace"))
+
+        return SimResult(stderr=f"Simulation does not know command: {cmd}", exited=1)
+
+    def execute_script(self, host, script):
+        if "$packages = @(" in script:
+            return self.execute_batch(host, script)
+
+        if "Update-VBRServerComponent" in script:
+            with self.datastore_io(host, "Update-VBRServerComponent"):
+                self.sleep_io(host, "Update-VBRServerComponent", self.config["install"]["Update-VBRServerComponent"])
+            for searchobj in re.finditer(r'New-ItemProperty -Path "([^"]+)" -Name (\w+) -Value (\w+)', script):
+                host.registry[f"{searchobj.group(1)}\\{searchobj.group(2)}"] = searchobj.group(3)
+            return SimResult()
+
+        searchobj = re.search(r"Start-Process '([^']+)'", script)
+        if searchobj:
+            program = searchobj.group(1)
+            log = re.search(r"'(?:/L\*V|/log)', '([^']+)'", script).group(1)
+            pid_file = get_pid_file(script)
+            if(program.lower() == "msiexec.exe"):
+                exit_code = self.run_installer(host, re.search(r"'/i', '([^']+)'", script).group(1), log, "msi", pid_file)
+            else:
+                exit_code = self.run_installer(host, program, log, "exe", pid_file)
+            return SimResult(stdout=f"{exit_code}\n")
+
+        if "taskkill.exe /PID" in script:
+            pid = host.read_file(re.search(r"Get-Content -LiteralPath '([^']+)'", script).group(1)).decode().strip()
+            host.processes[int(pid)]["killed"] = True
+            return SimResult(stdout=f"{pid}\n")
+        if "$report.partials[$sha]" in script:
+            return self.execute_media_probe(host, script)
+        if "Copy-Item -LiteralPath $partial" in script:
+            return self.execute_media_place(host, script)
+        if "LastBootUpTime" in script:
+            return SimResult(stdout=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(host.boot_time)) + f".{host.boot_count:07d}Z\n")
+        if "_MSIExecute" in script:
+            return SimResult(stdout="idle\n")
+        if "Invoke-CimMethod" in script:
+            return self.execute_clone_fixup(host)
+        if "$probe.services" in script:
+            return self.execute_health_probe(host, script)
+        if "Get-Service -Name 'Veeam*'" in script:
+            return SimResult(stdout=f"{max(1, len(host.products))} 0\n")
+        if "$uninstall = " in script:
+            return self.execute_probe(host, script)
+        if "Compress-Archive" in script:
+            (source, target) = re.search(r"-LiteralPath '([^']+)' -DestinationPath '([^']+)'", script).groups()
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zfh:
+                zfh.writestr(ntbasename(source), host.read_file(source))
+            host.write_file(target, buf.getvalue())
+            return SimResult()
+        if f"Join-Path $_.FullName '{veeam_install.run_finished_file}'" in script:
+            return self.execute_run_dirs(host)
+        if "Get-LogVerdict -Path" in script:
+            call = script[script.rindex("Get-LogVerdict -Path"):]
+            return SimResult(stdout=json.dumps(self.log_verdict(host, call)) + "\n")
+        for searchobj in re.finditer(r"^Remove-Item -LiteralPath '((?:[^']|'')*)'", script, re.M):
+            host.remove_file(searchobj.group(1).replace("''", "'"))
+
+        return SimResult()
+
+    # evaluate a "Get-LogVerdict -Path '...' -Success '...'" call with the local verifier
+    #
+    def log_verdict(self, host, call):
+        (path, success) = re.search(r"-Path (?:'((?:[^']|'')*)'|\(.*?\)) -Success '((?:[^']|'')*)'", call).groups()
+        searchobj = re.search(r"-Path \(Find-InstallLog '((?:[^']|'')*)' '((?:[^']|'')*)'\)", call)
+        if searchobj:
+            path = host.find_newest(searchobj.group(1).replace("''", "'")) or searchobj.group(2)
+        (path, success) = (path.replace("''", "'"), success.replace("''", "'"))
+        verdict = {"rc": 1, "matched_line": None, "failures": [], "msi_return": None, "lines": 0}
+        try:
+            data = host.read_file(path)
+        except FileNotFoundError:
+            return verdict
+
+        with tempfile.NamedTemporaryFile(suffix=".log") as fh:
+            fh.write(data)
+            fh.flush()
+            verdict.update(veeam_install.verify_ps_log(fh.name, success))
+        return verdict
+
+    # the run directories of the Veeam server with the rc of their finished runs
+    def execute_run_dirs(self, host):
+        base = sim_path(veeam_install.remote_base_dir)
+        lines = []
+        for name in sorted(host.dirs):
+            if(ntbasename(name) and name == f"{base}/{ntbasename(name)}" and re.match(veeam_install.run_dir_pattern, ntbasename(name))):
+                finished = f"{name}/{veeam_install.run_finished_file}"
+                lines.append(f"{ntbasename(name)} {host.files[finished].decode().strip()}" if finished in host.files else ntbasename(name))
+        return SimResult(stdout=''.join(f"{line}\n" for line in lines))
+
+    def execute_batch(self, host, script):
+        packages = re.findall(r"@\{ service = '((?:[^']|'')*)'; msi = '((?:[^']|'')*)'; log = '((?:[^']|'')*)'; success = '((?:[^']|'')*)' \}", script)
+        report = []
+        failed = False
+        for (service, msi, log, success) in packages:
+            result = {"service": service, "exit_code": None, "verdict": None, "skipped": failed}
+            if not failed:
+                result["exit_code"] = self.run_installer(host, msi, log, "msi", get_pid_file(script))
+                result["verdict"] = self.log_verdict(host, f"Get-LogVerdict -Path '{log}' -Success '{success}'")
+                failed = ((result["exit_code"] != 0 or result["verdict"]["rc"] != 0)
+                          and not veeam_install.is_reboot_required(result["exit_code"], result["verdict"]))
+            report.append(result)
+        return SimResult(stdout=json.dumps(report) + "\n")
+
+    def execute_probe(self, host, script):
+        probe = {"products": list(host.products), "files": {}, "registry": {}, "logs": {}}
+        for searchobj in re.finditer(r"\$probe\.files\['((?:[^']|'')*)'\] = ", script):
+            path = searchobj.group(1).replace("''", "'")
+            if(host.version and path == veeam_install.veeam_service_exe):
+                probe["files"][path] = host.version
+        for searchobj in re.finditer(r"\$probe\.registry\['((?:[^']|'')*)'\]", script):
+            key = searchobj.group(1).replace("''", "'")
+            if key in host.registry:
+                probe["registry"][key] = host.registry[key]
+        for searchobj in re.finditer(r"\$probe\.logs\['((?:[^']|'')*)'\] = \((Get-LogVerdict [^\n]*)\)\.rc", script):
+            probe["logs"][searchobj.group(1).replace("''", "'")] = self.log_verdict(host, searchobj.group(2))["rc"]
+        return SimResult(stdout=json.dumps(probe) + "\n")
+
+    def execute_clone_fixup(self, host):
+        report = {"hostname": host.hostname, "services": [], "sql_server": None}
+        if(host.hostname != veeam_install.veeam_serv_hostname):
+            report.update({"services": list(sim_services), "sql_server": f"{host.hostname}\\{veeam_install.veeam_serv_sqlinst}"})
+            self.clock.sleep(self.config["service_restart"])
+        return SimResult(stdout=json.dumps(report) + "\n")
+
+    def execute_health_probe(self, host, script):
+        probe = json.loads(self.execute_probe(host, script).stdout)
+        services = sim_services if "Veeam Backup & Replication Server" in host.products else []
+        probe.update({"services": [ {"name": name, "status": "Stopped" if name in host.stopped_services else "Running"} for name in services ],
+                      "sql": "Running", "version": host.version})
+        return SimResult(stdout=json.dumps(probe) + "\n")
+
+    # SHA-256 of a file of a simulated server, at the hashing speed of the server
+    #
+    def file_hash(self, host, path):
+        data = host.read_file(path)
+        self.clock.sleep(len(data) / self.config["hash_rate"])
+        return hashlib.sha256(data).hexdigest()
+
+    def execute_media_probe(self, host, script):
+        request = get_script_request(script)
+        report = {"files": {}, "partials": {}}
+        for entry in request["files"]:
+            try:
+                if(len(host.read_file(entry["path"])) == entry["size"]):
+                    report["files"][entry["path"]] = self.file_hash(host, entry["path"])
+            except FileNotFoundError:
+                pass
+        for sha in request["blobs"]:
+            try:
+                report["partials"][sha] = len(host.read_file(f"{request['staging']}\\{sha}.partial"))
+            except FileNotFoundError:
+                pass
+        return SimResult(stdout=json.dumps(report) + "\n")
+
+    def execute_media_place(self, host, script):
+        request = get_script_request(script)
+        report = {}
+        for blob in request["blobs"]:
+            partial = f"{request['staging']}\\{blob['sha']}.partial"
+            report[blob["sha"]] = self.file_hash(host, partial)
+            if(report[blob["sha"]] == blob["sha"]):
+                for target in blob["targets"]:
+                    host.write_file(target, host.read_file(partial))
+            with host.lock:
+                del host.files[sim_path(partial)]
+        return SimResult(stdout=json.dumps(report) + "\n")
+
+    # stand-in for vm_operation.create_from_yaml: every VM of the "veeam_install" section is cloned in turn
+    #
+    def create_from_yaml(self, yamlfile, yaml_section, mylogger, deplogfile):
+        with open(yamlfile, 'r') as fh:
+            yaml_data = yaml.safe_load(fh)
+
+        vcdata = dict(yaml_data["VCenter"])
+        vcdata["deployed_vm"] = []
+        for entry in yaml_data[yaml_section]:
+            for i in range(int(entry.get("vm_count", 1))):
+                with self.lock:
+                    name = f"{vcdata.get('base_vmname', 'veeam-serv').strip()}{next(self.vm_numbers)}"
+                self.clock.sleep(self.config["clone"])
+                host = self.add_host(name)
+                host.datastore = entry.get("datastore")
+                if(entry.get("template") in self.hosts_by_name):    # a clone of the golden VM
+                    host.clone_from(self.hosts_by_name[entry["template"]])
+                if vcdata.get("hostname_update"):
+                    host.hostname = name
+                vcdata["deployed_vm"].append({"vm_name": name})    # like vm_operation, without the ESX host and datastore
+                mylogger.info(f"Simulation: deployed virtual machine {name}")
+        # like vm_operation, return once the powered on VMs have booted
+        self.clock.sleep_until(max([ self.hosts_by_name[vm["vm_name"]].down_until for vm in vcdata["deployed_vm"] ] + [0]))
+        return (0, vcdata)
+
+    def get_vm_ip(self, vc_name, vc_user, vc_pw, vc_ssl_check, mylogger, vm_list):
+        return [ {"vm_name": name, "vm_ip": self.hosts_by_name[name].ip} for name in vm_list
+                 if name in self.hosts_by_name and self.hosts_by_name[name].is_up() ]
+
+
+def get_script_request(script):
+    return json.loads(re.search(r"ConvertFrom-Json '((?:[^']|'')*)'", script).group(1).replace("''", "'"))
+
+
+def get_pid_file(script):
+    searchobj = re.search(r"Set-Content -LiteralPath '([^']+)' -Value \$process\.Id", script)
+    return searchobj.group(1) if searchobj else None
+
+
+def ntbasename(path):
+    return re.split(r'[\\/]', path)[-1]
+
+
+# synthetic installer log. msi logs look like a Windows Installer verbose log, exe logs like the
+# Veeam patch log. A failing installer logs the failure at fail_at of the log and rolls back after it.
+#
+def synthetic_log(name, kind, exit_code, lines, fail_at=0.5):
+    body = [ f"MSI (s) (A0:B4) [12:00:{i % 60:02d}:000]: Doing action: Action{i}" for i in range(lines) ]
+    if(kind == "msi"):
+        if(exit_code == 0):
+            body += [f"MSI (s) (A0:B4) [12:01:00:000]: Product: {name} -- Installation completed successfully.",
+                     f"MSI (s) (A0:B4) [12:01:00:000]: Windows Installer installed the product. Product Name: {name}. Installation success or error status: 0.",
+                     "MSI (c) (C8:D0) [12:01:00:000]: MainEngineThread is returning 0"]
+        elif(exit_code == 3010):
+            body += [f"MSI (s) (A0:B4) [12:01:00:000]: Product: {name}. Restart required. The installation or update for the product required a restart.",
+                     f"MSI (s) (A0:B4) [12:01:00:000]: Windows Installer installed the product. Product Name: {name}. Installation success or error status: 3010.",
+                     "MSI (c) (C8:D0) [12:01:00:000]: MainEngineThread is returning 3010"]
+        elif exit_code in sim_msi_errors:    # errors Windows Installer reports before it runs any action
+            body = body[:5] + [f"MSI (c) (C8:D0) [12:00:05:000]: {sim_msi_errors[exit_code]}",
+                               f"MSI (c) (C8:D0) [12:00:05:000]: MainEngineThread is returning {exit_code}"]
+        else:
+            body = body[:int(lines * fail_at)] + ["MSI (s) (A0:B4) [12:00:30:000]: Return value 3."]
+            body += [ f"MSI (s) (A0:B4) [12:00:{i % 60:02d}:000]: Executing op: Rollback{i}" for i in range(lines - len(body)) ]
+            body += [f"MSI (s) (A0:B4) [12:01:00:000]: Product: {name} -- Installation operation failed.",
+                     f"MSI (c) (C8:D0) [12:01:00:000]: MainEngineThread is returning {exit_code}"]
+    elif(exit_code == 0 or exit_code in veeam_install.reboot_exit_codes):
+        body += [f"[12:01:00] Installing {name}"] + (["[12:01:00] Restart required"] if exit_code else []) + [f"[12:01:00] Return value {exit_code}"]
+    else:
+        body = body[:int(lines * fail_at)] + [f"[12:00:30] Installation failed: {name}"] + body[int(lines * fail_at):]
+        body += [f"[12:01:00] Return value {exit_code}"]
+    return '\r\n'.join(body)
+
+
+# install the simulation into veeam_install: its clock, ssh connections, port checks and vm_operation
+#
+def install_simulation(sim):
+    global active_sim
+    active_sim = sim
+    veeam_install.Connection = SimConnection
+    veeam_install.time = sim.clock
+    veeam_install.ssh_port_open = sim.ssh_port_open
+    vm_operation.create_from_yaml = sim.create_from_yaml
+    vm_operation.get_vm_ip = sim.get_vm_ip
+
+
+# stand-in modules: veeam_install imports vm_operation and fabric at import time
+vm_operation = sys.modules.setdefault("vm_operation", types.ModuleType("vm_operation"))
+try:
+    import fabric
+except ImportError:
+    fabric = types.ModuleType("fabric")
+    fabric.Connection = SimConnection
+    fabric.task = lambda func: func
+    sys.modules["fabric"] = fabric
+
+import yaml
+import veeam_install
+
+active_sim = None
+
+
+# write installer media of about size_mb megabytes, once per work directory
+#
+def write_sim_media(media_dir, size_mb):
+    files = {"catalog/VeeamBackupCatalog64.msi": 0.1, "backup/Server.x64.msi": 0.5, "backup/Shell.x64.msi": 0.2,
+             "packages/VeeamTransport.msi": 0.1, "updates/veeam_backup_11.0.1.1261_CumulativePatch20220302.exe": 0.1}
+    for (path, share) in files.items():
+        local = os.path.join(media_dir, *path.split('/'))
+        size = int(size_mb * share * 1024 * 1024)
+        if(not os.path.exists(local) or os.path.getsize(local) != size):
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            with open(local, 'wb') as fh:
+                fh.write(random.Random(path).randbytes(size))
+    return media_dir
+
+
+# write the YAML configuration file of a simulated run
+#
+def write_sim_yaml(yamlfile, args):
+    yaml_data = {"VCenter": {"vcenter_name": "sim-vcenter", "vcenter_user": "sim", "vcenter_pw": "sim", "ssl-check": False,
+                             "datacenter": "sim-dc", "folder": "sim", "base_vmname": "veeam-sim", "hostname_update": args.hostname_update,
+                             "power_on": True, "snapshot_name": None},
+                 "veeam_install": [],
+                 "install_options": {"workers": args.workers, "log_verify": args.log_verify, "log_monitor": args.log_monitor,
+                                     "stall_window": args.stall_window, "pipeline": args.pipeline, "provision_workers": args.provision_workers,
+                                     "admission": {"datastore": args.admission_datastore}, "golden_image": args.golden_image,
+                                     "golden_extra_vm": not args.golden_remaining}}
+    if args.media_mb:
+        yaml_data["install_options"].update({"media_dir": write_sim_media(os.path.join(os.path.dirname(yamlfile), "media"), args.media_mb),
+                                             "media_streams": args.media_streams})
+    entries = max(1, min(args.entries or args.servers, args.servers))
+    for i in range(entries):
+        vm_count = args.servers // entries + (1 if i < args.servers % entries else 0)
+        yaml_data["veeam_install"].append({"esx": f"sim-esx{i + 1}", "template": "sim-template", "datastore": f"sim-ds{i + 1}",
+                                           "vm_user": "Administrator", "vm_password": "sim", "vm_count": vm_count, "network": "sim",
+                                           "ip1": "10.99.0.1", "netmask": "255.255.255.0", "gateway": "10.99.0.254", "dns": "10.99.0.253"})
+    if args.controllers:
+        yaml_data["install_options"].update({"queue_dir": os.path.join(os.path.dirname(yamlfile), "queue"), "lease_ttl": args.lease_ttl})
+    with open(yamlfile, 'w') as fh:
+        yaml.safe_dump(yaml_data, fh)
+
+
+# distributed mode: queue the entries and run controllers worker processes on the queue, as
+# threads of this process. A crashed controller leaves the lease of the first task behind
+# without a heartbeat. Return the rc and the metrics files of the workers.
+#
+def run_sim_controllers(yamlfile, mylogger, outlogfile, cli_options, controllers, crash_controller):
+    rc = veeam_install.start_enqueue_vbr(yamlfile, mylogger, cli_options)
+    if(rc != 0):
+        return (rc, [])
+    if crash_controller:
+        vcdata = {"mylogger": mylogger}
+        veeam_install.init_work_queue(vcdata, veeam_install.get_install_options(yamlfile, mylogger)["queue_dir"], 0)
+        task_id = veeam_install.get_queued_tasks(vcdata)[0]
+        veeam_install.write_queue_file(veeam_install.get_queue_file(vcdata, "leases", task_id, ".lease"),
+                                       {"worker": "sim-crashed-controller", "token": "crashed", "heartbeat": veeam_install.time.time()})
+
+    results = {}
+    def run_controller(index):
+        options = dict(cli_options, outlogfile=f"{outlogfile}_c{index}")
+        results[index] = veeam_install.start_worker_vbr(yamlfile, mylogger, f"{outlogfile}_c{index}_dep", options)
+
+    threads = [ threading.Thread(target=run_controller, args=(index,), name=f"controller{index}") for index in range(controllers) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rc = max([ results.get(index, 1) for index in range(controllers) ])
+    return (rc, [ f"{outlogfile}_c{index}_metrics.jsonl" for index in range(controllers) ])
+
+
+# report of a simulated run from its metrics file
+#
+def get_bench_report(metrics_files, sim, sim_start, sim_wall, real_wall, rc):
+    # span ids restart in every metrics file: they are made unique as (file, id)
+    spans = []
+    for (index, metrics_file) in enumerate(metrics_files):
+        with open(metrics_file, 'r') as fh:
+            for line in fh:
+                if line.strip():
+                    span = json.loads(line)
+                    span.update({"id": (index, span["id"]), "parent": (index, span["parent"]) if span["parent"] is not None else None})
+                    spans.append(span)
+
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent"], []).append(span)
+
+    steps = {}
+    for span in spans:
+        if(span["span"] == "step"):
+            execs = sum(child["duration"] for child in children.get(span["id"], []) if child["span"] == "exec")
+            entry = steps.setdefault(span["step"], {"count": 0, "duration": 0.0, "overhead": 0.0})
+            entry["count"] += 1
+            entry["duration"] += span["duration"]
+            entry["overhead"] += span["duration"] - execs
+
+    stages = {}
+    for (stage, name) in [("provision", "provision"), ("vm_ready", "vm_ready"), ("install", "server")]:
+        stages[stage] = [ span["duration"] for span in spans if span["span"] == name ]
+    for stage in ["provision", "install"]:
+        stages[f"{stage}_queue"] = [ span["duration"] for span in spans if span["span"] == "queue" and span["stage"] == stage ]
+
+    servers = [ span for span in spans if span["span"] == "server" ]
+    succeeded = len([ span for span in servers if span["rc"] == 0 ])
+    completion = [ span["end"] - sim_start for span in servers ]
+    return {"rc": rc, "servers": len(servers), "succeeded": succeeded, "sim_wall_seconds": round(sim_wall, 1),
+            "real_wall_seconds": round(real_wall, 2),
+            "mean_completion_seconds": round(sum(completion) / len(completion), 1) if completion else None, "servers_per_hour": round(succeeded * 3600 / sim_wall, 2) if sim_wall else None,
+            "installer_seconds": round(sim.installer_time, 1), "operations": dict(sim.counters),
+            "stages": { stage: {"items": len(durations), "mean_seconds": round(sum(durations) / len(durations), 1), "max_seconds": round(max(durations), 1)}
+                        for (stage, durations) in stages.items() if durations },
+            "steps": { step: {"mean_seconds": round(entry["duration"] / entry["count"], 1),
+                              "mean_overhead_seconds": round(entry["overhead"] / entry["count"], 1)} for (step, entry) in steps.items() }}
+
+
+def print_bench_report(report):
+    print(f"Servers: {report['servers']} ({report['succeeded']} succeeded), rc {report['rc']}")
+    print(f"End-to-end wall time: {report['sim_wall_seconds']} simulated seconds ({report['real_wall_seconds']} real seconds)")
+    print(f"Mean server completion: {report['mean_completion_seconds']} simulated seconds after the start")
+    print(f"Throughput: {report['servers_per_hour']} servers per hour")
+    print(f"Operations: {', '.join(f'{key} {value}' for (key, value) in sorted(report['operations'].items()))}")
+    print(f"{'stage':<20}{'items':>6}{'mean':>10}{'max':>10}")
+    for (stage, entry) in report["stages"].items():
+        print(f"{stage:<20}{entry['items']:>6}{entry['mean_seconds']:>10.1f}{entry['max_seconds']:>10.1f}")
+    print(f"{'step':<20}{'mean':>10}{'overhead':>10}")
+    for (step, entry) in report["steps"].items():
+        print(f"{step:<20}{entry['mean_seconds']:>10.1f}{entry['mean_overhead_seconds']:>10.1f}")
+    if "verify" in report:
+        print(f"Verify: rc {report['verify']['rc']} in {report['verify']['wall']} simulated seconds")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the Veeam installation of veeam_install.py against simulated Veeam servers")
+
+    parser.add_argument('-n', '--servers', required=False, default=4, help='Number of simulated Veeam servers. Default is 4', dest='servers', type=int)
+    parser.add_argument('-w', '--workers', required=False, default=veeam_install.default_install_workers, help='Concurrent installs', dest='workers', type=int)
+    parser.add_argument('-s', '--scale', required=False, default=200.0, help='Simulated seconds per real second. Higher scales inflate the measured overheads. Default is 200', dest='scale', type=float)
+    parser.add_argument('-l', '--latency', required=False, default=None, help='Latency in simulated seconds of every ssh run/put/get', dest='latency', type=float)
+    parser.add_argument('-it', '--install-time', required=False, default=None, help='Simulated duration of every installer in seconds', dest='install_time', type=float)
+    parser.add_argument('-f', '--fail-rate', required=False, default=0.0, help='Probability of an installer failing', dest='fail_rate', type=float)
+    parser.add_argument('-fc', '--fail-codes', required=False, default="1603", help='Comma separated exit codes of the failing installers, e.g. 1603,1618,3010,1638. Default is 1603', dest='fail_codes', type=str)
+    parser.add_argument('-sr', '--stall-rate', required=False, default=0.0, help='Probability of an installer hanging without log output', dest='stall_rate', type=float)
+    parser.add_argument('-tf', '--transport-fail-rate', required=False, default=0.0, help='Probability of an ssh operation failing', dest='transport_fail_rate', type=float)
+    parser.add_argument('-e', '--log-encoding', required=False, default="utf-16", choices=["utf-16", "utf-8", "mixed"], help='Encoding of the synthetic installer logs', dest='log_encoding')
+    parser.add_argument('-ll', '--log-lines', required=False, default=2000, help='Lines of every synthetic installer log', dest='log_lines', type=int)
+    parser.add_argument('-lv', '--log-verify', required=False, default=veeam_install.default_log_verify, choices=['remote', 'local'], dest='log_verify')
+    parser.add_argument('-ne', '--entries', required=False, default=None, help='Number of veeam_install entries the servers are spread over. Default is one per server', dest='entries', type=int)
+    parser.add_argument('-np', '--no-pipeline', required=False, action='store_false', help='Deploy all VMs before installing', dest='pipeline')
+    parser.add_argument('-pw', '--provision-workers', required=False, default=veeam_install.default_provision_workers, help='Entries deployed at the same time', dest='provision_workers', type=int)
+    parser.add_argument('-mm', '--media-mb', required=False, default=0, help='Stage installer media of this many megabytes. The bytes are really hashed, so keep it small at high scales. Default is no media staging', dest='media_mb', type=float)
+    parser.add_argument('-ms', '--media-streams', required=False, default=veeam_install.default_media_streams, help='Parallel sftp streams per media upload', dest='media_streams', type=int)
+    parser.add_argument('-bw', '--bandwidth', required=False, default=None, help='Bytes per simulated second of one sftp stream', dest='bandwidth', type=float)
+    parser.add_argument('-nm', '--no-log-monitor', required=False, action='store_false', help='Do not tail the installer logs', dest='log_monitor')
+    parser.add_argument('-sw', '--stall-window', required=False, default=veeam_install.default_stall_window, help='Installer log stall window in simulated seconds', dest='stall_window', type=int)
+    parser.add_argument('-hd', '--history-db', required=False, default=None, help='Run history to learn the step timeouts from. Default is veeam_sim_history.db in the workdir, so repeated runs with the same workdir learn', dest='history_db', type=str)
+    parser.add_argument('-lf', '--log-format', required=False, default='text', choices=veeam_install.log_formats, help='Format of the log files', dest='log_format')
+    parser.add_argument('-ad', '--admission-datastore', required=False, default=veeam_install.default_admission_limits["datastore"], help='Heavy steps running at once per datastore, 0 is no limit. Use with -ne 1 to put all servers on one datastore', dest='admission_datastore', type=int)
+    parser.add_argument('--seed', required=False, default=None, help='Random seed', dest='seed', type=int)
+    parser.add_argument('-g', '--golden-image', required=False, action='store_true', help='Install one golden VM and clone the servers from it', dest='golden_image')
+    parser.add_argument('-gr', '--golden-remaining', required=False, action='store_true', help='Clone only the remaining VMs: the golden VM is the first server', dest='golden_remaining')
+    parser.add_argument('-hu', '--hostname-update', required=False, action='store_true', help='Give every deployed VM its own hostname', dest='hostname_update')
+    parser.add_argument('--verify', required=False, action='store_true', help='Verify the health of the installed servers after the run', dest='verify')
+    parser.add_argument('--break-services', required=False, default=0, help='Stop the Veeam backup service of this many servers before verifying', dest='break_services', type=int)
+    parser.add_argument('-c', '--controllers', required=False, default=0, help='Queue the entries and install them with this many worker controllers sharing the queue. Default is one controller without a queue', dest='controllers', type=int)
+    parser.add_argument('--crash-controller', required=False, action='store_true', help='Leave the lease of a crashed controller on the first queued task', dest='crash_controller')
+    parser.add_argument('--lease-ttl', required=False, default=600, help='Lease ttl in simulated seconds of the controllers. Default is 600', dest='lease_ttl', type=int)
+    parser.add_argument('--json', required=False, action='store_true', help='Print the report as JSON', dest='json')
+    parser.add_argument('--max-wall', required=False, default=None, help='Fail if the run takes more simulated seconds than this', dest='max_wall', type=float)
+    parser.add_argument('-d', '--workdir', required=False, default=None, help='Directory for the YAML, log and metrics files', dest='workdir', type=str)
+
+    args = parser.parse_args(argv)
+
+    config = json.loads(json.dumps(sim_defaults))
+    config.update({"install_fail_rate": args.fail_rate, "transport_fail_rate": args.transport_fail_rate, "stall_rate": args.stall_rate,
+                   "log_encoding": args.log_encoding, "log_lines": args.log_lines,
+                   "fail_codes": [ int(code) for code in args.fail_codes.split(',') ]})
+    if args.bandwidth is not None:
+        config["bandwidth"] = args.bandwidth
+    if args.latency is not None:
+        config.update({"put": args.latency, "get": args.latency, "run": args.latency})
+    if args.install_time is not None:
+        config["install"] = { name: args.install_time for name in config["install"] }
+        config["install_default"] = args.install_time
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="veeam_sim_")
+    os.makedirs(workdir, exist_ok=True)
+    yamlfile = os.path.join(workdir, "veeam_sim.yaml")
+    outlogfile = os.path.join(workdir, "veeam_sim.log")
+    write_sim_yaml(yamlfile, args)
+
+    (mylogger, listener) = veeam_install.setup_logging("veeam_sim", outlogfile, logging.DEBUG, args.log_format, console=False)
+
+    sim = Simulation(config, SimClock(args.scale), args.seed)
+    install_simulation(sim)
+
+    cli_options = {"outlogfile": outlogfile, "state_file": os.path.join(workdir, "veeam_sim_state.json"),
+                   "history_db": args.history_db if args.history_db is not None else os.path.join(workdir, "veeam_sim_history.db")}
+    (sim_start, real_start) = (sim.clock.time(), real_time.time())
+    try:
+        if args.controllers:
+            (rc, metrics_files) = run_sim_controllers(yamlfile, mylogger, outlogfile, cli_options, args.controllers, args.crash_controller)
+        else:
+            rc = veeam_install.start_install_vbr(yamlfile, mylogger, outlogfile + '_dep', cli_options)
+            metrics_files = [outlogfile + '_metrics.jsonl']
+    finally:
+        veeam_install.stop_logging(mylogger, listener)
+    (sim_wall, real_wall) = (sim.clock.time() - sim_start, real_time.time() - real_start)
+
+    report = get_bench_report(metrics_files, sim, sim_start, sim_wall, real_wall, rc)
+    report["workdir"] = workdir
+    if args.verify:
+        for host in list(sim.hosts_by_ip.values())[:args.break_services]:
+            host.stopped_services.add("VeeamBackupSvc")
+        (mylogger, listener) = veeam_install.setup_logging("veeam_sim", outlogfile, logging.DEBUG, args.log_format, console=False)
+        verify_start = sim.clock.time()
+        try:
+            verify_rc = veeam_install.start_verify_vbr(yamlfile, mylogger, dict(cli_options, metrics_file=outlogfile + '_verify_metrics.jsonl'))
+        finally:
+            veeam_install.stop_logging(mylogger, listener)
+        report["verify"] = {"rc": verify_rc, "wall": round(sim.clock.time() - verify_start, 1)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_bench_report(report)
+        print(f"Log, state and metrics files are in {workdir}")
+
+    if(args.max_wall is not None and sim_wall > args.max_wall):
+        print(f"Simulated wall time {sim_wall:.1f} seconds exceeds the limit of {args.max_wall} seconds")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    rc = main(sys.argv[1:])
+    sys.exit(rc)
@@ -0,0 +1,26 @@
+# Unit tests of the pure logic of veeam_install.py. fabric and vm_operation are only used
+# against real Veeam servers and vCenters; when they are not installed, stand-in modules
+# let veeam_install import, the same way veeam_sim.py does.
+
+import os
+import sys
+import types
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+try:
+    import fabric
+except ImportError:
+    fabric = types.ModuleType("fabric")
+    fabric.Connection = object
+    fabric.task = lambda func: func
+    sys.modules["fabric"] = fabric
+sys.modules.setdefault("vm_operation", types.ModuleType("vm_operation"))
+
+
+@pytest.fixture
+def mylogger():
+    return logging.getLogger("veeam_install_test")
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+import veeam_install
+
+
+entries = [ {"esx": "esx1", "datastore": "ds1", "vm_count": 2}, {"esx": "esx2", "datastore": "ds2"} ]
+
+
+def test_placement_of_deployed_vms_falls_back_to_their_entry():
+    vcdata = {"deployed_vm": [{"vm_name": "vm1"}, {"vm_name": "vm2"}, {"vm_name": "vm3", "datastore": "ds9"}]}
+    assert veeam_install.get_server_placement(vcdata, {"vm_name": "vm2"}, entries) == {"esx": "esx1", "datastore": "ds1"}
+    assert veeam_install.get_server_placement(vcdata, {"vm_name": "vm3"}, entries) == {"esx": "esx2", "datastore": "ds9"}
+    assert veeam_install.get_entry_of_vm(entries, 3) is None
+
+
+def test_placement_of_resumed_vms():
+    vcdata = {"checkpoint": {"servers": {"vm1": {"esx": "esx1", "datastore": "ds1"}, "vm2": {}}}}
+    assert veeam_install.get_server_placement(vcdata, {"vm_name": "vm1", "vm_ip": "10.0.0.1"}, entries) == {"esx": "esx1", "datastore": "ds1"}
+    # unknown placement: only the placement shared by all the entries is used
+    assert veeam_install.get_server_placement(vcdata, {"vm_name": "vm2", "vm_ip": "10.0.0.2"}, entries) == {"esx": None, "datastore": None}
+    assert veeam_install.get_server_placement(vcdata, {"vm_name": "vm2", "vm_ip": "10.0.0.2"}, entries[:1]) == {"esx": "esx1", "datastore": "ds1"}
+
+
+@pytest.fixture
+def admission(mylogger):
+    def new_admission(**limits):
+        vcdata = {"mylogger": mylogger, "options": {"admission": limits}}
+        veeam_install.init_admission(vcdata)
+        return vcdata
+    return new_admission
+
+
+def test_admission_pools(admission):
+    vcdata = admission(datastore=2, esx=0, **{"global": 3})
+    pools = veeam_install.get_admission_pools(vcdata["admission"], {"esx": "esx1", "datastore": "ds1"})
+    assert pools == [("global", None), ("datastore", "ds1")]
+    assert veeam_install.get_admission_pools(vcdata["admission"], {"esx": None, "datastore": None}) == [("global", None)]
+
+
+def test_datastore_limit(admission):
+    vcdata = admission(datastore=1)
+    step = {"description": "patch", "weight": 1}
+    (first, other_ds) = ({"vm_ip": "10.0.0.1", "datastore": "ds1"}, {"vm_ip": "10.0.0.3", "datastore": "ds2"})
+    admitted = threading.Event()
+
+    def second():
+        with veeam_install.admitted(vcdata, {"vm_ip": "10.0.0.2", "datastore": "ds1"}, step):
+            admitted.set()
+
+    with veeam_install.admitted(vcdata, first, step):
+        thread = threading.Thread(target=second)
+        thread.start()
+        with veeam_install.admitted(vcdata, other_ds, step):    # another datastore is not limited
+            pass
+        assert not admitted.wait(0.2)
+    thread.join(5)
+    assert admitted.is_set()
+    assert vcdata["admission"]["used"] == {("datastore", "ds1"): 0, ("datastore", "ds2"): 0}
+
+
+def test_step_heavier_than_the_limit_runs_alone(admission):
+    vcdata = admission(datastore=1)
+    with veeam_install.admitted(vcdata, {"vm_ip": "10.0.0.1", "datastore": "ds1"}, {"description": "patch", "weight": 2}):
+        assert vcdata["admission"]["used"] == {("datastore", "ds1"): 2}
+
+
+def test_light_steps_are_not_admitted(admission):
+    vcdata = admission(datastore=1)
+    with veeam_install.admitted(vcdata, {"vm_ip": "10.0.0.1", "datastore": "ds1"}, {"description": "console", "weight": 0}):
+        assert vcdata["admission"]["used"] == {}
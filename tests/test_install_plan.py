@@ -0,0 +1,54 @@
+import veeam_install
+
+
+def make_plan(*steps):
+    return [ veeam_install.normalize_install_step(dict({"kind": "msi", "installer": "c:\\a.msi", "log": "c:\\a.log"}, **step)) for step in steps ]
+
+
+def test_default_plan_is_valid(mylogger):
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    assert veeam_install.validate_install_plan(plan, mylogger) == 0
+
+
+def test_duplicate_names(mylogger):
+    assert veeam_install.validate_install_plan(make_plan({"name": "a"}, {"name": "a"}), mylogger) == 1
+
+
+def test_unknown_kind(mylogger):
+    assert veeam_install.validate_install_plan(make_plan({"name": "a", "kind": "zip"}), mylogger) == 1
+
+
+def test_missing_keys(mylogger):
+    assert veeam_install.validate_install_plan(make_plan({"name": "a", "installer": None}), mylogger) == 1
+    assert veeam_install.validate_install_plan(make_plan({"name": "a", "kind": "msi_batch", "packages": [{"service": "s", "msi": "m"}]}), mylogger) == 1
+
+
+def test_negative_weight(mylogger):
+    assert veeam_install.validate_install_plan(make_plan({"name": "a", "weight": -1}), mylogger) == 1
+
+
+def test_unknown_dependency(mylogger):
+    assert veeam_install.validate_install_plan(make_plan({"name": "a", "depends": ["b"]}), mylogger) == 1
+
+
+def test_dependency_cycle(mylogger):
+    plan = make_plan({"name": "a", "depends": ["c"]}, {"name": "b", "depends": ["a"]}, {"name": "c", "depends": ["b"]}, {"name": "d"})
+    assert veeam_install.validate_install_plan(plan, mylogger) == 1
+
+
+def test_diamond_dependencies(mylogger):
+    plan = make_plan({"name": "a"}, {"name": "b", "depends": ["a"]}, {"name": "c", "depends": ["a"]}, {"name": "d", "depends": ["b", "c"]})
+    assert veeam_install.validate_install_plan(plan, mylogger) == 0
+
+
+def test_batch_steps_are_expanded_per_package(mylogger):
+    pkgs = [ {"service": f"svc{i}", "msi": f"c:\\svc{i}.msi", "log": f"c:\\svc{i}.log", "ps_file": f"svc{i}.ps1", "timeout": 600,
+              "success": "Installation success or error status: 0", "detect": {}} for i in range(2) ]
+    plan = make_plan({"name": "console"}, {"name": "pkgs", "kind": "msi_batch", "packages": pkgs, "depends": ["console"]},
+                     {"name": "patch", "depends": ["pkgs"]})
+    expanded = veeam_install.expand_batch_steps(plan)
+    assert [ step["name"] for step in expanded ] == ["console", "pkgs0", "pkgs1", "patch"]
+    assert [ step["kind"] for step in expanded ] == ["msi", "msi", "msi", "msi"]
+    assert (expanded[1]["installer"], expanded[1]["log"], expanded[1]["depends"]) == ("c:\\svc0.msi", "c:\\svc0.log", ["console"])
+    assert expanded[3]["depends"] == ["pkgs0", "pkgs1"]
+    assert veeam_install.validate_install_plan(expanded, mylogger) == 0
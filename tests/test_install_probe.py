@@ -0,0 +1,37 @@
+import veeam_install
+
+
+def probe(products=(), files=None, registry=None, logs=None):
+    return {"products": list(products), "files": files or {}, "registry": registry or {}, "logs": logs or {}}
+
+
+def test_is_detected():
+    assert not veeam_install.is_detected(probe(["Veeam Backup Catalog"]), {})
+    assert veeam_install.is_detected(probe(["Veeam Backup Catalog"]), {"product": "veeam backup catalog"})
+    assert not veeam_install.is_detected(probe(), {"product": "Veeam Backup Catalog"})
+    assert veeam_install.is_detected(probe(files={"c:\\a.exe": "11.0.1.1261"}), {"file": "c:\\a.exe", "version": "11.0.1"})
+    assert not veeam_install.is_detected(probe(files={"c:\\a.exe": "11.0.0.837"}), {"file": "c:\\a.exe", "version": "11.0.1"})
+    assert veeam_install.is_detected(probe(registry={"HKLM:\\X\\Y": "1"}), {"registry": {"path": "HKLM:\\X", "name": "Y"}})
+    assert veeam_install.is_detected(probe(logs={"c:\\a.log": 0}), {"log": True}, "c:\\a.log")
+    assert not veeam_install.is_detected(probe(logs={"c:\\a.log": 1}), {"log": True}, "c:\\a.log")
+
+
+def test_patch_is_detected_by_the_backup_service_version():
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    patched = probe(files={veeam_install.veeam_service_exe: "11.0.1.1261"})
+    unpatched = probe(files={veeam_install.veeam_service_exe: "11.0.0.837"})
+    assert "patch" in veeam_install.apply_install_probe(plan, patched)[1]
+    assert "patch" not in veeam_install.apply_install_probe(plan, unpatched)[1]
+
+
+def test_apply_install_probe_drops_installed_packages():
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    services = [ pkg["service"] for pkg in veeam_install.veeam_service_pkgs ]
+    installed = services[:-1] + ["Veeam Backup Catalog", "Veeam Backup & Replication Server"]
+    (resumed, detected) = veeam_install.apply_install_probe(plan, probe(installed))
+    assert detected == {"catalog", "server"}
+    batch = [ step for step in resumed if step["name"] == "service_pkgs" ][0]
+    assert [ pkg["service"] for pkg in batch["packages"] ] == services[-1:]
+
+    (resumed, detected) = veeam_install.apply_install_probe(plan, probe(installed + ["Veeam Agent for Microsoft Windows Redistributable"]))
+    assert "service_pkgs" in detected
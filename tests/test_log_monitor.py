@@ -0,0 +1,118 @@
+import io
+import threading
+import types
+
+import pytest
+
+import veeam_install
+
+
+class FakeSftp:
+    def __init__(self):
+        self.files = {}
+
+    def write(self, log, data):
+        self.files[veeam_install.sftp_path(log)] = self.files.get(veeam_install.sftp_path(log), b'') + data
+
+    def stat(self, path):
+        if path not in self.files:
+            raise IOError(f"No such file: {path}")
+        return types.SimpleNamespace(st_size=len(self.files[path]))
+
+    def open(self, path, mode):
+        return io.BytesIO(self.files[path])
+
+
+@pytest.fixture
+def vcdata(mylogger, monkeypatch):
+    monkeypatch.setattr(veeam_install, "log_monitor_interval", 0.01)
+    return {"mylogger": mylogger, "options": {}}
+
+
+def new_state():
+    return {"offset": 0, "decoder": None, "partial": "", "lines": 0, "action": None}
+
+
+@pytest.mark.parametrize("line,failure", [ ("MSI (c) MainEngineThread is returning 1603", True),
+                                           ("MSI (c) MainEngineThread is returning 0", False),
+                                           ("MSI (c) MainEngineThread is returning 3010", False),
+                                           ("MSI (c) MainEngineThread is returning 1641", False),
+                                           ("MSI (c) MainEngineThread is returning 30100", True),
+                                           ("Installation success or error status: 1618.", True),
+                                           ("Installation success or error status: 3010.", False),
+                                           ("MSI (s) Return value 3.", True),
+                                           ("MSI (s) Return value 1.", False),
+                                           ("Installation operation failed", True) ])
+def test_failure_markers(line, failure):
+    patterns = veeam_install.get_log_patterns(veeam_install.msi_success_str)["failure"]
+    assert any(pattern.search(line) for pattern in patterns) == failure
+
+
+def test_read_log_increment_utf16_split_characters():
+    sftp = FakeSftp()
+    log = "c:\\temp\\a.log"
+    data = b'\xff\xfe' + "first line\r\nsecond".encode("utf-16-le")
+    state = new_state()
+    sftp.write(log, data[:9])    # the BOM and an odd number of bytes
+    assert veeam_install.read_log_increment(sftp, log, state) == []
+    sftp.write(log, data[9:])
+    assert veeam_install.read_log_increment(sftp, log, state) == ["first line"]
+    sftp.write(log, "\r\n".encode("utf-16-le"))
+    assert veeam_install.read_log_increment(sftp, log, state) == ["second"]
+
+
+def test_read_log_increment_new_log():
+    sftp = FakeSftp()
+    log = "c:\\temp\\a.log"
+    state = new_state()
+    sftp.write(log, b'an old log of many bytes\n')
+    veeam_install.read_log_increment(sftp, log, state)
+    sftp.files.clear()
+    sftp.write(log, b'new\n')
+    assert veeam_install.read_log_increment(sftp, log, state) == ["new"]
+
+
+def monitor(vcdata, sftp, logs, stall_window, release_after=None):
+    done = threading.Event()
+    worker = threading.Thread(target=done.wait, args=(release_after or 5,), daemon=True)
+    worker.start()
+    try:
+        conn = types.SimpleNamespace(sftp=lambda: sftp)
+        return veeam_install.monitor_installer_logs(vcdata, "10.0.0.1", conn, worker, logs, stall_window)
+    finally:
+        done.set()
+
+
+def test_monitor_aborts_on_failure_line(vcdata):
+    sftp = FakeSftp()
+    logs = ["c:\\temp\\a.log", "c:\\temp\\b.log"]
+    sftp.write(logs[0], b'MSI (s) Doing action: InstallFiles\n')
+    sftp.write(logs[1], b'MSI (s) Return value 3.\n')
+    (reason, max_gap) = monitor(vcdata, sftp, logs, 60)
+    assert reason is not None and "b.log" in reason and "Return value 3" in reason
+
+
+def test_monitor_lets_a_reboot_request_pass(vcdata):
+    sftp = FakeSftp()
+    sftp.write("c:\\temp\\a.log", b'Installation success or error status: 3010.\nMainEngineThread is returning 3010\n')
+    (reason, max_gap) = monitor(vcdata, sftp, ["c:\\temp\\a.log"], 60, release_after=0.2)
+    assert reason is None
+
+
+def test_monitor_aborts_a_stalled_installer(vcdata):
+    sftp = FakeSftp()
+    sftp.write("c:\\temp\\a.log", b'MSI (s) Doing action: InstallFiles\n')
+    (reason, max_gap) = monitor(vcdata, sftp, ["c:\\temp\\a.log"], 0.1)
+    assert reason is not None and "did not grow" in reason
+
+
+def test_monitored_command_removes_earlier_logs_first(vcdata, monkeypatch):
+    calls = []
+    monkeypatch.setattr(veeam_install, "run_powershell", lambda vcdata, veeam_serv, script, *args, **kwargs: calls.append(("remove", script)) or 0)
+    monkeypatch.setattr(veeam_install, "run_command", lambda *args, **kwargs: calls.append(("run", args[0])) or 0)
+    monkeypatch.setattr(veeam_install, "monitor_installer_logs", lambda vcdata, veeam_serv, conn, worker, logs, stall_window: (worker.join(), (None, 0.0))[1])
+    logs = ["c:\\temp\\run\\a.log", "c:\\temp\\run\\b.log"]
+    rc = veeam_install.run_monitored_command(vcdata, "10.0.0.1", "powershell -File x.ps1", None, 60, [], logs, "c:\\temp\\run\\x.pid")
+    assert rc == 0
+    assert [ call[0] for call in calls ] == ["remove", "run"]
+    assert all(f"Remove-Item -LiteralPath '{log}'" in calls[0][1] for log in logs)
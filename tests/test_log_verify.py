@@ -0,0 +1,53 @@
+import io
+
+import veeam_install
+
+
+def write_log(tmp_path, lines, encoding, bom=b''):
+    path = tmp_path / "install.log"
+    path.write_bytes(bom + '\r\n'.join(lines).encode(encoding))
+    return str(path)
+
+
+def test_detect_log_encoding():
+    assert veeam_install.detect_log_encoding(io.BytesIO(b'\xff\xfeM\x00')) == ("utf-16-le", 2)
+    assert veeam_install.detect_log_encoding(io.BytesIO(b'\xfe\xff\x00M')) == ("utf-16-be", 2)
+    assert veeam_install.detect_log_encoding(io.BytesIO(b'\xef\xbb\xbfMSI')) == ("utf-8", 3)
+    assert veeam_install.detect_log_encoding(io.BytesIO("MS".encode("utf-16-le"))) == ("utf-16-le", 0)
+    assert veeam_install.detect_log_encoding(io.BytesIO(b'MSI (s)')) == ("utf-8", 0)
+
+
+def test_reverse_log_lines_across_blocks():
+    lines = [ f"line {i}" for i in range(100) ]
+    for encoding in ["utf-8", "utf-16-le"]:
+        fh = io.BytesIO('\n'.join(lines).encode(encoding))
+        # small odd blocks split lines and utf-16 characters
+        found = list(veeam_install.reverse_log_lines(fh, encoding, 0, block_size=7))
+        assert found == lines[::-1]
+
+
+def test_reverse_log_lines_ignores_truncated_character():
+    fh = io.BytesIO(b'\xff\xfe' + "first\nlast".encode("utf-16-le") + b'\x00')
+    assert list(veeam_install.reverse_log_lines(fh, "utf-16-le", 2)) == ["last", "first"]
+
+
+def test_verify_ps_log_success(tmp_path):
+    path = write_log(tmp_path, ["MSI (s) Doing action: InstallFinalize", "MSI (c) MainEngineThread is returning 0", ""], "utf-16-le", b'\xff\xfe')
+    verdict = veeam_install.verify_ps_log(path, veeam_install.msi_success_str)
+    assert verdict["rc"] == 0
+    assert verdict["msi_return"] == 0
+    assert verdict["failures"] == []
+
+
+def test_verify_ps_log_failure(tmp_path):
+    path = write_log(tmp_path, ["MSI (s) Return value 3.", "MSI (c) MainEngineThread is returning 1603"], "utf-8")
+    verdict = veeam_install.verify_ps_log(path, veeam_install.msi_success_str)
+    assert verdict["rc"] == 1
+    assert verdict["msi_return"] == 1603
+    assert len(verdict["failures"]) == 2
+
+
+def test_verify_ps_log_only_reads_the_tail(tmp_path):
+    path = write_log(tmp_path, ["MSI (c) MainEngineThread is returning 0"] + [ f"line {i}" for i in range(50) ], "utf-8")
+    assert veeam_install.verify_ps_log(path, veeam_install.msi_success_str, tail_lines=10)["rc"] == 1
+    assert veeam_install.verify_ps_log(path, veeam_install.msi_success_str, tail_lines=60)["rc"] == 0
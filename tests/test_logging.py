@@ -0,0 +1,39 @@
+import json
+import logging
+
+import veeam_install
+
+
+def make_record(message="installing"):
+    record = logging.LogRecord("veeam_install_test", logging.INFO, __file__, 1, message, None, None)
+    veeam_install.add_log_context(record)
+    return record
+
+
+def test_log_context_of_the_current_span(tmp_path):
+    vcdata = {"mylogger": logging.getLogger("veeam_install_test")}
+    veeam_install.init_metrics(vcdata, str(tmp_path / "metrics.jsonl"))
+    assert make_record().log_context == '-'
+    with veeam_install.trace_span(vcdata, "server", server="10.0.0.1", vm_name="veeam-serv1"):
+        with veeam_install.trace_span(vcdata, "step", step="patch"):
+            record = make_record()
+    assert (record.vm_name, record.server, record.step) == ("veeam-serv1", "10.0.0.1", "patch")
+    assert record.log_context == "veeam-serv1 10.0.0.1 patch"
+    assert json.loads(veeam_install.JsonLogFormatter().format(record))["vm_name"] == "veeam-serv1"
+
+    # a server given by its address only
+    with veeam_install.trace_span(vcdata, "verify_server", server="10.0.0.2", vm_name="10.0.0.2"):
+        assert make_record().log_context == "10.0.0.2"
+    veeam_install.close_metrics(vcdata)
+
+
+def test_server_log_files_are_named_by_vm_and_ip(tmp_path):
+    handler = veeam_install.ServerLogHandler(str(tmp_path / "install.log"))
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    for (vm_name, server) in (("veeam-serv1", "10.0.0.1"), (None, "10.0.0.2"), (None, None)):
+        record = make_record(f"on {server}")
+        (record.vm_name, record.server) = (vm_name, server)
+        handler.emit(record)
+    handler.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["install.log_10.0.0.2.log", "install.log_veeam-serv1_10.0.0.1.log"]
+    assert (tmp_path / "install.log_veeam-serv1_10.0.0.1.log").read_text() == "on 10.0.0.1\n"
@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+import veeam_install
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / "a.msi"
+    path.write_bytes(b'x' * 3000000)
+    assert veeam_install.hash_file(str(path)) == hashlib.sha256(b'x' * 3000000).hexdigest()
+
+
+def test_build_media_manifest_caches_hashes(tmp_path, mylogger, monkeypatch):
+    (tmp_path / "backup").mkdir()
+    (tmp_path / "backup" / "Server.x64.msi").write_bytes(b'server')
+    (tmp_path / "catalog.msi").write_bytes(b'catalog')
+
+    files = veeam_install.build_media_manifest(str(tmp_path), mylogger)
+    assert [ entry["path"] for entry in files ] == ["catalog.msi", "backup/Server.x64.msi"]
+    assert files[1]["sha256"] == hashlib.sha256(b'server').hexdigest()
+    assert os.path.exists(tmp_path / veeam_install.media_manifest_file)
+
+    # unchanged files are not hashed again, a changed one is
+    hashed = []
+    real_hash_file = veeam_install.hash_file
+    monkeypatch.setattr(veeam_install, "hash_file", lambda path: hashed.append(path) or real_hash_file(path))
+    (tmp_path / "catalog.msi").write_bytes(b'catalog v2')
+    files = veeam_install.build_media_manifest(str(tmp_path), mylogger)
+    assert hashed == [str(tmp_path / "catalog.msi")]
+    assert files[0]["sha256"] == hashlib.sha256(b'catalog v2').hexdigest()
+
+
+def test_media_remote_path():
+    assert veeam_install.media_remote_path({"path": "backup/Server.x64.msi"}) == "c:\\veeam_soft\\backup\\Server.x64.msi"
+
+
+def test_media_journal_roundtrip(tmp_path):
+    journal = str(tmp_path / "blob.json")
+    assert veeam_install.load_media_journal(journal) == set()
+    veeam_install.save_media_journal(journal, {3, 1, 2})
+    assert veeam_install.load_media_journal(journal) == {1, 2, 3}
@@ -0,0 +1,69 @@
+import json
+
+import veeam_install
+
+
+def test_no_metrics_yields_an_empty_span(mylogger):
+    with veeam_install.trace_span({"mylogger": mylogger}, "server", server="10.0.0.1") as span:
+        span["rc"] = 0
+    with veeam_install.trace_span(None, "step") as span:
+        assert span == {}
+
+
+def test_spans_nest_and_inherit(tmp_path, mylogger):
+    vcdata = {"mylogger": mylogger}
+    veeam_install.init_metrics(vcdata, str(tmp_path / "metrics.jsonl"))
+    with veeam_install.trace_span(vcdata, "server", server="10.0.0.1", vm_name="veeam-serv1") as server:
+        with veeam_install.trace_span(vcdata, "step", step="patch") as step:
+            # vcdata may be None inside an open span
+            with veeam_install.trace_span(None, "exec") as exec_span:
+                exec_span["rc"] = 0
+        try:
+            with veeam_install.trace_span(vcdata, "step", step="console"):
+                raise RuntimeError("lost the connection")
+        except RuntimeError:
+            pass
+    veeam_install.close_metrics(vcdata)
+
+    spans = [ json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines() ]
+    assert [ span["span"] for span in spans ] == ["exec", "step", "step", "server"]
+    (exec_span, step, failed, server) = spans
+    assert (exec_span["parent"], step["parent"], failed["parent"], server["parent"]) == (step["id"], server["id"], server["id"], None)
+    assert (exec_span["server"], exec_span["vm_name"], exec_span["step"], exec_span["rc"]) == ("10.0.0.1", "veeam-serv1", "patch", 0)
+    assert failed["rc"] == "exception"
+    assert veeam_install.trace_context.get() is None
+
+
+def span(id, parent, name, duration, **fields):
+    return dict({"id": id, "parent": parent, "span": name, "duration": duration, "server": "10.0.0.1", "step": None, "rc": 0}, **fields)
+
+
+def test_phase_durations():
+    children = {1: [span(2, 1, "put", 1.5), span(3, 1, "exec", 10.0), span(4, 1, "exec", 2.0), span(5, 1, "unknown", 7.0)]}
+    durations = veeam_install.get_phase_durations(children, 1)
+    assert list(durations) == veeam_install.trace_phases
+    assert (durations["put"], durations["exec"], durations["wait"]) == (1.5, 12.0, 0.0)
+    assert veeam_install.get_phase_durations(children, 2)["exec"] == 0.0
+
+
+def test_prom_labels_are_escaped():
+    assert veeam_install.prom_labels(server="10.0.0.1", step='c:\\x "y"') == '{server="10.0.0.1",step="c:\\\\x \\"y\\""}'
+
+
+def test_prometheus_textfile(tmp_path, mylogger):
+    prom_file = tmp_path / "veeam_install.prom"
+    vcdata = {"mylogger": mylogger, "metrics": {"prom_file": str(prom_file), "spans": [
+        span(1, None, "server", 100.0), span(2, 1, "step", 60.0, step="patch"), span(3, 2, "exec", 50.0, step="patch"),
+        span(4, 1, "admit", 5.0), span(5, 1, "admit", 2.5)]}}
+    veeam_install.write_prometheus_textfile(vcdata)
+
+    lines = prom_file.read_text().splitlines()
+    assert 'veeam_install_server_duration_seconds{server="10.0.0.1",rc="0"} 100.0' in lines
+    assert 'veeam_install_step_duration_seconds{server="10.0.0.1",step="patch",rc="0"} 60.0' in lines
+    assert 'veeam_install_step_phase_seconds{server="10.0.0.1",step="patch",phase="exec"} 50.0' in lines
+    assert 'veeam_install_admission_wait_seconds{server="10.0.0.1"} 7.5' in lines
+    assert [ path.name for path in tmp_path.iterdir() ] == ["veeam_install.prom"]
+
+    # no textfile asked for
+    vcdata["metrics"]["prom_file"] = None
+    veeam_install.write_prometheus_textfile(vcdata)
@@ -0,0 +1,39 @@
+import time
+
+import yaml
+
+import veeam_install
+
+
+def test_deploy_units(tmp_path, mylogger):
+    yamlfile = tmp_path / "veeam_install.yaml"
+    entries = [{"vm_name": "veeam-serv1"}, {"vm_name": "veeam-serv2"}]
+    yamlfile.write_text(yaml.safe_dump({"VCenter": {"vcenter_name": "vc1"}, "veeam_install": entries}))
+    (rc, vcdata, yaml_data, units) = veeam_install.get_deploy_units(str(yamlfile), mylogger, "veeam_install")
+    assert (rc, vcdata, units) == (0, {"vcenter_name": "vc1"}, entries)
+    assert yaml_data["VCenter"] == {"vcenter_name": "vc1"}
+
+    for data in ({"veeam_install": entries}, {"VCenter": {"vcenter_name": "vc1"}, "veeam_install": []}):
+        yamlfile.write_text(yaml.safe_dump(data))
+        assert veeam_install.get_deploy_units(str(yamlfile), mylogger, "veeam_install") == (1, {}, None, [])
+
+
+def test_queue_depth(mylogger):
+    vcdata = {"mylogger": mylogger}
+    veeam_install.init_pipeline(vcdata)
+    assert [ veeam_install.update_queue_depth(vcdata, "install", delta) for delta in (1, 1, -1, 1, -1, -1) ] == [1, 2, 1, 2, 1, 0]
+    assert vcdata["pipeline"]["max_depth"] == {"provision": 0, "install": 2}
+
+
+def test_queued_item_records_its_wait(tmp_path, mylogger):
+    vcdata = {"mylogger": mylogger}
+    veeam_install.init_pipeline(vcdata)
+    veeam_install.init_metrics(vcdata, str(tmp_path / "metrics.jsonl"))
+    veeam_install.update_queue_depth(vcdata, "install", 2)
+    enqueued = time.time() - 5
+
+    assert veeam_install.run_queued(vcdata, "install", "veeam-serv1", enqueued, lambda x, y: x + y, 1, 2) == 3
+    veeam_install.close_metrics(vcdata)
+    (span,) = vcdata["metrics"]["spans"]
+    assert (span["span"], span["stage"], span["item"], span["depth"], span["rc"], span["start"]) == ("queue", "install", "veeam-serv1", 1, 0, enqueued)
+    assert span["duration"] >= 5
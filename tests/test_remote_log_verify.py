@@ -0,0 +1,40 @@
+import json
+
+import veeam_install
+
+
+def test_ps_quote():
+    assert veeam_install.ps_quote("c:\\temp\\it's.log") == "'c:\\temp\\it''s.log'"
+    assert veeam_install.ps_string_array(["a", "b'c"]) == "@('a', 'b''c')"
+
+
+def test_render_log_verdict_call():
+    call = veeam_install.render_log_verdict_call("c:\\temp\\a.log", "MainEngineThread is returning 0", tail_lines=5)
+    assert call.startswith("Get-LogVerdict -Path 'c:\\temp\\a.log' -Success 'MainEngineThread is returning 0' -Failure @(")
+    assert call.endswith(" -Tail 5")
+    assert veeam_install.render_log_verdict_call("c:\\a.log", "ok", path_expr="(Find-InstallLog 'x' 'y')").startswith("Get-LogVerdict -Path (Find-InstallLog 'x' 'y') ")
+
+
+def verify(monkeypatch, mylogger, rc, lines):
+    scripts = []
+    def run_powershell(vcdata, veeam_serv, script, results=None):
+        scripts.append(script)
+        results.extend(lines)
+        return rc
+    monkeypatch.setattr(veeam_install, "run_powershell", run_powershell)
+    verdict = veeam_install.remote_verify_ps_log({"mylogger": mylogger}, "10.0.0.1", "c:\\temp\\a.log", "MainEngineThread is returning 0")
+    return (verdict, scripts)
+
+
+def test_remote_verdict(monkeypatch, mylogger):
+    remote = {"rc": 0, "matched_line": "MainEngineThread is returning 0", "failures": [], "msi_return": 0, "lines": 10, "size": 4096}
+    (verdict, scripts) = verify(monkeypatch, mylogger, 0, [json.dumps(remote)])
+    assert verdict == remote
+    # only the verdict comes back: the log stays on the server
+    assert "function Get-LogVerdict" in scripts[0] and scripts[0].endswith("| ConvertTo-Json -Compress")
+
+
+def test_failed_or_garbled_verdict_is_a_failure(monkeypatch, mylogger):
+    for (rc, lines) in ((1, []), (0, ["not json"])):
+        (verdict, scripts) = verify(monkeypatch, mylogger, rc, lines)
+        assert (verdict["rc"], verdict["lines"]) == (1, 0)
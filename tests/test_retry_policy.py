@@ -0,0 +1,151 @@
+import threading
+
+import pytest
+
+import veeam_install
+
+
+class CommandTimedOut(Exception):
+    pass
+
+
+class SSHException(Exception):
+    pass
+
+
+@pytest.mark.parametrize("evidence,failure_class", [
+    ([("exit_code", 1603), ("log", {"failures": ["Return value 3."], "msi_return": 1603})], "install_failed"),
+    ([("exit_code", 1618)], "msi_busy"),
+    ([("exit_code", "3010")], "reboot_pending"),
+    ([("log", {"failures": [], "msi_return": 1641})], "reboot_pending"),
+    ([("exit_code", 1638)], "fatal"),
+    ([("abort", 'installer log c:\\a.log reports "Installation success or error status: 1625."')], "fatal"),
+    ([("stderr", "Error 1311. Source file not found")], "fatal"),
+    ([("abort", "installer log c:\\a.log did not grow for 900 seconds")], "stalled"),
+    ([("exception", CommandTimedOut("Command did not complete within 1800 seconds!"))], "timed_out"),
+    ([("exception", SSHException("Error reading SSH protocol banner"))], "transient"),
+    ([("exception", EOFError())], "transient"),
+    ([("exception", TimeoutError("connect timed out"))], "transient"),
+    ([("exception", ConnectionResetError(104, "Connection reset by peer"))], "transient"),
+    ([("exception", FileNotFoundError(2, "No such file", "/media/Server.x64.msi"))], "fatal"),
+    ([("exception", PermissionError(13, "Permission denied", "/tmp/veeam_install_state.json"))], "fatal"),
+    ([("timeout", "the server is not ready after the reboot")], "transient"),
+    ([("exception", ValueError("bad report"))], "unknown"),
+    ([], "unknown") ])
+def test_classify_failure(evidence, failure_class):
+    assert veeam_install.classify_failure(evidence)[0] == failure_class
+
+
+def test_retry_policy_overrides():
+    policies = veeam_install.get_retry_policy({"options": {"retry_policy": {"msi_busy": {"budget": 5}}}})
+    assert policies["msi_busy"] == {"budget": 5, "backoff": veeam_install.default_retry_policy["msi_busy"]["backoff"]}
+    assert policies["fatal"] == veeam_install.default_retry_policy["fatal"]
+
+
+@pytest.fixture
+def run_step(mylogger, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(veeam_install.time, "sleep", sleeps.append)
+
+    def run(outcomes, prepare_rc=0, retries=0, options=None, cancel=None):
+        attempts = []
+        def runner(vcdata, veeam_serv, step):
+            (rc, evidence) = outcomes[min(len(attempts), len(outcomes) - 1)]
+            attempts.append(rc)
+            if isinstance(evidence, Exception):
+                raise evidence
+            for (kind, value) in evidence:
+                veeam_install.note_failure(kind, value)
+            return rc
+        monkeypatch.setitem(veeam_install.install_step_runners, "msi", runner)
+        monkeypatch.setattr(veeam_install, "prepare_retry", lambda vcdata, veeam_serv, failure_class: prepare_rc)
+        vcdata = {"mylogger": mylogger, "options": options or {}, "cancel": cancel}
+        step = veeam_install.normalize_install_step({"name": "catalog", "kind": "msi", "installer": "c:\\a.msi", "log": "c:\\a.log", "retries": retries})
+        rc = veeam_install.run_plan_step(vcdata, {"vm_ip": "10.0.0.1"}, step, {"msiexec": threading.Lock()})
+        return (rc, len(attempts), sleeps)
+    return run
+
+
+def test_budget_per_class_and_backoff(run_step):
+    (rc, attempts, sleeps) = run_step([(1, [("exit_code", 1618)])] * 4 + [(0, [])])
+    assert (rc, attempts) == (1, 4)
+    assert sleeps == [120, 240, 480]
+
+
+def test_success_after_retry(run_step):
+    (rc, attempts, sleeps) = run_step([(1, [("exit_code", 1618)]), (0, [])])
+    assert (rc, attempts) == (0, 2)
+
+
+def test_fatal_and_timed_out_are_not_retried(run_step):
+    assert run_step([(1, [("exit_code", 1638)]), (0, [])])[:2] == (1, 1)
+    assert run_step([(1, [("exception", CommandTimedOut("timed out"))]), (0, [])])[:2] == (1, 1)
+
+
+def test_install_failed_uses_step_retries(run_step):
+    assert run_step([(1, [("exit_code", 1603)]), (0, [])], retries=0)[:2] == (1, 1)
+    # the re-run is gated by the readiness wait of prepare_retry, not by a sleep
+    assert run_step([(1, [("exit_code", 1603)]), (0, [])], retries=1) == (0, 2, [])
+
+
+def test_retry_policy_option(run_step):
+    assert run_step([(1, [("exit_code", 1638)]), (0, [])], options={"retry_policy": {"fatal": {"budget": 1}}})[:2] == (0, 2)
+
+
+def test_no_rerun_when_prepare_retry_fails(run_step):
+    assert run_step([(1, [("exit_code", 3010)]), (0, [])], prepare_rc=1)[:2] == (1, 1)
+
+
+def test_runner_exception_is_classified_and_retried(run_step):
+    assert run_step([(1, SSHException("connection reset")), (0, [])])[:2] == (0, 2)
+
+
+def test_no_rerun_after_cancel(run_step):
+    cancel = threading.Event()
+    cancel.set()
+    assert run_step([(1, [("exit_code", 1618)]), (0, [])], cancel=cancel)[:2] == (1, 1)
+
+
+@pytest.mark.parametrize("exit_code,verdict,required", [
+    ("3010", {"lines": 10, "failures": [], "msi_return": 3010}, True),
+    (1641, {"lines": 10, "failures": [], "msi_return": None}, True),
+    ("3010", {"lines": 0, "failures": [], "msi_return": None}, False),    # no log
+    ("3010", {"lines": 10, "failures": ["Return value 3."], "msi_return": 3010}, False),
+    ("3010", {"lines": 10, "failures": [], "msi_return": 1603}, False),
+    ("1603", {"lines": 10, "failures": [], "msi_return": None}, False) ])
+def test_is_reboot_required(exit_code, verdict, required):
+    assert veeam_install.is_reboot_required(exit_code, verdict) == required
+
+
+def test_reboot_required_step_succeeds(mylogger, monkeypatch):
+    def runner(vcdata, veeam_serv, step):
+        veeam_install.note_failure("reboot_required", 3010)
+        return 0
+    monkeypatch.setitem(veeam_install.install_step_runners, "msi", runner)
+    step = veeam_install.normalize_install_step({"name": "catalog", "kind": "msi", "installer": "c:\\a.msi", "log": "c:\\a.log"})
+    reboots = set()
+    rc = veeam_install.run_plan_step({"mylogger": mylogger, "options": {}}, {"vm_ip": "10.0.0.1"}, step, {"msiexec": threading.Lock()}, reboots)
+    assert (rc, reboots) == (0, {"catalog"})
+
+
+def test_plan_reboots_before_the_dependent_steps(mylogger, monkeypatch):
+    events = []
+    def run_plan_step(vcdata, server, step, locks, reboots):
+        events.append(step["name"])
+        if(step["name"] == "a"):
+            reboots.add("a")
+        return 0
+    monkeypatch.setattr(veeam_install, "run_plan_step", run_plan_step)
+    monkeypatch.setattr(veeam_install, "reboot_veeam_server", lambda vcdata, veeam_serv: events.append("reboot") or 0)
+    monkeypatch.setattr(veeam_install, "apply_learned_limits", lambda vcdata, server, plan: plan)
+    monkeypatch.setattr(veeam_install, "record_checkpoint", lambda vcdata, server, name: None)
+    plan = [ veeam_install.normalize_install_step({"name": name, "kind": "msi", "installer": "c:\\a.msi", "log": "c:\\a.log", "depends": depends})
+             for (name, depends) in (("a", []), ("b", ["a"]), ("c", ["b"])) ]
+    vcdata = {"mylogger": mylogger, "options": {"plan_workers": 1}}
+    assert veeam_install.run_install_plan(vcdata, {"vm_ip": "10.0.0.1"}, plan) == (0, None)
+    assert events == ["a", "reboot", "b", "c"]
+
+    monkeypatch.setattr(veeam_install, "reboot_veeam_server", lambda vcdata, veeam_serv: 1)
+    events.clear()
+    assert veeam_install.run_install_plan(vcdata, {"vm_ip": "10.0.0.1"}, plan) == (1, "reboot after a")
+    assert events == ["a"]
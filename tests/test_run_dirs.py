@@ -0,0 +1,55 @@
+import os
+import time
+
+import veeam_install
+
+
+now = time.time()
+day = 86400
+
+
+def run_name(age, suffix="0000000a"):
+    return time.strftime('%Y%m%d_%H%M%S', time.localtime(now - age)) + '_' + suffix
+
+
+def test_only_finished_runs_beyond_keep_runs_are_removed():
+    runs = { run_name(10 * 3600 - hours * 3600, f"{hours:08x}"): 0 for hours in range(5) }
+    current = run_name(0, "ffffffff")
+    pruned = veeam_install.get_prunable_run_dirs(dict(runs, **{current: None}), current, 3, now)
+    assert pruned == sorted(runs)[:3]
+
+
+def test_running_runs_and_newer_ones_are_kept():
+    (old, running, finished_later) = (run_name(3 * 3600, "00000001"), run_name(2 * 3600, "00000002"), run_name(3600, "00000003"))
+    current = run_name(0, "ffffffff")
+    runs = {old: 0, running: None, finished_later: 0, current: None}
+    # the run started before this one still runs: nothing newer than it is removed
+    assert veeam_install.get_prunable_run_dirs(runs, current, 1, now) == [old]
+
+
+def test_failed_runs_are_kept_as_evidence_for_a_while():
+    (failed, stale_failed, crashed) = (run_name(day, "00000001"), run_name(8 * day, "00000002"), run_name(9 * day, "00000003"))
+    current = run_name(0, "ffffffff")
+    runs = {failed: 1, stale_failed: 1, crashed: None, current: None}
+    assert veeam_install.get_prunable_run_dirs(runs, current, 1, now) == [crashed, stale_failed]
+
+
+def test_parse_run_rc():
+    assert veeam_install.parse_run_rc(None) is None
+    assert veeam_install.parse_run_rc("0\n") == 0
+    assert veeam_install.parse_run_rc("garbage") == 1
+
+
+def test_prune_local_run_dirs(tmp_path, mylogger, monkeypatch):
+    monkeypatch.setattr(veeam_install, "local_base_dir", str(tmp_path))
+    (done, running) = (run_name(2 * 3600, "00000001"), run_name(3600, "00000002"))
+    for name in (done, running):
+        (tmp_path / name).mkdir()
+    (tmp_path / "media_journal").mkdir()
+    vcdata = {"mylogger": mylogger, "options": {"keep_runs": 1}}
+    veeam_install.init_run_dirs(vcdata)
+    assert sorted(os.listdir(tmp_path)) == sorted([done, running, "media_journal"])
+
+    veeam_install.mark_local_run_finished({"mylogger": mylogger, "local_dir": str(tmp_path / done)}, 0)
+    veeam_install.prune_local_run_dirs(vcdata)
+    assert sorted(os.listdir(tmp_path)) == sorted([running, "media_journal"])
@@ -0,0 +1,88 @@
+import pytest
+
+import veeam_install
+
+
+def test_percentile():
+    values = [ float(i) for i in range(20, 0, -1) ]
+    assert (veeam_install.percentile(values, 50), veeam_install.percentile(values, 95), veeam_install.percentile(values, 100)) == (10.0, 19.0, 20.0)
+    assert (veeam_install.percentile([7.0], 0), veeam_install.percentile([7.0], 95)) == (7.0, 7.0)
+
+
+def step_span(step, server, duration, log_gap=None, rc=0, attempts=1):
+    return {"span": "step", "step": step, "server": server, "end": 1000.0 + duration, "duration": duration, "log_gap": log_gap,
+            "rc": rc, "attempts": attempts}
+
+
+# record the steps of one run as run_id, with the servers on the given datastores
+#
+def record_run(vcdata, run_id, spans, datastores):
+    vcdata["run_id"] = run_id
+    vcdata["metrics"] = {"spans": spans}
+    vcdata["history"]["datastores"] = dict(datastores)
+    vcdata["history"]["baselines"] = {}
+    veeam_install.record_run_history(vcdata)
+
+
+@pytest.fixture
+def vcdata(tmp_path, mylogger):
+    vcdata = {"mylogger": mylogger, "options": {}}
+    veeam_install.init_run_history(vcdata, str(tmp_path / "history.db"), "11.0.1.1261")
+    yield vcdata
+    veeam_install.close_run_history(vcdata)
+
+
+def test_only_first_attempt_successes_are_recorded(vcdata):
+    record_run(vcdata, "run1", [step_span("server", "10.0.0.1", 600.0), step_span("server", "10.0.0.2", 900.0, rc=1),
+                                step_span("server", "10.0.0.3", 800.0, attempts=2)], {"10.0.0.1": "ds1"})
+    rows = vcdata["history"]["db"].execute("SELECT run_id, step, version, datastore, server, duration FROM step_runs").fetchall()
+    assert rows == [("run1", "server", "11.0.1.1261", "ds1", "10.0.0.1", 600.0)]
+
+
+def test_baseline_needs_enough_samples_per_scope(vcdata):
+    samples = veeam_install.history_min_samples
+    record_run(vcdata, "run1", [ step_span("server", f"10.0.0.{i}", 100.0 * (i + 1), log_gap=60.0) for i in range(samples - 1) ],
+               { f"10.0.0.{i}": "ds1" for i in range(samples) })
+    assert veeam_install.get_step_baseline(vcdata, "server", "ds1") is None
+
+    # one more run on another datastore: enough runs of the version, not of the datastore
+    record_run(vcdata, "run2", [step_span("server", "10.0.1.1", 1000.0, log_gap=60.0)], {"10.0.1.1": "ds2"})
+    baseline = veeam_install.get_step_baseline(vcdata, "server", "ds1")
+    assert (baseline["scope"], baseline["samples"], baseline["p95"], baseline["gap_p95"]) == ("version 11.0.1.1261", samples, 1000.0, 60.0)
+    assert veeam_install.get_step_baseline(vcdata, "console", "ds1") is None
+
+    # the baseline is queried once per run
+    record_run(vcdata, "run3", [ step_span("server", f"10.0.0.{i}", 50.0) for i in range(samples) ], { f"10.0.0.{i}": "ds1" for i in range(samples) })
+    assert veeam_install.get_step_baseline(vcdata, "server", "ds1")["scope"] == "version 11.0.1.1261 on datastore ds1"
+    vcdata["history"]["db"].execute("DELETE FROM step_runs")
+    assert veeam_install.get_step_baseline(vcdata, "server", "ds1")["scope"] == "version 11.0.1.1261 on datastore ds1"
+
+
+def test_no_history_db(mylogger):
+    vcdata = {"mylogger": mylogger, "options": {}}
+    veeam_install.init_run_history(vcdata, "", "11.0.1.1261")
+    assert veeam_install.get_step_baseline(vcdata, "server", "ds1") is None
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    assert veeam_install.apply_learned_limits(vcdata, {"vm_ip": "10.0.0.1", "datastore": "ds1"}, plan) == plan
+
+
+def test_learned_limits(vcdata):
+    samples = veeam_install.history_min_samples
+    # fast steps with short log gaps hit the floors
+    spans = [ step_span("console", "10.0.0.1", 10.0, log_gap=5.0) for i in range(samples) ]
+    # slow steps are capped by their static limits
+    spans += [ step_span("server", "10.0.0.1", 5000.0, log_gap=2000.0) for i in range(samples) ]
+    spans += [ step_span("catalog", "10.0.0.1", 200.0, log_gap=100.0) for i in range(samples) ]
+    record_run(vcdata, "run1", spans, {"10.0.0.1": "ds1"})
+
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    learned = { step["name"]: step for step in veeam_install.apply_learned_limits(vcdata, {"vm_ip": "10.0.0.1", "datastore": "ds1"}, plan) }
+    static = { step["name"]: step for step in plan }
+
+    assert (learned["console"]["timeout"], learned["console"]["stall_window"]) == (veeam_install.history_min_timeout, veeam_install.history_min_stall)
+    assert (learned["server"]["timeout"], learned["server"]["stall_window"]) == (static["server"]["timeout"], veeam_install.default_stall_window)
+    assert (learned["catalog"]["timeout"], learned["catalog"]["stall_window"]) == (600, 300)
+    assert all(learned[name]["learned"] for name in ("console", "server", "catalog"))
+    # steps without history keep their static limits
+    assert learned["patch"] == static["patch"]
+    assert vcdata["history"]["datastores"] == {"10.0.0.1": "ds1"}
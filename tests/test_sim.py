@@ -0,0 +1,50 @@
+# Smoke tests of veeam_install.py against the offline simulation. veeam_sim.py answers every
+# remote script by its text, so a changed script template that the simulation no longer
+# recognizes fails here instead of silently.
+
+import json
+
+import pytest
+
+import veeam_install
+import veeam_sim
+
+
+@pytest.fixture
+def run_sim(tmp_path, monkeypatch, capsys):
+    # install_simulation() replaces these for good: restore them after the test
+    for name in ("Connection", "time", "ssh_port_open"):
+        monkeypatch.setattr(veeam_install, name, getattr(veeam_install, name))
+    for name in ("create_from_yaml", "get_vm_ip"):
+        monkeypatch.setattr(veeam_install.vm_operation, name, getattr(veeam_install.vm_operation, name, None), raising=False)
+    monkeypatch.setattr(veeam_install, "local_base_dir", str(tmp_path / "runs"))
+
+    def run(*args):
+        capsys.readouterr()
+        rc = veeam_sim.main(["-hd", "", "--seed", "1", "-s", "1000", "--json", "-d", str(tmp_path / "sim")] + list(args))
+        return (rc, json.loads(capsys.readouterr().out))
+    return run
+
+
+def test_pipeline(run_sim):
+    (rc, report) = run_sim("-n", "2", "--verify")
+    assert (rc, report["rc"], report["servers"], report["succeeded"]) == (0, 0, 2, 2)
+    assert report["verify"]["rc"] == 0
+    assert set(report["steps"]) == {"catalog", "server", "console", "service_pkgs", "patch", "update_components"}
+
+
+def test_no_pipeline_with_reboots(run_sim):
+    # 3010 is a success that needs a reboot: every server still installs
+    (rc, report) = run_sim("-n", "2", "-np", "-f", "0.5", "-fc", "3010")
+    assert (rc, report["rc"], report["succeeded"]) == (0, 0, 2)
+    assert report["operations"].get("injected_install_failure_3010")
+
+
+def test_golden_image(run_sim):
+    (rc, report) = run_sim("-n", "3", "-g")
+    assert (rc, report["rc"], report["succeeded"]) == (0, 0, report["servers"])
+
+
+def test_work_queue_controllers(run_sim):
+    (rc, report) = run_sim("-n", "3", "-c", "2", "--crash-controller", "--lease-ttl", "300")
+    assert (rc, report["rc"], report["servers"], report["succeeded"]) == (0, 0, 3, 3)
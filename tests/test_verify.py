@@ -0,0 +1,55 @@
+import json
+
+import yaml
+
+import veeam_install
+
+
+def healthy_probe():
+    products = ["Veeam Backup Catalog", "Veeam Backup & Replication Server", "Veeam Backup & Replication Console"]
+    products += [ pkg["service"] for pkg in veeam_install.veeam_service_pkgs[:-1] ] + ["Veeam Agent for Microsoft Windows Redistributable"]
+    registry = f"{veeam_install.veeam_maxsnapshots_reg['path']}\\{veeam_install.veeam_maxsnapshots_reg['name']}"
+    return {"products": products, "files": {veeam_install.veeam_service_exe: "11.0.1.1261"}, "logs": {},
+            "registry": {registry: str(veeam_install.veeam_maxsnapshots_value)},
+            "services": [{"name": "VeeamBackupSvc", "status": "Running"}], "sql": "Running", "version": "11.0.1.1261"}
+
+
+def check(probe):
+    plan = [ veeam_install.normalize_install_step(step) for step in veeam_install.default_install_plan ]
+    return veeam_install.check_server_health(probe, plan, veeam_install.get_veeam_version(plan))
+
+
+def test_healthy_server_passes_every_check():
+    checks = check(healthy_probe())
+    assert sorted(checks) == ["components", "registry", "services", "sql", "version"]
+    assert all(passed for (passed, details) in checks.values())
+
+
+def test_failed_checks():
+    probe = dict(healthy_probe(), services=[{"name": "VeeamBackupSvc", "status": "Stopped"}], sql=None, version="11.0.0.837",
+                 files={veeam_install.veeam_service_exe: "11.0.0.837"}, registry={})
+    checks = check(probe)
+    assert [ name for (name, (passed, details)) in sorted(checks.items()) if not passed ] == ["components", "registry", "services", "sql", "version"]
+    assert checks["services"][1].endswith("not running: VeeamBackupSvc")
+    assert checks["components"][1] == "not installed: patch, update_components"
+
+
+def test_verify_servers_from_the_state_files(tmp_path, mylogger, monkeypatch):
+    yamlfile = tmp_path / "veeam.yaml"
+    yamlfile.write_text(yaml.safe_dump({"VCenter": {"vcenter_name": "vc", "vcenter_user": "u", "vcenter_pw": "p", "ssl-check": False},
+                                        "veeam_install": [{"esx": "esx1", "datastore": "ds1"}]}))
+    state = {"servers": {"vm1": {"vm_name": "vm1", "esx": "esx1", "datastore": "ds1"},
+                         "vm2": {"vm_name": "vm2", "esx": None, "datastore": None},
+                         "vm3": {"vm_name": "vm3", "esx": "esx9", "datastore": "ds9"},
+                         "golden": {"vm_name": "golden", "esx": "esx1", "datastore": "ds1", "golden": True}}}
+    (tmp_path / "state.json").write_text(json.dumps(state))
+    asked = []
+    monkeypatch.setattr(veeam_install.vm_operation, "get_vm_ip", lambda vm_list, **kwargs: asked.extend(vm_list) or
+                        [ {"vm_name": name, "vm_ip": f"10.0.0.{index}"} for (index, name) in enumerate(vm_list) ], raising=False)
+    options = {"state_file": str(tmp_path / "state.json"), "queue_dir": str(tmp_path / "queue")}
+
+    servers = veeam_install.get_verify_servers(str(yamlfile), options, mylogger)
+    assert asked == ["vm1", "vm2"]
+    assert servers == [{"vm_name": "vm1", "vm_ip": "10.0.0.0"}, {"vm_name": "vm2", "vm_ip": "10.0.0.1"}]
+
+    assert veeam_install.get_verify_servers(str(yamlfile), dict(options, hosts=["10.1.1.1"]), mylogger) == [{"vm_name": "10.1.1.1", "vm_ip": "10.1.1.1"}]
@@ -0,0 +1,65 @@
+import pytest
+
+import veeam_install
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(veeam_install, "time", clock)
+    return clock
+
+
+def test_ready_at_once(clock, mylogger):
+    assert veeam_install.wait_until(mylogger, "ready", lambda: True, 60) == 0
+    assert clock.sleeps == []
+
+
+def test_backoff_doubles_up_to_the_max_interval(clock, mylogger):
+    checks = iter([False] * 6 + [True])
+    assert veeam_install.wait_until(mylogger, "ready", lambda: next(checks), 600, interval=2, max_interval=10) == 0
+    assert clock.sleeps == [2, 4, 8, 10, 10, 10]
+
+
+def test_deadline(clock, mylogger):
+    assert veeam_install.wait_until(mylogger, "never", lambda: False, 20, interval=2, max_interval=30) == 1
+    # the last sleep is cut to the deadline
+    assert clock.sleeps == [2, 4, 8, 6]
+    assert clock.now == 1020.0
+
+
+def test_check_exception_is_not_ready(clock, mylogger):
+    checks = iter([ConnectionRefusedError(), True])
+    def check():
+        value = next(checks)
+        if isinstance(value, Exception):
+            raise value
+        return value
+    assert veeam_install.wait_until(mylogger, "ssh", check, 60) == 0
+    assert clock.sleeps == [veeam_install.wait_initial_interval]
+
+
+@pytest.mark.parametrize("results,idle", [(["idle"], True), (["busy"], False), ([], False)])
+def test_installer_idle(monkeypatch, results, idle):
+    monkeypatch.setattr(veeam_install, "run_powershell", lambda vcdata, veeam_serv, script, results=None, lines=results: results.extend(lines) or 0)
+    assert veeam_install.installer_idle({}, "10.0.0.1") == idle
+
+
+def test_last_boot_time(monkeypatch):
+    monkeypatch.setattr(veeam_install, "run_powershell", lambda vcdata, veeam_serv, script, results=None: results.append("2026-10-17T08:00:00.0000000Z \n") or 0)
+    assert veeam_install.get_last_boot_time({}, "10.0.0.1") == "2026-10-17T08:00:00.0000000Z"
+    monkeypatch.setattr(veeam_install, "run_powershell", lambda vcdata, veeam_serv, script, results=None: 1)
+    assert veeam_install.get_last_boot_time({}, "10.0.0.1") is None
@@ -0,0 +1,112 @@
+import os
+import threading
+
+import pytest
+
+import veeam_install
+
+
+@pytest.fixture
+def workers(tmp_path, mylogger):
+    def new_worker(ttl=300):
+        vcdata = {"mylogger": mylogger}
+        veeam_install.init_work_queue(vcdata, str(tmp_path / "queue"), ttl)
+        return vcdata
+    return new_worker
+
+
+def enqueue(vcdata, task_id):
+    veeam_install.write_queue_file(veeam_install.get_queue_file(vcdata, "tasks", task_id), {"id": task_id, "entry": {}, "deployed": None})
+
+
+def lease_file(vcdata, task_id):
+    return veeam_install.get_queue_file(vcdata, "leases", task_id, ".lease")
+
+
+def test_only_one_worker_takes_a_lease(workers):
+    (first, second) = (workers(), workers())
+    assert veeam_install.take_lease(first, "t1")
+    assert not veeam_install.take_lease(second, "t1")
+    assert veeam_install.read_queue_file(lease_file(first, "t1"))["worker"] == first["queue"]["worker"]
+    assert [ name for name in os.listdir(os.path.dirname(lease_file(first, "t1"))) ] == ["t1.lease"]
+
+
+def test_concurrent_takers(workers):
+    takers = [ workers() for i in range(8) ]
+    results = []
+    threads = [ threading.Thread(target=lambda vcdata=vcdata: results.append(veeam_install.take_lease(vcdata, "t1"))) for vcdata in takers ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+
+
+def test_expired_lease_is_taken_over(workers):
+    (crashed, second) = (workers(), workers(ttl=60))
+    assert veeam_install.take_lease(crashed, "t1")
+    lease = veeam_install.read_queue_file(lease_file(crashed, "t1"))
+    veeam_install.write_queue_file(lease_file(crashed, "t1"), dict(lease, heartbeat=lease["heartbeat"] - 61))
+    assert veeam_install.take_lease(second, "t1")
+    assert veeam_install.read_queue_file(lease_file(second, "t1"))["worker"] == second["queue"]["worker"]
+
+
+def test_renewed_lease_is_not_taken_over(workers):
+    (first, second) = (workers(), workers(ttl=60))
+    assert veeam_install.take_lease(first, "t1")
+    veeam_install.renew_leases(first)
+    assert not veeam_install.take_lease(second, "t1")
+    assert veeam_install.holds_lease(first, "t1")
+
+
+def test_lost_lease_cancels_the_task(workers):
+    (first, second) = (workers(), workers(ttl=60))
+    assert veeam_install.take_lease(first, "t1")
+    cancel = first["queue"]["cancel"]["t1"] = threading.Event()
+    lease = veeam_install.read_queue_file(lease_file(first, "t1"))
+    veeam_install.write_queue_file(lease_file(first, "t1"), dict(lease, heartbeat=lease["heartbeat"] - 61))
+    assert veeam_install.take_lease(second, "t1")
+
+    veeam_install.renew_leases(first)
+    assert cancel.is_set()
+    assert not veeam_install.holds_lease(first, "t1")
+    # the old worker does not remove the lease of the new one
+    veeam_install.release_lease(first, "t1")
+    assert veeam_install.read_queue_file(lease_file(second, "t1"))["worker"] == second["queue"]["worker"]
+
+
+def test_claim_and_complete(workers):
+    (first, second) = (workers(), workers())
+    enqueue(first, "t1")
+    enqueue(first, "t2")
+    assert veeam_install.claim_next_task(first)["id"] == "t1"
+    assert veeam_install.claim_next_task(second)["id"] == "t2"
+    assert veeam_install.claim_next_task(second) is None
+
+    veeam_install.complete_task(first, {"id": "t1", "entry": {}}, [{"vm_name": "vm1", "vm_ip": "10.0.0.1", "rc": 0, "failed_step": None, "elapsed": 1}])
+    assert veeam_install.get_queued_tasks(first) == ["t2"]
+    assert veeam_install.read_queue_file(veeam_install.get_queue_file(first, "done", "t1"))["rc"] == 0
+    assert not os.path.exists(lease_file(first, "t1"))
+
+
+
+def test_resumed_vms_are_handed_off_once(tmp_path, mylogger):
+    yamlfile = tmp_path / "veeam.yaml"
+    yamlfile.write_text("VCenter: {vcenter_name: vc}\nveeam_install:\n  - {esx: esx1, datastore: ds1}\n")
+    state_file = tmp_path / "state.json"
+    veeam_install.write_queue_file(str(state_file), {"servers": {
+        "vm1": {"vm_name": "vm1", "esx": "esx1", "datastore": "ds1", "steps": {"catalog": {}}, "complete": False},
+        "vm2": {"vm_name": "vm2", "steps": {}, "complete": True}}})
+    options = {"resume": True, "state_file": str(state_file), "queue_dir": str(tmp_path / "queue")}
+
+    assert veeam_install.start_enqueue_vbr(str(yamlfile), mylogger, options) == 0
+    vcdata = {"mylogger": mylogger}
+    veeam_install.init_work_queue(vcdata, options["queue_dir"], 300)
+    [task_id] = veeam_install.get_queued_tasks(vcdata)
+    assert veeam_install.read_queue_file(str(state_file))["servers"]["vm1"]["queued"] == task_id
+    assert list(veeam_install.read_queue_file(veeam_install.get_queue_file(vcdata, "state", task_id))["servers"]) == ["vm1"]
+
+    # neither a second enqueue nor an install resume picks the VM up again
+    assert veeam_install.start_enqueue_vbr(str(yamlfile), mylogger, options) == 1
+    assert veeam_install.get_queued_tasks(vcdata) == [task_id]
+    assert veeam_install.get_resume_vms(str(yamlfile), mylogger, options)[0] == 1